@@ -0,0 +1,255 @@
+"""
+Asynchronous, sharded training checkpoints.
+
+A checkpoint for step `i` is a directory `step_{i:010d}` containing:
+
+- `model_config.json` and `model.pt`: the model, loadable with `BasicsTransformerLM.from_pretrained`.
+- `shard_{rank:05d}.pt`: one file per DDP rank, holding the optimizer state of every `world_size`-th
+  parameter, plus that rank's RNG state and pending batch (the data sampler state).
+- `meta.json`: the step and world size, written last.
+
+Each rank snapshots its state to CPU on the training thread and writes it from a background thread,
+so the training loop only blocks for the device -> host copy. Ranks write into `step_{i:010d}.tmp`
+and drop a `shard_{rank:05d}.done` marker when finished; rank 0 waits for all markers, then atomically
+renames the directory and deletes all but the newest `keep_last` checkpoints. A directory without the
+`.tmp` suffix is therefore always complete.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import random
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+_TMP_SUFFIX = ".tmp"
+
+
+def _to_cpu(obj: Any) -> Any:
+    """Recursively copy all tensors in `obj` to CPU, so the originals can keep changing while we write."""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def get_rng_state() -> dict:
+    state = {
+        "python": random.getstate(),
+        "numpy": np.random.get_state(),
+        "torch": torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state()
+    return state
+
+
+def set_rng_state(state: dict) -> None:
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state(state["cuda"])
+
+
+def _shard_optimizer_state(optimizer_state: dict, rank: int, world_size: int) -> dict:
+    """Keep the per-parameter state of every `world_size`-th parameter, starting at `rank`."""
+    return {
+        "state": {k: v for k, v in optimizer_state["state"].items() if k % world_size == rank},
+        "param_groups": optimizer_state["param_groups"],
+    }
+
+
+def _step_dir_name(step: int) -> str:
+    return f"step_{step:010d}"
+
+
+def list_checkpoints(checkpoint_dir: str | os.PathLike) -> list[Path]:
+    """Return the complete checkpoints in `checkpoint_dir`, oldest first."""
+    checkpoint_dir = Path(checkpoint_dir)
+    if not checkpoint_dir.exists():
+        return []
+    return sorted(p for p in checkpoint_dir.glob("step_*") if p.is_dir() and not p.name.endswith(_TMP_SUFFIX))
+
+
+def latest_checkpoint(checkpoint_dir: str | os.PathLike) -> Path | None:
+    checkpoints = list_checkpoints(checkpoint_dir)
+    return checkpoints[-1] if checkpoints else None
+
+
+class CheckpointManager:
+    """Write checkpoints in a background thread and keep the last `keep_last` of them.
+
+    Args:
+        checkpoint_dir: str | os.PathLike
+            Directory holding one `step_*` subdirectory per checkpoint. Must be shared by all ranks.
+        model_config: dict
+            The model configuration, written as `model_config.json`.
+        rank: int
+            The DDP rank of this process.
+        world_size: int
+            The number of DDP processes.
+        keep_last: int
+            Number of most recent checkpoints to keep; older ones are deleted.
+        timeout: float
+            Seconds rank 0 waits for the other ranks' shards before giving up on a checkpoint.
+    """
+
+    def __init__(
+        self,
+        checkpoint_dir: str | os.PathLike,
+        model_config: dict,
+        rank: int = 0,
+        world_size: int = 1,
+        keep_last: int = 3,
+        timeout: float = 3600.0,
+    ):
+        self.checkpoint_dir = Path(checkpoint_dir)
+        self.model_config = model_config
+        self.rank = rank
+        self.world_size = world_size
+        self.keep_last = keep_last
+        self.timeout = timeout
+        self._thread: threading.Thread | None = None
+        self._error: BaseException | None = None
+
+        self.checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        if self.rank == 0:
+            # Leftovers from a run that died while writing
+            for tmp_dir in self.checkpoint_dir.glob(f"step_*{_TMP_SUFFIX}"):
+                logger.info(f"Removing incomplete checkpoint {tmp_dir}")
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def save(
+        self,
+        step: int,
+        model: torch.nn.Module,
+        optimizer: torch.optim.Optimizer,
+        extra_state: dict | None = None,
+    ) -> None:
+        """Snapshot the training state to CPU and write it asynchronously.
+
+        `step` is the step training resumes at. `model` must be the unwrapped model (no DDP or
+        `torch.compile` wrapper). `extra_state` is saved per rank, e.g. the pending batch.
+        Blocks only if the previous checkpoint is still being written.
+        """
+        self.wait()
+        shard = {
+            "optimizer": _shard_optimizer_state(optimizer.state_dict(), self.rank, self.world_size),
+            "rng": get_rng_state(),
+            "extra_state": extra_state or {},
+        }
+        model_state = model.state_dict() if self.rank == 0 else None
+        shard, model_state = _to_cpu(shard), _to_cpu(model_state)
+        self._thread = threading.Thread(
+            target=self._write, args=(step, shard, model_state), name=f"checkpoint-{step}", daemon=False
+        )
+        self._thread.start()
+
+    def wait(self) -> None:
+        """Block until the checkpoint being written (if any) is complete."""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError("Writing checkpoint failed") from error
+
+    def _write(self, step: int, shard: dict, model_state: dict | None) -> None:
+        try:
+            start_time = time.perf_counter()
+            final_dir = self.checkpoint_dir / _step_dir_name(step)
+            tmp_dir = self.checkpoint_dir / (_step_dir_name(step) + _TMP_SUFFIX)
+            tmp_dir.mkdir(parents=True, exist_ok=True)
+
+            torch.save(shard, tmp_dir / f"shard_{self.rank:05d}.pt")
+            if model_state is not None:
+                torch.save(model_state, tmp_dir / "model.pt")
+                with open(tmp_dir / "model_config.json", "w") as f:
+                    json.dump(self.model_config, f, indent=4)
+            (tmp_dir / f"shard_{self.rank:05d}.done").touch()
+
+            if self.rank != 0:
+                return
+            self._wait_for_shards(tmp_dir)
+            for done_marker in tmp_dir.glob("shard_*.done"):
+                done_marker.unlink()
+            with open(tmp_dir / "meta.json", "w") as f:
+                json.dump({"step": step, "world_size": self.world_size}, f, indent=4)
+            if final_dir.exists():
+                shutil.rmtree(final_dir)
+            os.rename(tmp_dir, final_dir)
+            self._rotate()
+            logger.info(f"Saved checkpoint {final_dir} in {time.perf_counter() - start_time:.1f}s")
+        except BaseException as e:
+            self._error = e
+
+    def _wait_for_shards(self, tmp_dir: Path) -> None:
+        deadline = time.monotonic() + self.timeout
+        while len(list(tmp_dir.glob("shard_*.done"))) < self.world_size:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Timed out waiting for all {self.world_size} shards of {tmp_dir}")
+            time.sleep(0.5)
+
+    def _rotate(self) -> None:
+        checkpoints = list_checkpoints(self.checkpoint_dir)
+        for old_checkpoint in checkpoints[: max(len(checkpoints) - self.keep_last, 0)]:
+            logger.info(f"Removing old checkpoint {old_checkpoint}")
+            shutil.rmtree(old_checkpoint, ignore_errors=True)
+
+
+def load_checkpoint(
+    checkpoint_path: str | os.PathLike,
+    model: torch.nn.Module,
+    optimizer: torch.optim.Optimizer | None = None,
+    rank: int = 0,
+    world_size: int = 1,
+) -> tuple[int, dict]:
+    """Restore a checkpoint written by `CheckpointManager`.
+
+    Loads the model weights and, if given, the optimizer state merged from all shards. The RNG
+    state of this rank is restored if the checkpoint was written with the same world size.
+
+    Returns:
+        The step to resume training at, and this rank's `extra_state`.
+    """
+    checkpoint_path = Path(checkpoint_path)
+    with open(checkpoint_path / "meta.json") as f:
+        meta = json.load(f)
+
+    model.load_state_dict(torch.load(checkpoint_path / "model.pt", map_location="cpu"))
+
+    shards = [
+        torch.load(checkpoint_path / f"shard_{r:05d}.pt", map_location="cpu", weights_only=False)
+        for r in range(meta["world_size"])
+    ]
+    if optimizer is not None:
+        optimizer_state = {"state": {}, "param_groups": shards[0]["optimizer"]["param_groups"]}
+        for shard in shards:
+            optimizer_state["state"].update(shard["optimizer"]["state"])
+        optimizer.load_state_dict(optimizer_state)
+
+    if meta["world_size"] == world_size:
+        own_shard = shards[rank]
+        set_rng_state(own_shard["rng"])
+        extra_state = own_shard["extra_state"]
+    else:
+        logger.warning(
+            f"Checkpoint was written with world size {meta['world_size']} but resuming with {world_size}; "
+            "RNG and data sampler state are not restored"
+        )
+        extra_state = {}
+    return meta["step"], extra_state
@@ -1,14 +1,215 @@
 from __future__ import annotations
 
+import os
+import struct
+from dataclasses import dataclass
+from pathlib import Path
+
 import numpy as np
 import numpy.typing as npt
 import torch
 
+# A token shard is a small fixed-size header followed by the raw tokens:
+#
+#   magic     8 bytes  b"CS336TOK"
+#   version   uint32
+#   dtype     8 bytes  numpy dtype string, e.g. "<u2", "<u4"
+#   vocab     int64    vocabulary size, every token is below it
+#   tokens    int64    number of tokens after the header
+#   eos       int64    end-of-text id, -1 if none
+#
+# padded to `SHARD_HEADER_SIZE` bytes, so the tokens can be memory-mapped at a fixed offset. A dataset is a
+# directory of `*.tok` shards, read in name order as one contiguous stream; regenerating part of the data
+# means rewriting only its shards. A headerless file is read as the old single uint16 `.bin`.
+
+SHARD_MAGIC = b"CS336TOK"
+SHARD_VERSION = 1
+SHARD_HEADER_SIZE = 64
+SHARD_SUFFIX = ".tok"
+_HEADER = struct.Struct("<8sI8sqqq")
+
+
+@dataclass(frozen=True)
+class ShardHeader:
+    dtype: np.dtype
+    vocab_size: int | None
+    num_tokens: int
+    eos_id: int | None = None
+
+    def pack(self) -> bytes:
+        packed = _HEADER.pack(
+            SHARD_MAGIC,
+            SHARD_VERSION,
+            self.dtype.str.encode(),
+            -1 if self.vocab_size is None else self.vocab_size,
+            self.num_tokens,
+            -1 if self.eos_id is None else self.eos_id,
+        )
+        return packed.ljust(SHARD_HEADER_SIZE, b"\0")
+
+
+def token_dtype(vocab_size: int) -> np.dtype:
+    """Narrowest unsigned dtype that holds every token id below `vocab_size`."""
+    return np.dtype("<u2") if vocab_size <= 2**16 else np.dtype("<u4")
+
+
+def read_shard_header(path: str | os.PathLike) -> ShardHeader | None:
+    """Header of the shard at `path`, or None for a headerless token file."""
+    with open(path, "rb") as f:
+        raw = f.read(SHARD_HEADER_SIZE)
+    if len(raw) < SHARD_HEADER_SIZE or not raw.startswith(SHARD_MAGIC):
+        return None
+    _, version, dtype, vocab_size, num_tokens, eos_id = _HEADER.unpack_from(raw)
+    if version != SHARD_VERSION:
+        raise ValueError(f"{path}: unsupported shard version {version}")
+    return ShardHeader(
+        dtype=np.dtype(dtype.rstrip(b"\0").decode()),
+        vocab_size=None if vocab_size < 0 else vocab_size,
+        num_tokens=num_tokens,
+        eos_id=None if eos_id < 0 else eos_id,
+    )
+
+
+class ShardWriter:
+    """Streams token arrays into a shard at `path`.
+
+    Tokens go to `path` + ".tmp" and the header is filled in on `close`, which then renames the file into
+    place, so a shard that exists under its name is always complete.
+    """
+
+    def __init__(self, path: str | os.PathLike, vocab_size: int, eos_id: int | None = None):
+        self.path = Path(path)
+        self.vocab_size = vocab_size
+        self.eos_id = eos_id
+        self.dtype = token_dtype(vocab_size)
+        self.num_tokens = 0
+        self.header: ShardHeader | None = None
+        self._tmp = self.path.with_name(self.path.name + ".tmp")
+        self._file = open(self._tmp, "wb")
+        self._file.write(b"\0" * SHARD_HEADER_SIZE)
+
+    def write(self, tokens: npt.ArrayLike) -> None:
+        tokens = np.asarray(tokens)
+        if len(tokens) and (tokens.min() < 0 or tokens.max() >= self.vocab_size):
+            raise ValueError(f"{self.path}: token ids must be in [0, {self.vocab_size})")
+        tokens.astype(self.dtype, copy=False).tofile(self._file)
+        self.num_tokens += len(tokens)
+
+    def close(self) -> ShardHeader:
+        if self.header is None:
+            self.header = ShardHeader(self.dtype, self.vocab_size, self.num_tokens, self.eos_id)
+            self._file.seek(0)
+            self._file.write(self.header.pack())
+            self._file.close()
+            os.replace(self._tmp, self.path)
+        return self.header
+
+    def __enter__(self) -> ShardWriter:
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self._file.close()
+            self._tmp.unlink(missing_ok=True)
+
+
+def write_shard(
+    path: str | os.PathLike, tokens: npt.ArrayLike, vocab_size: int, eos_id: int | None = None
+) -> ShardHeader:
+    with ShardWriter(path, vocab_size, eos_id) as writer:
+        writer.write(tokens)
+    return writer.header
+
+
+def open_shard(path: str | os.PathLike, legacy_dtype: npt.DTypeLike = np.uint16) -> tuple[npt.NDArray, ShardHeader]:
+    """Memory-mapped tokens and header of a shard; a headerless file is read as `legacy_dtype` tokens."""
+    header = read_shard_header(path)
+    if header is None:
+        dtype = np.dtype(legacy_dtype)
+        num_tokens = os.path.getsize(path) // dtype.itemsize
+        header, offset = ShardHeader(dtype, None, num_tokens), 0
+    else:
+        offset = SHARD_HEADER_SIZE
+    if header.num_tokens == 0:
+        return np.empty(0, dtype=header.dtype), header
+    return np.memmap(path, dtype=header.dtype, mode="r", offset=offset, shape=(header.num_tokens,)), header
+
+
+class TokenDataset:
+    """Token shards presented as one contiguous 1-D token array.
+
+    `path` is a directory of `*.tok` shards (in name order), a single shard, or a headerless uint16 `.bin`.
+    Indexing and slicing work like on a memmap of the concatenated tokens; a slice within one shard is a
+    view, a slice across shards is copied. Finding the shard of an index is a binary search over the shard
+    offsets.
+    """
+
+    def __init__(self, path: str | os.PathLike, legacy_dtype: npt.DTypeLike = np.uint16):
+        path = Path(path)
+        files = sorted(path.glob(f"*{SHARD_SUFFIX}")) if path.is_dir() else [path]
+        if not files:
+            raise FileNotFoundError(f"No {SHARD_SUFFIX} shards in {path}")
+        self.path = path
+        self.files = files
+        self.shards, self.headers = zip(*(open_shard(f, legacy_dtype) for f in files))
+        # offsets[i] is the index of the first token of shard i, offsets[-1] the total
+        self.offsets = np.zeros(len(files) + 1, dtype=np.int64)
+        np.cumsum([len(shard) for shard in self.shards], out=self.offsets[1:])
+        self.dtype = np.result_type(*(header.dtype for header in self.headers))
+
+        vocab_sizes = [h.vocab_size for h in self.headers if h.vocab_size is not None]
+        self.vocab_size = max(vocab_sizes) if vocab_sizes else None
+        eos_ids = {h.eos_id for h in self.headers if h.eos_id is not None}
+        if len(eos_ids) > 1:
+            raise ValueError(f"Shards in {path} disagree on the EOS id: {sorted(eos_ids)}")
+        self.eos_id = eos_ids.pop() if eos_ids else None
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def _locate(self, index: int) -> int:
+        return int(np.searchsorted(self.offsets, index, side="right")) - 1
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return self[start:stop][::step]
+            if stop <= start:
+                return np.empty(0, dtype=self.dtype)
+            first, last = self._locate(start), self._locate(stop - 1)
+            if first == last:
+                return self.shards[first][start - self.offsets[first] : stop - self.offsets[first]]
+            pieces = [self.shards[first][start - self.offsets[first] :]]
+            pieces.extend(self.shards[first + 1 : last])
+            pieces.append(self.shards[last][: stop - self.offsets[last]])
+            return np.concatenate(pieces).astype(self.dtype, copy=False)
+
+        index = int(key)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(f"Index {key} out of range for {len(self)} tokens")
+        shard = self._locate(index)
+        return self.shards[shard][index - self.offsets[shard]]
+
+    def __repr__(self) -> str:
+        return f"TokenDataset({str(self.path)!r}, shards={len(self.files)}, tokens={len(self)}, dtype={self.dtype})"
+
 
 def get_batch(
-    dataset: npt.NDArray, batch_size: int, context_length: int, device: str
+    dataset: npt.NDArray | TokenDataset, batch_size: int, context_length: int, device: str
 ) -> tuple[torch.Tensor, torch.Tensor]:
     starting_idxs = torch.randint(len(dataset) - context_length, (batch_size,))
+    return get_batch_at(dataset, starting_idxs, context_length, device)
+
+
+def get_batch_at(
+    dataset: npt.NDArray | TokenDataset, starting_idxs: npt.NDArray | torch.Tensor, context_length: int, device: str
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """Like `get_batch`, but for the windows starting at the given `starting_idxs`."""
     x = torch.stack([
             torch.from_numpy((dataset[i : i + context_length]).astype(np.int64))
             for i in starting_idxs
@@ -26,3 +227,14 @@ def get_batch(
         x = x.to(device)
         y = y.to(device)
     return x, y
+
+
+def get_eval_starting_idxs(dataset_len: int, context_length: int, num_windows: int) -> npt.NDArray:
+    """Deterministic starting indices of `num_windows` evaluation windows spread evenly over the dataset.
+
+    The same dataset and arguments always give the same windows, so evaluation losses are comparable
+    between runs. Windows don't overlap unless there are more of them than fit in the dataset.
+    """
+    max_start = dataset_len - context_length - 1
+    num_windows = min(num_windows, max_start + 1)
+    return np.linspace(0, max_start, num_windows).astype(np.int64)
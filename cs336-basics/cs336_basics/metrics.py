@@ -0,0 +1,118 @@
+from __future__ import annotations
+
+import json
+import os
+import time
+
+import torch
+
+# Peak dense bf16 throughput per device, used for the MFU estimate when `training.peak_flops` is not set
+PEAK_FLOPS_BY_DEVICE_NAME = {
+    "A100": 312e12,
+    "H100": 989e12,
+    "H200": 989e12,
+    "L40S": 362e12,
+    "A10G": 125e12,
+    "RTX 4090": 165e12,
+}
+
+
+def get_peak_flops(device: str) -> float | None:
+    """Best guess of the peak bf16 FLOP/s of `device`, or None if unknown."""
+    if "cuda" not in device or not torch.cuda.is_available():
+        return None
+    device_name = torch.cuda.get_device_name(device)
+    for name, peak_flops in PEAK_FLOPS_BY_DEVICE_NAME.items():
+        if name in device_name:
+            return peak_flops
+    return None
+
+
+def get_flops_per_token(num_params: int, num_layers: int, d_model: int, context_length: int) -> int:
+    """Training FLOPs per token: 6N for the matmuls plus the attention scores (PaLM, appendix B)."""
+    return 6 * num_params + 12 * num_layers * d_model * context_length
+
+
+class TrainingMetrics:
+    """Accumulate per-step training metrics without synchronizing the host with the device.
+
+    Losses and gradient norms are summed into device tensors; `compute` copies them to the
+    host once per logging interval and resets the accumulators.
+
+    Args:
+        device: str
+            Device of the loss and gradient norm tensors.
+        flops_per_token: int
+            Training FLOPs per token, see `get_flops_per_token`.
+        peak_flops: float | None
+            Peak FLOP/s of all devices used for training together. If None, MFU is not reported.
+    """
+
+    def __init__(self, device: str, flops_per_token: int, peak_flops: float | None = None):
+        self.device = device
+        self.flops_per_token = flops_per_token
+        self.peak_flops = peak_flops
+        self._loss_sum = torch.zeros((), device=device, dtype=torch.float32)
+        self._grad_norm_sum = torch.zeros((), device=device, dtype=torch.float32)
+        self._num_grad_norms = 0
+        self._num_steps = 0
+        self._num_tokens = 0
+        self._data_wait_time = 0.0
+        self._excluded_time = 0.0
+        self._start_time = time.perf_counter()
+
+    def update(self, loss: torch.Tensor, num_tokens: int, grad_norm: torch.Tensor | None = None) -> None:
+        """Record one optimizer step. `loss` is the step's mean loss, `num_tokens` all tokens trained on."""
+        self._loss_sum += loss.detach().float()
+        if grad_norm is not None:
+            self._grad_norm_sum += grad_norm.detach().float()
+            self._num_grad_norms += 1
+        self._num_steps += 1
+        self._num_tokens += num_tokens
+
+    def add_data_wait_time(self, seconds: float) -> None:
+        self._data_wait_time += seconds
+
+    def exclude_time(self, seconds: float) -> None:
+        """Leave out time not spent training (e.g., evaluation) from the throughput."""
+        self._excluded_time += seconds
+
+    def compute(self) -> dict[str, float]:
+        """Averages since the last call. This is the only place the host waits on the device."""
+        elapsed = time.perf_counter() - self._start_time - self._excluded_time
+        loss_sum, grad_norm_sum = torch.stack([self._loss_sum, self._grad_norm_sum]).tolist()
+        num_steps = max(self._num_steps, 1)
+        metrics = {
+            "train_loss": loss_sum / num_steps,
+            "tokens_per_sec": self._num_tokens / elapsed,
+            "data_wait_fraction": self._data_wait_time / elapsed,
+            "step_time_sec": elapsed / num_steps,
+        }
+        if self._num_grad_norms:
+            metrics["grad_norm"] = grad_norm_sum / self._num_grad_norms
+        if self.peak_flops:
+            metrics["mfu"] = self.flops_per_token * metrics["tokens_per_sec"] / self.peak_flops
+
+        self._loss_sum.zero_()
+        self._grad_norm_sum.zero_()
+        self._num_grad_norms = 0
+        self._num_steps = 0
+        self._num_tokens = 0
+        self._data_wait_time = 0.0
+        self._excluded_time = 0.0
+        self._start_time = time.perf_counter()
+        return metrics
+
+
+class JSONLMetricsSink:
+    """Append one JSON object per logged step to a local file."""
+
+    def __init__(self, path: str | os.PathLike):
+        self._file = open(path, "a")
+
+    def log(self, metrics: dict, step: int) -> None:
+        self._file.write(json.dumps({"step": step, **metrics}) + "\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        self._file.close()
@@ -4,6 +4,7 @@ Optimized version of 2025 CS336 Basics model code.
 - hand-crafted softmax -> F.softmax
 - hand-crafted silu -> F.silu
 - hand-crafted scaled dot product attention -> F.scaled_dot_product_attention
+- separate q/k/v and w1/w3 projections -> optional fused QKV and SwiGLU gate/up projections
 
 In the trainer:
 - hand-crafted clip_gradient -> torch.nn.utils.clip_grad_norm_
@@ -26,10 +27,15 @@ from einops import einsum, rearrange
 from jaxtyping import Float, Int
 from torch import Tensor
 from torch.nn.attention import SDPBackend, sdpa_kernel
+from torch.utils.checkpoint import checkpoint
 
 
 logger = logging.getLogger(__name__)
 
+# What `TransformerBlock` recomputes in the backward pass instead of keeping activations:
+# the whole block, only the attention sublayer, or only the feed-forward sublayer.
+ACTIVATION_CHECKPOINTING_MODES = ("block", "attn", "ffn")
+
 
 class Linear(nn.Module):
     def __init__(self, d_in: int, d_out: int):
@@ -54,6 +60,18 @@ class Linear(nn.Module):
     def extra_repr(self):
         return f"d_out={self.weight.shape[0]}, d_in={self.weight.shape[1]}"
 
+    @classmethod
+    def fused(cls, d_in: int, d_outs: list[int]) -> Linear:
+        """A single linear layer computing several projections of the same input in one matmul.
+
+        Each `d_out` slice of the weight is initialized as if it were its own `Linear(d_in, d_out)`,
+        so a fused model starts from the same distribution as an unfused one.
+        """
+        layer = cls(d_in, sum(d_outs))
+        with torch.no_grad():
+            layer.weight.copy_(torch.cat([cls(d_in, d_out).weight for d_out in d_outs]))
+        return layer
+
 
 class Embedding(nn.Module):
     def __init__(self, vocab_size: int, d_model: int):
@@ -128,6 +146,12 @@ class BasicsTransformerLM(nn.Module):
             Dimensionality of the feed-forward inner layer (section 3.3).
         rope_theta: float
             The theta value for the RoPE positional encoding.
+        fused_qkv: bool
+            If True, compute the query, key and value projections with a single
+            `(d_model, 3 * d_model)` weight.
+        fused_swiglu: bool
+            If True, compute the SwiGLU gate and up projections with a single
+            `(d_model, 2 * d_ff)` weight.
 
     Returns:
         FloatTensor of shape (batch size, sequence_length, vocab_size) with the
@@ -143,6 +167,8 @@ class BasicsTransformerLM(nn.Module):
         num_heads: int,
         d_ff: int,
         rope_theta: float,
+        fused_qkv: bool = False,
+        fused_swiglu: bool = False,
     ):
         # Store the model configuration for serialization / deserialization
         self.config = {
@@ -162,6 +188,8 @@ class BasicsTransformerLM(nn.Module):
                     num_heads=num_heads,
                     d_ff=d_ff,
                     positional_encoder=self.positional_encoder,
+                    fused_qkv=fused_qkv,
+                    fused_swiglu=fused_swiglu,
                 )
                 for _ in range(num_layers)
             ]
@@ -184,6 +212,26 @@ class BasicsTransformerLM(nn.Module):
 
         return n_params
 
+    def set_activation_checkpointing(self, mode: str | None, every_n_layers: int = 1):
+        """
+        Trade compute for memory by recomputing activations in the backward pass.
+
+        Args:
+            mode: str | None
+                One of `ACTIVATION_CHECKPOINTING_MODES` ("block", "attn" or "ffn"),
+                or None to disable activation checkpointing.
+            every_n_layers: int
+                Only checkpoint every `every_n_layers`-th layer, starting with the first one.
+        """
+        if mode is not None and mode not in ACTIVATION_CHECKPOINTING_MODES:
+            raise ValueError(
+                f"Unknown activation checkpointing mode {mode!r}, expected one of {ACTIVATION_CHECKPOINTING_MODES}"
+            )
+        if every_n_layers < 1:
+            raise ValueError(f"every_n_layers must be positive, got {every_n_layers}")
+        for i, layer in enumerate(self.layers):
+            layer.activation_checkpointing = mode if i % every_n_layers == 0 else None
+
     def forward(self, x: Int[Tensor, " ... sequence_length"]) -> Float[Tensor, " ... sequence_length vocab_size"]:
         """
         Args:
@@ -266,10 +314,17 @@ class BasicsTransformerLM(nn.Module):
         return new_token_ids
 
     @classmethod
-    def from_pretrained(cls, pretrained_model_path: str):
+    def from_pretrained(cls, pretrained_model_path: str, **config_overrides):
+        """Load a saved model.
+
+        `config_overrides` replace entries of the saved `model_config.json`, e.g.
+        `fused_qkv=True` loads a checkpoint saved with separate projections into the
+        fused layout (the attention and SwiGLU modules convert the weights on load).
+        """
         config_path = os.path.join(pretrained_model_path, "model_config.json")
         with open(config_path) as f:
             config = json.load(f)
+        config.update(config_overrides)
         model = cls(**config)
         weights_path = os.path.join(pretrained_model_path, "model.pt")
         state_dict = torch.load(weights_path)
@@ -300,6 +355,10 @@ class TransformerBlock(nn.Module):
             Dimensionality of the feed-forward inner layer (section 3.3).
         positional_encoder: RotaryEmbedding
             The RoPE module to use.
+        fused_qkv: bool
+            Whether the attention sublayer uses a single fused QKV projection.
+        fused_swiglu: bool
+            Whether the feed-forward sublayer uses a single fused gate/up projection.
 
     Returns:
         FloatTensor of shape `(batch_size, sequence_length, d_model)`.
@@ -311,16 +370,21 @@ class TransformerBlock(nn.Module):
         num_heads: int,
         d_ff: int,
         positional_encoder: RotaryEmbedding,
+        fused_qkv: bool = False,
+        fused_swiglu: bool = False,
     ):
         super().__init__()
         self.attn = CausalMultiHeadSelfAttention(
             d_model=d_model,
             num_heads=num_heads,
             positional_encoder=positional_encoder,
+            fused_qkv=fused_qkv,
         )
-        self.ffn = SwiGLU(d_model=d_model, d_ff=d_ff)
+        self.ffn = SwiGLU(d_model=d_model, d_ff=d_ff, fused=fused_swiglu)
         self.ln1 = nn.RMSNorm(d_model)
         self.ln2 = nn.RMSNorm(d_model)
+        # One of `ACTIVATION_CHECKPOINTING_MODES` or None, see `BasicsTransformerLM.set_activation_checkpointing`
+        self.activation_checkpointing: str | None = None
 
     def forward(self, x: torch.Tensor):
         """
@@ -331,27 +395,91 @@ class TransformerBlock(nn.Module):
         Returns:
             FloatTensor of shape `(batch_size, sequence_length, d_model)`.
         """
+        # Nothing to save activations for when no graph is being recorded (e.g., evaluation)
+        mode = self.activation_checkpointing if torch.is_grad_enabled() else None
+        if mode == "block":
+            # Non-reentrant checkpointing is the variant that composes with torch.compile
+            return checkpoint(self._forward, x, use_reentrant=False)
+        return self._forward(x, mode)
+
+    def _forward(self, x: torch.Tensor, mode: str | None = None):
         # NOTE: this is a pre-norm Transformer, and differs from the original
         # description in the paper.
         # Apply the multi-head self-attention sublayer
-        x_attn = self.attn(self.ln1(x))
+        if mode == "attn":
+            x_attn = checkpoint(self._attn_sublayer, x, use_reentrant=False)
+        else:
+            x_attn = self._attn_sublayer(x)
         attn_sublayer_output = x + x_attn
 
         # Apply the feed-forward sublayer
-        x_ffn = self.ffn(self.ln2(attn_sublayer_output))
+        if mode == "ffn":
+            x_ffn = checkpoint(self._ffn_sublayer, attn_sublayer_output, use_reentrant=False)
+        else:
+            x_ffn = self._ffn_sublayer(attn_sublayer_output)
         ffn_sublayer_output = attn_sublayer_output + x_ffn
         return ffn_sublayer_output
 
+    def _attn_sublayer(self, x: torch.Tensor):
+        return self.attn(self.ln1(x))
+
+    def _ffn_sublayer(self, x: torch.Tensor):
+        return self.ffn(self.ln2(x))
+
+
+def _fuse_state_dict(state_dict: dict, prefix: str, unfused_names: list[str], fused_name: str) -> None:
+    """Concatenate `unfused_names` weights in `state_dict` into one `fused_name` weight, in place."""
+    unfused_keys = [f"{prefix}{name}.weight" for name in unfused_names]
+    if all(k in state_dict for k in unfused_keys):
+        state_dict[f"{prefix}{fused_name}.weight"] = torch.cat([state_dict.pop(k) for k in unfused_keys])
+
+
+def _unfuse_state_dict(state_dict: dict, prefix: str, unfused_names: list[str], fused_name: str) -> None:
+    """Split a `fused_name` weight in `state_dict` into equally sized `unfused_names` weights, in place."""
+    fused_key = f"{prefix}{fused_name}.weight"
+    if fused_key in state_dict:
+        chunks = state_dict.pop(fused_key).chunk(len(unfused_names))
+        for name, chunk in zip(unfused_names, chunks):
+            state_dict[f"{prefix}{name}.weight"] = chunk
+
 
 class SwiGLU(nn.Module):
-    def __init__(self, d_model: int, d_ff: int):
+    """SwiGLU feed-forward network.
+
+    Args:
+        d_model: int
+            The dimensionality of the input and output.
+        d_ff: int
+            Dimensionality of the feed-forward inner layer.
+        fused: bool
+            If True, the gate (`w1`) and up (`w3`) projections are stored as a single
+            `w13` weight of shape `(2 * d_ff, d_model)` and computed with one matmul.
+            Checkpoints in either layout can be loaded into either layout.
+    """
+
+    def __init__(self, d_model: int, d_ff: int, fused: bool = False):
         super().__init__()
-        self.w1 = Linear(d_model, d_ff)
+        self.fused = fused
+        if fused:
+            self.w13 = Linear.fused(d_model, [d_ff, d_ff])
+        else:
+            self.w1 = Linear(d_model, d_ff)
+            self.w3 = Linear(d_model, d_ff)
         self.w2 = Linear(d_ff, d_model)
-        self.w3 = Linear(d_model, d_ff)
 
     def forward(self, x):
-        return self.w2(F.silu(self.w1(x)) * self.w3(x))
+        if self.fused:
+            gate, up = self.w13(x).chunk(2, dim=-1)
+        else:
+            gate, up = self.w1(x), self.w3(x)
+        return self.w2(F.silu(gate) * up)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if self.fused:
+            _fuse_state_dict(state_dict, prefix, ["w1", "w3"], "w13")
+        else:
+            _unfuse_state_dict(state_dict, prefix, ["w1", "w3"], "w13")
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
 
 class CausalMultiHeadSelfAttention(nn.Module):
@@ -370,6 +498,10 @@ class CausalMultiHeadSelfAttention(nn.Module):
             evenly divisible by `num_heads`.
         positional_encoder: RotaryEmbedding
             The RoPE module to use.
+        fused_qkv: bool
+            If True, the query, key and value projections are stored as a single
+            `qkv_proj` weight of shape `(3 * d_model, d_model)` and computed with one matmul.
+            Checkpoints in either layout can be loaded into either layout.
 
     Returns:
         Tensor of shape `(batch_size, sequence_length, d_model)`.
@@ -380,6 +512,7 @@ class CausalMultiHeadSelfAttention(nn.Module):
         d_model: int,
         num_heads: int,
         positional_encoder: RotaryEmbedding,
+        fused_qkv: bool = False,
     ):
         super().__init__()
         assert d_model % num_heads == 0
@@ -389,9 +522,15 @@ class CausalMultiHeadSelfAttention(nn.Module):
         self.d_k = d_model // num_heads
         self.d_v = self.d_k
 
-        self.q_proj = Linear(self.d_model, self.num_heads * self.d_k)
-        self.k_proj = Linear(self.d_model, self.num_heads * self.d_k)
-        self.v_proj = Linear(self.d_model, self.num_heads * self.d_v)
+        self.fused_qkv = fused_qkv
+        if fused_qkv:
+            self.qkv_proj = Linear.fused(
+                self.d_model, [self.num_heads * self.d_k, self.num_heads * self.d_k, self.num_heads * self.d_v]
+            )
+        else:
+            self.q_proj = Linear(self.d_model, self.num_heads * self.d_k)
+            self.k_proj = Linear(self.d_model, self.num_heads * self.d_k)
+            self.v_proj = Linear(self.d_model, self.num_heads * self.d_v)
 
         self.output_proj = Linear(self.num_heads * self.d_v, self.d_model)
 
@@ -411,9 +550,12 @@ class CausalMultiHeadSelfAttention(nn.Module):
         *b, sequence_length, d_model = x.size()
         assert d_model == self.d_model
 
-        Q = self.q_proj(x)
-        K = self.k_proj(x)
-        V = self.v_proj(x)
+        if self.fused_qkv:
+            Q, K, V = self.qkv_proj(x).chunk(3, dim=-1)
+        else:
+            Q = self.q_proj(x)
+            K = self.k_proj(x)
+            V = self.v_proj(x)
 
         # Take apart each head from the embedding dimension of Q, K, V to shape (..., num_heads, seq_len, d_k).
         Q, K, V = (
@@ -448,3 +590,10 @@ class CausalMultiHeadSelfAttention(nn.Module):
         # Apply the output projection
         output = self.output_proj(attn_output)
         return output
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        if self.fused_qkv:
+            _fuse_state_dict(state_dict, prefix, ["q_proj", "k_proj", "v_proj"], "qkv_proj")
+        else:
+            _unfuse_state_dict(state_dict, prefix, ["q_proj", "k_proj", "v_proj"], "qkv_proj")
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
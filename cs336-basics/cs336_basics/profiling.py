@@ -0,0 +1,147 @@
+"""
+Profiling for the training loop: `torch.profiler` traces over a window of steps, plus wall times
+of the training phases (data, forward, backward, optimizer, eval) over the whole run.
+
+Works on CPU-only machines; CUDA activity is recorded only when a GPU is available.
+"""
+
+from __future__ import annotations
+
+import contextlib
+import logging
+import time
+from collections import defaultdict
+from pathlib import Path
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+class TrainingProfiler:
+    """Profile the training loop according to a `training.profile` config.
+
+    When `enabled` is False, `phase` and `step` do nothing, so the profiler can stay in the loop.
+
+    Args:
+        output_dir: str | Path
+            Directory for the Chrome traces, operator summaries and the final report.
+        enabled: bool
+            Whether to profile at all.
+        wait: int
+            Steps to skip before profiling (e.g. to get past `torch.compile` warmup).
+        warmup: int
+            Steps the profiler runs without recording, to settle its own overhead.
+        active: int
+            Steps recorded per trace.
+        repeat: int
+            Number of traces to take.
+        record_shapes: bool
+            Record operator input shapes.
+        profile_memory: bool
+            Track tensor memory allocations.
+        with_stack: bool
+            Record Python stacks for operators.
+        synchronize: bool
+            Synchronize CUDA at the end of every phase, so phase wall times include the device work
+            launched in them. This removes the overlap of data loading with compute.
+        row_limit: int
+            Number of operators in each operator summary.
+    """
+
+    def __init__(
+        self,
+        output_dir: str | Path,
+        enabled: bool = False,
+        wait: int = 10,
+        warmup: int = 2,
+        active: int = 5,
+        repeat: int = 1,
+        record_shapes: bool = False,
+        profile_memory: bool = False,
+        with_stack: bool = False,
+        synchronize: bool = True,
+        row_limit: int = 30,
+    ):
+        self.output_dir = Path(output_dir)
+        self.enabled = enabled
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.row_limit = row_limit
+        self.phase_times: dict[str, float] = defaultdict(float)
+        self.phase_counts: dict[str, int] = defaultdict(int)
+        self.num_steps = 0
+        self._profiler = None
+        if not enabled:
+            return
+
+        self.output_dir.mkdir(parents=True, exist_ok=True)
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if torch.cuda.is_available():
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+        self._sort_by = "self_cuda_time_total" if torch.cuda.is_available() else "self_cpu_time_total"
+        self._profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=repeat),
+            on_trace_ready=self._on_trace_ready,
+            record_shapes=record_shapes,
+            profile_memory=profile_memory,
+            with_stack=with_stack,
+        )
+
+    def start(self) -> None:
+        if self._profiler is not None:
+            self._profiler.start()
+
+    def stop(self) -> None:
+        if self._profiler is not None:
+            self._profiler.stop()
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """Time the enclosed code as part of phase `name`, and label it in the trace."""
+        if not self.enabled:
+            yield
+            return
+        start_time = time.perf_counter()
+        with torch.profiler.record_function(name):
+            yield
+            if self.synchronize:
+                torch.cuda.synchronize()
+        self.phase_times[name] += time.perf_counter() - start_time
+        self.phase_counts[name] += 1
+
+    def step(self) -> None:
+        """Mark the end of a training step."""
+        if not self.enabled:
+            return
+        self.num_steps += 1
+        self._profiler.step()
+
+    def _on_trace_ready(self, prof) -> None:
+        trace_path = self.output_dir / f"trace_step_{prof.step_num}.json"
+        prof.export_chrome_trace(str(trace_path))
+        summary_path = self.output_dir / f"operators_step_{prof.step_num}.txt"
+        with open(summary_path, "w") as f:
+            f.write(prof.key_averages().table(sort_by=self._sort_by, row_limit=self.row_limit))
+        logger.info(f"Saved profiler trace to {trace_path} and operator summary to {summary_path}")
+
+    def report(self) -> str | None:
+        """Summarize the phase wall times, write them to `report.txt` and return the summary."""
+        if not self.enabled:
+            return None
+        total_time = sum(self.phase_times.values())
+        lines = [
+            f"Phase wall times over {self.num_steps} steps",
+            f"{'phase':<12}{'total (s)':>12}{'calls':>10}{'per call (ms)':>16}{'share':>9}",
+        ]
+        for name, phase_time in sorted(self.phase_times.items(), key=lambda kv: -kv[1]):
+            count = self.phase_counts[name]
+            lines.append(
+                f"{name:<12}{phase_time:>12.2f}{count:>10}{phase_time / count * 1e3:>16.2f}"
+                f"{phase_time / max(total_time, 1e-9):>9.1%}"
+            )
+        report = "\n".join(lines)
+        with open(self.output_dir / "report.txt", "w") as f:
+            f.write(report + "\n")
+        logger.info("\n" + report)
+        return report
@@ -11,6 +11,7 @@ from omegaconf import MISSING
 
 @dataclass
 class PathsConfig:
+    # a directory of `.tok` token shards, a single shard, or a headerless uint16 `.bin` (see `cs336_basics.data`)
     train_bin: Path = MISSING
     valid_bin: Path = MISSING
     model_output: Path = MISSING
@@ -25,6 +26,26 @@ class ModelConfig:
     num_layers: int = 12
     num_heads: int = 12
     rope_theta: float | None = 10000.0
+    fused_qkv: bool = False
+    fused_swiglu: bool = False
+
+
+@dataclass
+class ProfileConfig:
+    enabled: bool = False
+    # Directory for traces and reports, defaults to `paths.model_output/profile`
+    output_dir: Path | None = None
+    # torch.profiler schedule: skip `wait` steps, then `warmup` unrecorded and `active` recorded steps, `repeat` times
+    wait: int = 10
+    warmup: int = 2
+    active: int = 5
+    repeat: int = 1
+    record_shapes: bool = False
+    profile_memory: bool = False
+    with_stack: bool = False
+    # Synchronize CUDA after each phase so phase wall times include device work
+    synchronize: bool = True
+    row_limit: int = 30
 
 
 @dataclass
@@ -36,6 +57,10 @@ class TrainingConfig:
     train_steps: int = 100_000
     gradient_accumulation_steps: int = 1
     compile: bool = True
+    # Recompute activations in the backward pass to save memory: "block", "attn", "ffn" or None (off)
+    activation_checkpointing: str | None = None
+    # Only checkpoint every k-th TransformerBlock
+    activation_checkpointing_every_n_layers: int = 1
     eval_iterations: int = 1_000
     eval_interval: int = 2_000
     max_grad_norm: float | None = 1.0
@@ -49,7 +74,18 @@ class TrainingConfig:
     wandb_project: str | None = None
     wandb_entity: str | None = None
     log_interval: int = 20
+    # Also append the logged training metrics to `paths.model_output/metrics.jsonl`
+    log_jsonl: bool = True
+    # Peak FLOP/s of one device for the MFU estimate; guessed from the GPU name if None
+    peak_flops: float | None = None
+    profile: ProfileConfig = field(default_factory=ProfileConfig)
     save_checkpoints: bool = False
+    # Steps between checkpoints, defaults to `eval_interval`
+    checkpoint_interval: int | None = None
+    # Number of most recent checkpoints to keep in `paths.model_output/checkpoints`
+    keep_last_checkpoints: int = 3
+    # Resume from the latest checkpoint in `paths.model_output/checkpoints`, if there is one
+    resume: bool = False
 
 @dataclass
 class Config:
@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import logging
+import timeit
+
+import torch
+import typer
+
+from cs336_basics.model import BasicsTransformerLM
+
+logger = logging.getLogger(__name__)
+
+
+def benchmark(
+    vocab_size: int = 50257,
+    context_length: int = 256,
+    d_model: int = 512,
+    d_ff: int = 1344,
+    num_layers: int = 4,
+    num_heads: int = 8,
+    batch_size: int = 4,
+    warmup_steps: int = 2,
+    timed_steps: int = 10,
+    device: str = "cpu",
+    seed: int = 0,
+):
+    """Time forward and forward+backward passes of the unfused and fused projection layouts."""
+    torch.manual_seed(seed)
+    x = torch.randint(vocab_size, (batch_size, context_length), device=device)
+
+    reference_state_dict = None
+    reference_logits = None
+    for fused in (False, True):
+        model = BasicsTransformerLM(
+            vocab_size=vocab_size,
+            context_length=context_length,
+            d_model=d_model,
+            num_layers=num_layers,
+            num_heads=num_heads,
+            d_ff=d_ff,
+            rope_theta=10000.0,
+            fused_qkv=fused,
+            fused_swiglu=fused,
+        ).to(device)
+        # Share the same weights across layouts so the outputs can be compared
+        if reference_state_dict is None:
+            reference_state_dict = model.state_dict()
+        else:
+            model.load_state_dict(dict(reference_state_dict))
+
+        def forward():
+            with torch.no_grad():
+                return model(x)
+
+        def forward_backward():
+            model(x).float().mean().backward()
+            model.zero_grad(set_to_none=True)
+
+        logits = forward()
+        if reference_logits is None:
+            reference_logits = logits
+        max_abs_diff = (logits - reference_logits).abs().max().item()
+
+        for _ in range(warmup_steps):
+            forward_backward()
+        forward_time = timeit.timeit(forward, number=timed_steps) / timed_steps
+        forward_backward_time = timeit.timeit(forward_backward, number=timed_steps) / timed_steps
+        print(
+            f"fused={fused!s:<5} forward: {forward_time * 1e3:8.2f} ms  "
+            f"forward+backward: {forward_backward_time * 1e3:8.2f} ms  "
+            f"max |logits - unfused logits|: {max_abs_diff:.2e}"
+        )
+
+
+if __name__ == "__main__":
+    """
+    Microbenchmark of the fused QKV / SwiGLU projections against the separate projections.
+
+    Usage: uv run python scripts/benchmark_fused_projections.py --device cpu
+    """
+    typer.run(benchmark)
@@ -4,7 +4,7 @@ Train a language model on one or multiple GPUs.
 Default config is `experiment/your_data`, which will train on your GPT-2 tokenized dataset and validate on `tokenized_paloma_c4_100_domains_validation.bin`.
 
 To ready the config for your run, you should:
-1. open the config file at `cs336-basics/configs/experiment/your_data.yaml` and set the `paths.train_bin` attribute to point to the file containing your tokenized training data.
+1. open the config file at `cs336-basics/configs/experiment/your_data.yaml` and set the `paths.train_bin` attribute to point to your tokenized training data: a directory of `.tok` token shards or a single uint16 `.bin` file.
 2. You should also set an appropriate `training.wandb_entity` and `training.wandb_project` attribute for logging.
 
 To run single-GPU training:
@@ -18,6 +18,18 @@ To run multi-GPU training, use `torchrun`. e.g., for single-node, 2 GPU:
 ```
 uv run torchrun --standalone --nproc_per_node=2 scripts/train.py --config-name=experiment/your_data
 ```
+
+To profile a few training steps (also on CPU), e.g.:
+
+```
+uv run python scripts/train.py --config-name=experiment/your_data training.profile.enabled=true training.train_steps=30
+```
+
+To resume a preempted run from its latest checkpoint (requires `training.save_checkpoints=true`):
+
+```
+uv run python scripts/train.py --config-name=experiment/your_data training.resume=true
+```
 """
 
 from __future__ import annotations
@@ -25,12 +37,13 @@ from __future__ import annotations
 import json
 import logging
 import os
+import time
 from pathlib import Path
 
 import hydra
-import numpy as np
 import numpy.typing as npt
 import torch
+import torch.distributed as dist
 import torch.nn.functional as F
 from omegaconf import OmegaConf
 from rich.pretty import pprint as pprint
@@ -40,9 +53,12 @@ from torch.nn.parallel import DistributedDataParallel as DDP
 from tqdm import tqdm, trange
 
 import wandb
-from cs336_basics.data import get_batch
+from cs336_basics.checkpoint import CheckpointManager, latest_checkpoint, load_checkpoint
+from cs336_basics.data import TokenDataset, get_batch, get_batch_at, get_eval_starting_idxs
+from cs336_basics.metrics import JSONLMetricsSink, TrainingMetrics, get_flops_per_token, get_peak_flops
 from cs336_basics.model import BasicsTransformerLM
 from cs336_basics.optimizer import get_cosine_lr
+from cs336_basics.profiling import TrainingProfiler
 from cs336_basics.train_config import Config, register_configs
 
 register_configs()
@@ -64,8 +80,12 @@ def main(cfg: Config) -> None:
     default_cfg = OmegaConf.structured(Config())
     cfg = OmegaConf.merge(default_cfg, cfg_dict)
 
-    train_data = np.memmap(cfg.paths.train_bin, dtype=np.uint16, mode="r")
-    dev_data = np.memmap(cfg.paths.valid_bin, dtype=np.uint16, mode="r")
+    # a directory of token shards or a single (legacy uint16) token file
+    train_data = TokenDataset(cfg.paths.train_bin)
+    dev_data = TokenDataset(cfg.paths.valid_bin)
+    for data in (train_data, dev_data):
+        if data.vocab_size is not None and data.vocab_size > cfg.model.vocab_size:
+            raise ValueError(f"{data.path} has vocab size {data.vocab_size}, the model {cfg.model.vocab_size}")
     model = BasicsTransformerLM(
         vocab_size=cfg.model.vocab_size,
         context_length=cfg.model.context_length,
@@ -74,6 +94,8 @@ def main(cfg: Config) -> None:
         num_heads=cfg.model.num_heads,
         d_ff=cfg.model.d_ff,
         rope_theta=cfg.model.rope_theta,
+        fused_qkv=cfg.model.fused_qkv,
+        fused_swiglu=cfg.model.fused_swiglu,
     )
     pprint(model)
 
@@ -93,19 +115,18 @@ def main(cfg: Config) -> None:
             logger.info("Using DDP")
     else:
         seed = cfg.training.seed
+        ddp_rank = 0
         ddp_world_size = 1
         is_master_process = True
 
+    tokens_per_step = (
+        cfg.training.gradient_accumulation_steps
+        * ddp_world_size
+        * cfg.training.train_batch_size
+        * cfg.model.context_length
+    )
     if is_master_process:
-        logger.info(
-            "Total number of tokens per training step: "
-            + str(
-                cfg.training.gradient_accumulation_steps
-                * ddp_world_size
-                * cfg.training.train_batch_size
-                * cfg.model.context_length
-            )
-        )
+        logger.info("Total number of tokens per training step: " + str(tokens_per_step))
         if cfg.training.wandb_project and cfg.training.wandb_entity:
             wandb.init(
                 # Set the project where this run will be logged
@@ -140,13 +161,39 @@ def main(cfg: Config) -> None:
 
     amp_ctx = torch.amp.autocast(device_type="cuda", dtype=torch_dtype)
 
+    # A fixed set of validation windows, so eval losses are comparable across evaluations and runs.
+    # Every rank evaluates its own share of them.
+    eval_starting_idxs = get_eval_starting_idxs(
+        len(dev_data),
+        context_length=cfg.model.context_length,
+        num_windows=cfg.training.eval_iterations * cfg.training.eval_batch_size,
+    )
+    rank_eval_starting_idxs = eval_starting_idxs[ddp_rank::ddp_world_size]
+
+    if cfg.training.activation_checkpointing is not None:
+        model.set_activation_checkpointing(
+            cfg.training.activation_checkpointing,
+            every_n_layers=cfg.training.activation_checkpointing_every_n_layers,
+        )
+        if is_master_process:
+            logger.info(
+                f"Using {cfg.training.activation_checkpointing} activation checkpointing "
+                f"on every {cfg.training.activation_checkpointing_every_n_layers} layer(s)"
+            )
+
     # Move model to the device
     model = model.to(cfg.training.device)
+    # Keep a handle on the unwrapped model for checkpointing
+    raw_model = model
+    track_peak_memory = "cuda" in cfg.training.device
 
     # compile the model, requires torch 2.0
     if cfg.training.compile:
         model = torch.compile(model)
 
+    # Evaluation needs no gradient synchronization, so it bypasses the DDP wrapper
+    eval_model = model
+
     if is_ddp:
         model = DDP(model, device_ids=[ddp_local_rank])
 
@@ -171,14 +218,82 @@ def main(cfg: Config) -> None:
         fused=True,
     )
 
-    # Get the first batch
-    batch_x, batch_y = get_batch(
-        train_data,
-        batch_size=cfg.training.train_batch_size,
-        context_length=cfg.model.context_length,
+    checkpoint_dir = cfg.paths.model_output / "checkpoints"
+    start_step = 0
+    resume_path = latest_checkpoint(checkpoint_dir) if cfg.training.resume else None
+    if resume_path is not None:
+        start_step, data_state = load_checkpoint(
+            resume_path, raw_model, optimizer, rank=ddp_rank, world_size=ddp_world_size
+        )
+        if is_master_process:
+            logger.info(f"Resuming from {resume_path} at step {start_step}")
+    elif cfg.training.resume and is_master_process:
+        logger.info(f"No checkpoint found in {checkpoint_dir}, starting from scratch")
+
+    checkpoint_manager = None
+    if cfg.training.save_checkpoints:
+        checkpoint_manager = CheckpointManager(
+            checkpoint_dir,
+            model_config=raw_model.config,
+            rank=ddp_rank,
+            world_size=ddp_world_size,
+            keep_last=cfg.training.keep_last_checkpoints,
+        )
+    checkpoint_interval = cfg.training.checkpoint_interval or cfg.training.eval_interval
+
+    peak_flops = cfg.training.peak_flops or get_peak_flops(cfg.training.device)
+    training_metrics = TrainingMetrics(
         device=cfg.training.device,
+        flops_per_token=get_flops_per_token(
+            raw_model.get_num_params(),
+            num_layers=cfg.model.num_layers,
+            d_model=cfg.model.d_model,
+            context_length=cfg.model.context_length,
+        ),
+        peak_flops=peak_flops * ddp_world_size if peak_flops else None,
     )
-    for i in (pbar := trange(cfg.training.train_steps, desc="Training", disable=not is_master_process)):
+    metrics_sink = None
+    if is_master_process and cfg.training.log_jsonl:
+        metrics_sink = JSONLMetricsSink(cfg.paths.model_output / "metrics.jsonl")
+
+    profile_cfg = cfg.training.profile
+    profiler = TrainingProfiler(
+        output_dir=(profile_cfg.output_dir or cfg.paths.model_output / "profile") / f"rank_{ddp_rank}",
+        enabled=profile_cfg.enabled,
+        wait=profile_cfg.wait,
+        warmup=profile_cfg.warmup,
+        active=profile_cfg.active,
+        repeat=profile_cfg.repeat,
+        record_shapes=profile_cfg.record_shapes,
+        profile_memory=profile_cfg.profile_memory,
+        with_stack=profile_cfg.with_stack,
+        synchronize=profile_cfg.synchronize,
+        row_limit=profile_cfg.row_limit,
+    )
+    profiler.start()
+
+    if resume_path is not None and "batch_x" in data_state:
+        # Continue with the batch that was prefetched when the checkpoint was taken
+        batch_x = data_state["batch_x"].to(cfg.training.device)
+        batch_y = data_state["batch_y"].to(cfg.training.device)
+    else:
+        # Get the first batch
+        batch_x, batch_y = get_batch(
+            train_data,
+            batch_size=cfg.training.train_batch_size,
+            context_length=cfg.model.context_length,
+            device=cfg.training.device,
+        )
+    for i in (
+        pbar := trange(
+            start_step,
+            cfg.training.train_steps,
+            initial=start_step,
+            total=cfg.training.train_steps,
+            desc="Training",
+            disable=not is_master_process,
+        )
+    ):
         lr = get_cosine_lr(
             i,
             max_learning_rate=cfg.training.lr,
@@ -189,81 +304,116 @@ def main(cfg: Config) -> None:
         for param_group in optimizer.param_groups:
             param_group["lr"] = lr
 
+        step_loss = torch.zeros((), device=cfg.training.device)
         for micro_step_idx in range(cfg.training.gradient_accumulation_steps):
             if is_ddp:
                 # When using DDP, don't all-reduce gradients until the last step.
                 model.require_backward_grad_sync = micro_step_idx == cfg.training.gradient_accumulation_steps - 1
 
             with amp_ctx:
-                logits = model(batch_x)
+                with profiler.phase("forward"):
+                    logits = model(batch_x)
 
                 # immediately async prefetch next batch while model is doing the forward pass on the GPU
-                next_batch_x, next_batch_y = get_batch(
-                    train_data,
-                    batch_size=cfg.training.train_batch_size,
-                    context_length=cfg.model.context_length,
-                    device=cfg.training.device,
-                )
+                data_start_time = time.perf_counter()
+                with profiler.phase("data"):
+                    next_batch_x, next_batch_y = get_batch(
+                        train_data,
+                        batch_size=cfg.training.train_batch_size,
+                        context_length=cfg.model.context_length,
+                        device=cfg.training.device,
+                    )
+                training_metrics.add_data_wait_time(time.perf_counter() - data_start_time)
 
                 # Calculate the loss with the logits
-                loss = (
-                    F.cross_entropy(logits.view(-1, logits.size(-1)), batch_y.view(-1))
-                    / cfg.training.gradient_accumulation_steps
-                )
+                with profiler.phase("forward"):
+                    loss = (
+                        F.cross_entropy(logits.view(-1, logits.size(-1)), batch_y.view(-1))
+                        / cfg.training.gradient_accumulation_steps
+                    )
 
-            loss.backward()
+            with profiler.phase("backward"):
+                loss.backward()
+            step_loss += loss.detach()
 
             batch_x = next_batch_x
             batch_y = next_batch_y
 
-        if cfg.training.max_grad_norm is not None:
-            torch.nn.utils.clip_grad_norm_(model.parameters(), cfg.training.max_grad_norm)
-
-        optimizer.step()
-        optimizer.zero_grad(set_to_none=True)
-
-        loss_float = loss.item() * cfg.training.gradient_accumulation_steps
-
-        if is_master_process:
-            pbar.set_description(f"Training step {i}, Loss: {loss_float:.4f}")
-            if cfg.training.wandb_project and i % cfg.training.log_interval == 0:
-                wandb.log({"train_loss": loss_float, "lr": lr}, step=i)
-
-        if i != 0 and i % cfg.training.eval_interval == 0 and is_master_process:
-            dev_loss = estimate_dev_loss(
-                model=model,
-                dev_dataset=dev_data,
-                batch_size=cfg.training.eval_batch_size,
-                eval_iters=cfg.training.eval_iterations,
-                device=cfg.training.device,
-                context_length=cfg.model.context_length,
+        with profiler.phase("optimizer"):
+            grad_norm = None
+            if cfg.training.max_grad_norm is not None:
+                grad_norm = torch.nn.utils.clip_grad_norm_(model.parameters(), cfg.training.max_grad_norm)
+
+            optimizer.step()
+            optimizer.zero_grad(set_to_none=True)
+
+        training_metrics.update(step_loss, num_tokens=tokens_per_step, grad_norm=grad_norm)
+
+        # Only wait for the device once per logging interval
+        if i % cfg.training.log_interval == 0:
+            metrics = training_metrics.compute()
+            if track_peak_memory:
+                # Largest peak allocated memory of any step (forward, backward and optimizer) since the last log
+                metrics["peak_memory_gb"] = torch.cuda.max_memory_allocated() / 1024**3
+                torch.cuda.reset_peak_memory_stats()
+            if is_master_process:
+                metrics["lr"] = lr
+                pbar.set_description(
+                    f"Training step {i}, Loss: {metrics['train_loss']:.4f}, "
+                    f"Tokens/sec: {metrics['tokens_per_sec']:.0f}"
+                )
+                if cfg.training.wandb_project:
+                    wandb.log(metrics, step=i)
+                if metrics_sink is not None:
+                    metrics_sink.log(metrics, step=i)
+
+        if i != 0 and i % cfg.training.eval_interval == 0:
+            eval_start_time = time.perf_counter()
+            with profiler.phase("eval"):
+                dev_loss = estimate_dev_loss(
+                    model=eval_model,
+                    dev_dataset=dev_data,
+                    starting_idxs=rank_eval_starting_idxs,
+                    batch_size=cfg.training.eval_batch_size,
+                    device=cfg.training.device,
+                    context_length=cfg.model.context_length,
+                    amp_ctx=amp_ctx,
+                    is_ddp=is_ddp,
+                )
+            if is_master_process:
+                logger.info(f"Estimated validation loss: {dev_loss}")
+                if cfg.training.wandb_project:
+                    wandb.log({"eval_loss": dev_loss}, step=i)
+            training_metrics.exclude_time(time.perf_counter() - eval_start_time)
+
+        if checkpoint_manager is not None and i != 0 and i % checkpoint_interval == 0:
+            # Every rank saves its shard; written in the background while training continues.
+            # The pending batch is part of the data sampler state, so resuming replays the exact run.
+            checkpoint_manager.save(
+                i + 1, raw_model, optimizer, extra_state={"batch_x": batch_x, "batch_y": batch_y}
             )
-            logger.info(f"Estimated validation loss: {dev_loss}")
-            if cfg.training.wandb_project:
-                wandb.log({"eval_loss": dev_loss}, step=i)
-
-            if cfg.training.save_checkpoints:
-                model_weights_output_path = cfg.paths.model_output / f"step_{i:010d}" / "model.pt"
-                model_weights_output_path.parent.mkdir(parents=True, exist_ok=True)
 
-                # Need both config and weights to load the model
-                # Write config:
-                with open(model_weights_output_path.parent / "model_config.json", "w") as f:
-                    json.dump(model_config, f, indent=4)
+        profiler.step()
 
-                # Write weights:
-                torch.save(model.state_dict(), model_weights_output_path)
+    profiler.stop()
+    profiler.report()
+    if checkpoint_manager is not None:
+        checkpoint_manager.wait()
+    if metrics_sink is not None:
+        metrics_sink.close()
 
     # Calculate final estimated dev loss
+    dev_loss = estimate_dev_loss(
+        model=eval_model,
+        dev_dataset=dev_data,
+        starting_idxs=rank_eval_starting_idxs,
+        batch_size=cfg.training.eval_batch_size,
+        device=cfg.training.device,
+        context_length=cfg.model.context_length,
+        amp_ctx=amp_ctx,
+        is_ddp=is_ddp,
+    )
     if is_master_process:
-        dev_loss = estimate_dev_loss(
-            model=model,
-            dev_dataset=dev_data,
-            batch_size=cfg.training.eval_batch_size,
-            eval_iters=cfg.training.eval_iterations,
-            device=cfg.training.device,
-            context_length=cfg.model.context_length,
-        )
         logger.info(f"Final estimated validation loss: {dev_loss}")
         if cfg.training.wandb_project:
             wandb.log({"eval_loss": dev_loss}, step=cfg.training.train_steps)
@@ -277,30 +427,42 @@ def main(cfg: Config) -> None:
         destroy_process_group()
 
 
-@torch.no_grad()
 def estimate_dev_loss(
     model: BasicsTransformerLM,
-    dev_dataset: npt.NDArray,
+    dev_dataset: npt.NDArray | TokenDataset,
+    starting_idxs: npt.NDArray,
     batch_size: int,
-    eval_iters: int,
     device: str,
     context_length: int,
-):
+    amp_ctx,
+    is_ddp: bool = False,
+) -> float:
+    """Mean per-token loss over the validation windows starting at `starting_idxs`.
+
+    Under DDP, each rank passes its own share of the windows. Loss sums and token counts stay
+    on the device and are all-reduced once at the end, so there is a single host sync per evaluation.
+    """
     model.eval()
-    losses = torch.zeros(eval_iters, device=device)
-    for k in tqdm(range(eval_iters)):
-        batch_x, batch_y = get_batch(
-            dev_dataset,
-            batch_size=batch_size,
-            context_length=context_length,
-            device=device,
-        )
-        logits = model(batch_x)
-        loss = F.cross_entropy(logits.view(-1, logits.size(-1)), batch_y.view(-1))
-        losses[k] = loss.item()
+    loss_sum = torch.zeros((), device=device, dtype=torch.float64)
+    num_tokens = torch.zeros((), device=device, dtype=torch.float64)
+    with torch.inference_mode(), amp_ctx:
+        for batch_start in tqdm(range(0, len(starting_idxs), batch_size), disable=is_ddp and dist.get_rank() != 0):
+            batch_x, batch_y = get_batch_at(
+                dev_dataset,
+                starting_idxs[batch_start : batch_start + batch_size],
+                context_length=context_length,
+                device=device,
+            )
+            logits = model(batch_x)
+            loss_sum += F.cross_entropy(logits.view(-1, logits.size(-1)), batch_y.view(-1), reduction="sum")
+            num_tokens += batch_y.numel()
 
+    if is_ddp:
+        totals = torch.stack([loss_sum, num_tokens])
+        dist.all_reduce(totals, op=dist.ReduceOp.SUM)
+        loss_sum, num_tokens = totals
     model.train()
-    return losses.mean()
+    return (loss_sum / num_tokens).item()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,200 @@
+import os
+import time
+import sqlite3
+import argparse
+
+import mmh3
+
+# Persistent cache of `filter_batch` verdicts, keyed by a 128-bit hash of the document text.
+#
+# The same page bodies recur within a crawl and across crawl dumps, so an exact duplicate costs one
+# sqlite lookup instead of three fastText predictions and a Gopher pass. The cache lives in a single
+# sqlite file in WAL mode, which lets every worker of a process pool read and write it concurrently.
+# Each process opens its own connection on first use.
+#
+# A verdict depends on the thresholds, windows and models it was computed with. All of these go into
+# `namespace`, which is hashed together with the text, so changing any of them starts a fresh keyspace.
+# Stale entries age out through the eviction.
+#
+# Eviction: once the cache holds more than `max_entries`, the least recently used entries are deleted
+# down to 90% of it. The check runs every `evict_every` inserts in each process.
+#
+# Lookups are read-only. The `last_used` touches of hits and the hit / miss counters are kept in memory and
+# written in one transaction by `save` every `save_every` lookups, before an eviction and on `stats` / `close`.
+# A process that exits without `save` only loses some recency and counts, never a verdict.
+
+# keys per `UPDATE ... IN (...)`, below sqlite's host parameter limit
+_TOUCH_BATCH = 500
+
+# stage a document stopped at; "kept" passed every filter
+STAGES = ("lang", "quality", "nsfw", "toxic", "kept")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS verdicts (
+    key BLOB PRIMARY KEY,
+    stage INTEGER NOT NULL,
+    lang_score REAL,
+    non_nsfw_score REAL,
+    non_toxic_score REAL,
+    last_used INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS verdicts_last_used ON verdicts (last_used);
+CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+INSERT OR IGNORE INTO counters VALUES ('hits', 0), ('misses', 0);
+"""
+
+
+def normalize_for_key(text: str) -> str:
+    """line endings and surrounding whitespace don't change any verdict"""
+    return text.replace("\r\n", "\n").strip()
+
+
+class ClassifierCache:
+    """sqlite-backed map: document text -> (stage, lang score, non-nsfw score, non-toxic score)
+
+    Args:
+        path: sqlite file, shared by all processes.
+        namespace: everything the verdicts depend on (thresholds, windows, model files).
+        max_entries: size bound, enforced by LRU eviction.
+        evict_every: inserts between two size checks, per process.
+        save_every: lookups between two writes of the `last_used` touches and counters, per process.
+    """
+
+    def __init__(self, path, namespace: str = "", max_entries: int = 50_000_000, evict_every: int = 100_000,
+                 save_every: int = 10_000):
+        self.path = str(path)
+        self.namespace = namespace.encode("utf-8")
+        self.max_entries = max_entries
+        self.evict_every = evict_every
+        self.save_every = save_every
+        # hits / misses of this process since it opened the cache
+        self.hits = 0
+        self.misses = 0
+        self._inserts_since_check = 0
+        # hits not yet touched in `verdicts`, and counts not yet added to `counters`
+        self._touched = set()
+        self._unsaved = {"hits": 0, "misses": 0}
+        self._lookups_since_save = 0
+        self._conn = None
+        self._pid = None
+
+    def __getstate__(self):
+        # sqlite connections can't cross process boundaries; every worker reconnects
+        state = self.__dict__.copy()
+        state["_conn"], state["_pid"] = None, None
+        # the pending writes belong to this process
+        state.update(_touched=set(), _unsaved={"hits": 0, "misses": 0}, _lookups_since_save=0)
+        return state
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SCHEMA)
+            self._pid = os.getpid()
+        return self._conn
+
+    def key(self, text: str) -> bytes:
+        return mmh3.hash_bytes(self.namespace + b"\0" + normalize_for_key(text).encode("utf-8", "surrogatepass"))
+
+    def get_many(self, texts: list[str]) -> list[tuple | None]:
+        """verdict of every text, None where it isn't cached"""
+        if not texts:
+            return []
+        keys = [self.key(text) for text in texts]
+        placeholders = ",".join("?" * len(keys))
+        rows = self.conn.execute(
+            "SELECT key, stage, lang_score, non_nsfw_score, non_toxic_score FROM verdicts "
+            f"WHERE key IN ({placeholders})",
+            keys,
+        ).fetchall()
+        found = {row[0]: (STAGES[row[1]], *row[2:]) for row in rows}
+        verdicts = [found.get(key) for key in keys]
+        n_hits = sum(verdict is not None for verdict in verdicts)
+        self.hits += n_hits
+        self.misses += len(keys) - n_hits
+        self._unsaved["hits"] += n_hits
+        self._unsaved["misses"] += len(keys) - n_hits
+        self._touched.update(found)
+        self._lookups_since_save += len(keys)
+        if self._lookups_since_save >= self.save_every:
+            self.save()
+        return verdicts
+
+    def save(self) -> None:
+        """write the pending `last_used` touches and hit / miss counts, in one transaction"""
+        self._lookups_since_save = 0
+        if not self._touched and not any(self._unsaved.values()):
+            return
+        touched = list(self._touched)
+        now = int(time.time())
+        with self.conn:
+            for batch_start in range(0, len(touched), _TOUCH_BATCH):
+                batch = touched[batch_start:batch_start + _TOUCH_BATCH]
+                self.conn.execute(f"UPDATE verdicts SET last_used = ? WHERE key IN ({','.join('?' * len(batch))})",
+                                  [now, *batch])
+            self.conn.executemany("UPDATE counters SET value = value + ? WHERE name = ?",
+                                  [(value, name) for name, value in self._unsaved.items()])
+        self._touched = set()
+        self._unsaved = {"hits": 0, "misses": 0}
+
+    def put_many(self, texts: list[str], verdicts: list[tuple]) -> None:
+        if not texts:
+            return
+        now = int(time.time())
+        rows = [(self.key(text), STAGES.index(stage), lang, nsfw, toxic, now)
+                for text, (stage, lang, nsfw, toxic) in zip(texts, verdicts)]
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?, ?, ?, ?)", rows)
+        self._inserts_since_check += len(rows)
+        if self._inserts_since_check >= self.evict_every:
+            self._inserts_since_check = 0
+            self.evict()
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT count(*) FROM verdicts").fetchone()[0]
+
+    def evict(self) -> int:
+        """delete least recently used entries down to 90% of `max_entries`; return the number deleted"""
+        # recent hits must not be evicted
+        self.save()
+        n_entries = len(self)
+        if n_entries <= self.max_entries:
+            return 0
+        n_delete = n_entries - int(self.max_entries * 0.9)
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM verdicts WHERE key IN (SELECT key FROM verdicts ORDER BY last_used LIMIT ?)", (n_delete,)
+            )
+        return n_delete
+
+    def stats(self) -> dict:
+        """lifetime counters of the cache file, across all processes and runs (that saved theirs)"""
+        self.save()
+        counters = dict(self.conn.execute("SELECT name, value FROM counters").fetchall())
+        total = counters["hits"] + counters["misses"]
+        return {"entries": len(self), "hits": counters["hits"], "misses": counters["misses"],
+                "hit_rate": counters["hits"] / total if total else 0.0}
+
+    def close(self) -> None:
+        self.save()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Show or trim a classifier verdict cache')
+    parser.add_argument('path', type=str, help='sqlite cache file')
+    parser.add_argument('--max-entries', type=int, default=None, help='Evict down to this size')
+    args = parser.parse_args()
+
+    cache = ClassifierCache(args.path)
+    if args.max_entries is not None:
+        cache.max_entries = args.max_entries
+        print(f"Evicted {cache.evict()} entries")
+    stats = cache.stats()
+    print(f"{stats['entries']} entries, {stats['hits']} hits / {stats['misses']} misses "
+          f"(hit rate {stats['hit_rate']:.1%})")
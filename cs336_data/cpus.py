@@ -0,0 +1,13 @@
+import os
+
+# Default worker counts of the leaderboard stages.
+#
+# `os.sched_getaffinity` respects CPU pinning (taskset, cgroups), but it only exists on Linux; elsewhere
+# (macOS) every CPU of the machine is assumed usable.
+
+
+def available_cpus() -> int:
+    """number of CPUs this process may run on"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
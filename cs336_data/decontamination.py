@@ -0,0 +1,274 @@
+import os
+import json
+import math
+import time
+import argparse
+import concurrent.futures
+from pathlib import Path
+
+import numpy as np
+
+from cs336_data.cpus import available_cpus
+from cs336_data.text_normalization import mix64
+
+# N-gram decontamination of a uint16 token stream (`CC_filtered_tokens.bin`) against eval token files.
+#
+# Two steps:
+#   build   every `ngram`-token window of the eval files (windows containing the document separator are
+#           skipped) is hashed to 64 bits. The index keeps the sorted unique hashes and a Bloom filter of them
+#   scan    the training stream is cut into chunks, one per worker task. Each chunk hashes all its windows
+#           at once, probes the Bloom filter, and confirms the few hits with a binary search in the sorted
+#           hashes, so a Bloom false positive never drops a document. Hits are mapped to documents (spans
+#           ending in the separator) and counted
+#
+# Window hashes are a polynomial fold of the `ngram` token columns of a strided window view followed by
+# the splitmix64 finalizer: `ngram` in-place vectorized passes per chunk, no Python loop over tokens.
+# Every Bloom hit is confirmed exactly, and that binary search is the expensive part, so the defaults (3
+# probes, 0.5% false positives, ~16 bits per eval n-gram) keep confirmations rare. Probe 0 runs on every
+# window and rules out ~83% of them; later probes only run on the survivors.
+#
+# `python -m cs336_data.decontamination scan --action drop` writes the training stream without the
+# documents with at least `--min-hits` overlapping windows; `--action report` only lists them.
+
+TOKEN_DTYPE = np.uint16
+GPT2_EOS = 50256
+BLOOM = "bloom.npy"
+NGRAMS = "ngrams.npy"
+PARAMS = "params.json"
+
+_FOLD = np.uint64(0x100000001B3)
+_SECOND = np.uint64(0x9E3779B97F4A7C15)
+
+
+def open_tokens(path) -> np.ndarray:
+    return np.memmap(path, dtype=TOKEN_DTYPE, mode="r")
+
+
+def ngram_hashes(tokens: np.ndarray, ngram: int, separator: int | None = GPT2_EOS) -> tuple[np.ndarray, np.ndarray]:
+    """64-bit hash of every `ngram`-token window (`len(tokens) - ngram + 1` of them), and whether the window
+    lies inside one document (holds no `separator`)"""
+    tokens = np.asarray(tokens)
+    n_windows = len(tokens) - ngram + 1
+    if n_windows <= 0:
+        return np.zeros(0, dtype=np.uint64), np.zeros(0, dtype=bool)
+    with np.errstate(over="ignore"):
+        # window i is tokens[i:i + ngram]: fold in token i + j for all windows at once, in place
+        h = tokens[:n_windows].astype(np.uint64)
+        for j in range(1, ngram):
+            h *= _FOLD
+            h += tokens[j:j + n_windows]
+        h = mix64(h)
+    if separator is None:
+        return h, np.ones(n_windows, dtype=bool)
+    n_separators = np.concatenate([[0], np.cumsum(tokens == separator)])
+    return h, n_separators[ngram:] == n_separators[:n_windows]
+
+
+class NgramIndex:
+    """Bloom filter over the hashed eval n-grams, backed by their sorted hashes for exact confirmation"""
+
+    def __init__(self, hashes: np.ndarray, bloom: np.ndarray, num_probes: int, ngram: int,
+                 separator: int | None = GPT2_EOS):
+        self.hashes = hashes
+        self.bloom = bloom
+        self.num_probes = num_probes
+        self.ngram = ngram
+        self.separator = separator
+        self._mask = np.uint64(len(bloom) * 8 - 1)
+
+    @classmethod
+    def from_hashes(cls, hashes: np.ndarray, ngram: int, separator: int | None = GPT2_EOS,
+                    false_positive_rate: float = 0.005, num_probes: int = 3) -> "NgramIndex":
+        hashes = np.unique(hashes)
+        n = max(len(hashes), 1)
+        # size for `false_positive_rate` with `num_probes` probes, rounded up to a power of two so a bit
+        # position is a mask
+        n_bits_needed = -num_probes * n / math.log(1 - false_positive_rate ** (1 / num_probes))
+        n_bits = 1 << max(6, math.ceil(math.log2(n_bits_needed)))
+        index = cls(hashes, np.zeros(n_bits // 8, dtype=np.uint8), num_probes, ngram, separator)
+        for bits in index._probes(hashes):
+            np.bitwise_or.at(index.bloom, bits >> np.uint64(3), (1 << (bits & np.uint64(7))).astype(np.uint8))
+        return index
+
+    @classmethod
+    def from_token_files(cls, paths, ngram: int = 13, separator: int | None = GPT2_EOS,
+                         false_positive_rate: float = 0.005, num_probes: int = 3,
+                         chunk_tokens: int = 1 << 26) -> "NgramIndex":
+        hashes = []
+        for path in paths:
+            tokens = open_tokens(path)
+            for start in range(0, len(tokens), chunk_tokens):
+                h, valid = ngram_hashes(tokens[start:start + chunk_tokens + ngram - 1], ngram, separator)
+                hashes.append(np.unique(h[valid]))
+        return cls.from_hashes(np.concatenate(hashes or [np.zeros(0, dtype=np.uint64)]), ngram, separator,
+                               false_positive_rate, num_probes)
+
+    def _probes(self, hashes: np.ndarray):
+        """bit positions of the Bloom probes, by double hashing"""
+        with np.errstate(over="ignore"):
+            step = mix64(hashes ^ _SECOND) | np.uint64(1)
+            for i in range(self.num_probes):
+                yield (hashes + np.uint64(i) * step) & self._mask
+
+    def _is_set(self, bits: np.ndarray) -> np.ndarray:
+        return (self.bloom[bits >> np.uint64(3)] >> (bits & np.uint64(7)).astype(np.uint8)) & 1 == 1
+
+    def contains(self, hashes: np.ndarray) -> np.ndarray:
+        """exact membership of every hash"""
+        hashes = np.asarray(hashes, dtype=np.uint64)
+        # probe 0 is the hash itself and runs on every window; the others only on the survivors
+        candidates = np.flatnonzero(self._is_set(hashes & self._mask))
+        with np.errstate(over="ignore"):
+            for i in range(1, self.num_probes):
+                h = hashes[candidates]
+                candidates = candidates[self._is_set((h + np.uint64(i) * (mix64(h ^ _SECOND) | np.uint64(1)))
+                                                     & self._mask)]
+        found = np.zeros(len(hashes), dtype=bool)
+        if len(candidates) and len(self.hashes):
+            # sorted queries let each binary search start from the previous one
+            candidates = candidates[np.argsort(hashes[candidates])]
+            pos = np.minimum(np.searchsorted(self.hashes, hashes[candidates]), len(self.hashes) - 1)
+            found[candidates] = self.hashes[pos] == hashes[candidates]
+        return found
+
+    def save(self, directory) -> None:
+        directory = Path(directory)
+        directory.mkdir(parents=True, exist_ok=True)
+        np.save(directory / BLOOM, self.bloom)
+        np.save(directory / NGRAMS, self.hashes)
+        with open(directory / PARAMS, "w") as f:
+            json.dump({"ngram": self.ngram, "separator": self.separator, "num_probes": self.num_probes,
+                       "n_ngrams": len(self.hashes), "n_bits": len(self.bloom) * 8}, f, indent=2)
+
+    @classmethod
+    def load(cls, directory) -> "NgramIndex":
+        directory = Path(directory)
+        with open(directory / PARAMS) as f:
+            params = json.load(f)
+        return cls(np.load(directory / NGRAMS, mmap_mode="r"), np.load(directory / BLOOM, mmap_mode="r"),
+                   params["num_probes"], params["ngram"], params["separator"])
+
+
+# ---- scan ----
+
+_INDEX = None
+
+
+def _init_worker(index_dir):
+    global _INDEX
+    _INDEX = NgramIndex.load(index_dir)
+
+
+def _separator_positions(tokens_path, start, end, separator) -> np.ndarray:
+    return np.flatnonzero(open_tokens(tokens_path)[start:end] == separator).astype(np.int64) + start
+
+
+def _scan_chunk(tokens_path, start, end, block_tokens: int = 1 << 16) -> np.ndarray:
+    """start positions of the contaminated windows that start in [start, end)"""
+    tokens = np.asarray(open_tokens(tokens_path)[start:end + _INDEX.ngram - 1])
+    hits = []
+    # blocks small enough for the temporaries of the hashing passes to stay in cache
+    for block in range(0, end - start, block_tokens):
+        hashes, valid = ngram_hashes(tokens[block:block + block_tokens + _INDEX.ngram - 1], _INDEX.ngram,
+                                     _INDEX.separator)
+        candidates = np.flatnonzero(valid)
+        hits.append(candidates[_INDEX.contains(hashes[candidates])] + (start + block))
+    return np.concatenate(hits or [np.zeros(0, dtype=np.int64)]).astype(np.int64)
+
+
+def document_bounds(separators: np.ndarray, n_tokens: int) -> tuple[np.ndarray, np.ndarray]:
+    """[start, end) of every document; a document ends with its separator, the last one may not"""
+    ends = separators + 1
+    if not len(ends) or ends[-1] < n_tokens:
+        ends = np.r_[ends, n_tokens]
+    return np.r_[0, ends[:-1]].astype(np.int64), ends.astype(np.int64)
+
+
+def scan_tokens(tokens_path, index_dir, chunk_tokens: int = 1 << 26, n_workers: int | None = None) -> dict:
+    """Contaminated window counts per document of the token stream
+
+    Returns the document bounds (`starts`, `ends`), `hits` (contaminated windows per document) and `windows`
+    (windows per document).
+    """
+    index = NgramIndex.load(index_dir)
+    n_tokens = len(open_tokens(tokens_path))
+    n_workers = n_workers or available_cpus()
+    chunks = [(start, min(start + chunk_tokens, n_tokens)) for start in range(0, n_tokens, chunk_tokens)]
+    with concurrent.futures.ProcessPoolExecutor(n_workers, initializer=_init_worker,
+                                                initargs=(str(index_dir),)) as executor:
+        if index.separator is None:
+            separators = np.zeros(0, dtype=np.int64)
+        else:
+            separators = np.concatenate([np.zeros(0, dtype=np.int64)] + list(executor.map(
+                _separator_positions, *zip(*[(tokens_path, s, e, index.separator) for s, e in chunks]))))
+        hit_positions = np.concatenate([np.zeros(0, dtype=np.int64)] + list(executor.map(
+            _scan_chunk, *zip(*[(tokens_path, s, e) for s, e in chunks]))))
+    starts, ends = document_bounds(separators, n_tokens)
+    hits = np.bincount(np.searchsorted(ends, hit_positions, side="right"), minlength=len(starts))
+    # windows inside a document, not counting its separator
+    lengths = ends - starts - np.isin(ends - 1, separators).astype(np.int64)
+    return {"starts": starts, "ends": ends, "hits": hits, "windows": np.maximum(lengths - index.ngram + 1, 0)}
+
+
+def write_without_documents(tokens_path, output_path, starts, ends, drop, chunk_tokens: int = 1 << 26) -> int:
+    """copy the token stream without the documents flagged in `drop`; return the number of tokens dropped"""
+    tokens = open_tokens(tokens_path)
+    tmp_path = Path(f"{output_path}.tmp")
+    with open(tmp_path, "wb") as out:
+        position = 0
+        for start, end in zip(starts[drop].tolist(), ends[drop].tolist()):
+            for s in range(position, start, chunk_tokens):
+                np.asarray(tokens[s:min(s + chunk_tokens, start)]).tofile(out)
+            position = end
+        for s in range(position, len(tokens), chunk_tokens):
+            np.asarray(tokens[s:s + chunk_tokens]).tofile(out)
+    os.replace(tmp_path, output_path)
+    return int(np.sum(ends[drop] - starts[drop]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Eval n-gram decontamination of a token stream')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    build = subparsers.add_parser('build', help='Index the n-grams of eval token files')
+    build.add_argument('evals', nargs='+', help='Eval .bin token files')
+    build.add_argument('--index', type=str, default="/home/azureuser/mount/decontamination_index")
+    build.add_argument('--ngram', type=int, default=13)
+    build.add_argument('--false-positive-rate', type=float, default=0.005,
+                       help='Bloom false-positive rate; hits are confirmed exactly, so this only trades memory '
+                            'for the number of confirmations')
+    build.add_argument('--num-probes', type=int, default=3)
+    scan = subparsers.add_parser('scan', help='Find (and drop) training documents overlapping the eval n-grams')
+    scan.add_argument('--input', type=str, default="/home/azureuser/mount/CC_filtered_tokens.bin")
+    scan.add_argument('--index', type=str, default="/home/azureuser/mount/decontamination_index")
+    scan.add_argument('--action', choices=('report', 'drop'), default='report')
+    scan.add_argument('--output', type=str, default="/home/azureuser/mount/CC_filtered_tokens_decontaminated.bin")
+    scan.add_argument('--report', type=str, default="/home/azureuser/mount/decontamination_report.jsonl")
+    scan.add_argument('--min-hits', type=int, default=1, help='Contaminated windows that flag a document')
+    scan.add_argument('--chunk-tokens', type=int, default=1 << 26)
+    scan.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    start_time = time.perf_counter()
+    if args.command == 'build':
+        index = NgramIndex.from_token_files(args.evals, args.ngram, false_positive_rate=args.false_positive_rate,
+                                            num_probes=args.num_probes)
+        index.save(args.index)
+        print(f"{len(index.hashes):,} distinct {args.ngram}-grams, Bloom filter {index.bloom.nbytes / 2**20:.1f} MiB "
+              f"with {index.num_probes} probes, {time.perf_counter() - start_time:.1f}s")
+    else:
+        result = scan_tokens(args.input, args.index, args.chunk_tokens, args.workers)
+        elapsed = time.perf_counter() - start_time
+        flagged = result["hits"] >= args.min_hits
+        n_tokens = int(result["ends"][-1]) if len(result["ends"]) else 0
+        with open(args.report, "w") as f:
+            for doc in np.flatnonzero(flagged).tolist():
+                json.dump({"document": doc, "start": int(result["starts"][doc]), "end": int(result["ends"][doc]),
+                           "hits": int(result["hits"][doc]), "windows": int(result["windows"][doc])}, f)
+                f.write("\n")
+        print(f"Scanned {n_tokens:,} tokens ({2 * n_tokens / 2**20 / elapsed:.0f} MiB/s), "
+              f"{int(flagged.sum()):,} of {len(flagged):,} documents with >= {args.min_hits} eval n-grams "
+              f"(report: {args.report})")
+        if args.action == 'drop':
+            n_dropped = write_without_documents(args.input, args.output, result["starts"], result["ends"], flagged,
+                                                args.chunk_tokens)
+            print(f"Dropped {n_dropped:,} tokens, wrote {args.output}")
@@ -0,0 +1,204 @@
+import os
+import json
+import queue
+import threading
+from pathlib import Path
+
+import numpy as np
+import zstandard
+
+# Compressed document shards: `<name>.jsonl.zst`
+#
+# The shard is a sequence of independent zstd frames, each holding one block of `block_records` JSONL
+# records. Concatenated frames are a valid zstd stream, so `zstdcat shard.jsonl.zst` still gives plain
+# JSONL. A sidecar `<name>.jsonl.zst.idx.npy` stores (byte offset, compressed size, number of records)
+# per block, so a reader can decompress just the blocks holding the records it needs.
+#
+# Plain `.jsonl` files are still readable through the same functions, so downstream stages don't care
+# which format the WET processor wrote.
+
+SHARD_SUFFIX = ".jsonl.zst"
+INDEX_SUFFIX = ".idx.npy"
+
+
+def is_shard(path) -> bool:
+    return str(path).endswith(SHARD_SUFFIX)
+
+
+def document_stem(path) -> str:
+    """file name without `.jsonl` / `.jsonl.zst`"""
+    name = Path(path).name
+    for suffix in (SHARD_SUFFIX, ".jsonl"):
+        if name.endswith(suffix):
+            return name[: -len(suffix)]
+    return name
+
+
+class ShardWriter:
+    """Write records (dicts) to a compressed shard; serialization, compression and I/O run in a background thread
+
+    Records are buffered into blocks of `block_records`, and full blocks are handed to the writer thread
+    through a queue of at most `max_pending_blocks`, so a slow disk blocks `write` instead of growing memory.
+    The shard is written to `<path>.tmp` and renamed on `close`, so an existing shard is always complete.
+    """
+
+    def __init__(self, path, block_records: int = 1024, level: int = 3, max_pending_blocks: int = 8):
+        self.path = Path(path)
+        self.tmp_path = self.path.with_name(self.path.name + ".tmp")
+        self.block_records = block_records
+        self.level = level
+        self._block = []
+        self._queue = queue.Queue(maxsize=max_pending_blocks)
+        self._index = []
+        self._error = None
+        self._file = open(self.tmp_path, "wb")
+        self._thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self._thread.start()
+
+    def _writer_loop(self):
+        compressor = zstandard.ZstdCompressor(level=self.level)
+        offset = 0
+        while (block := self._queue.get()) is not None:
+            if self._error is not None:
+                continue
+            try:
+                data = "".join(json.dumps(record) + "\n" for record in block).encode("utf-8")
+                frame = compressor.compress(data)
+                self._file.write(frame)
+                self._index.append((offset, len(frame), len(block)))
+                offset += len(frame)
+            except Exception as e:
+                self._error = e
+
+    def write(self, record: dict) -> None:
+        self._block.append(record)
+        if len(self._block) >= self.block_records:
+            self._flush_block()
+
+    def _flush_block(self):
+        if self._error is not None:
+            raise self._error
+        if self._block:
+            self._queue.put(self._block)
+            self._block = []
+
+    def close(self) -> None:
+        self._flush_block()
+        self._queue.put(None)
+        self._thread.join()
+        self._file.close()
+        if self._error is not None:
+            self.tmp_path.unlink(missing_ok=True)
+            raise self._error
+        np.save(f"{self.path}{INDEX_SUFFIX}", np.array(self._index, dtype=np.int64).reshape(-1, 3))
+        os.replace(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # don't leave a half-written shard behind
+            self._queue.put(None)
+            self._thread.join()
+            self._file.close()
+            self.tmp_path.unlink(missing_ok=True)
+
+
+class JsonlWriter:
+    """`ShardWriter` interface for plain uncompressed JSONL"""
+
+    def __init__(self, path):
+        self._file = open(path, "w", encoding="utf-8")
+
+    def write(self, record: dict) -> None:
+        json.dump(record, self._file)
+        self._file.write("\n")
+
+    def close(self) -> None:
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def open_writer(path, **kwargs):
+    """`ShardWriter` for `.jsonl.zst` paths, `JsonlWriter` otherwise"""
+    return ShardWriter(path, **kwargs) if is_shard(path) else JsonlWriter(path)
+
+
+class ShardReader:
+    """Block-level random access into a shard written by `ShardWriter`"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        index = np.load(f"{self.path}{INDEX_SUFFIX}")
+        self.offsets, self.sizes = index[:, 0], index[:, 1]
+        # record i lives in block searchsorted(block_starts, i, "right") - 1
+        self.block_starts = np.concatenate([[0], np.cumsum(index[:, 2])])
+        self._decompressor = zstandard.ZstdDecompressor()
+
+    def __len__(self) -> int:
+        return int(self.block_starts[-1])
+
+    @property
+    def n_blocks(self) -> int:
+        return len(self.offsets)
+
+    def read_block(self, block_idx: int, f=None) -> list[dict]:
+        if f is None:
+            with open(self.path, "rb") as f:
+                return self.read_block(block_idx, f)
+        f.seek(int(self.offsets[block_idx]))
+        data = self._decompressor.decompress(f.read(int(self.sizes[block_idx])))
+        return [json.loads(line) for line in data.decode("utf-8").splitlines()]
+
+    def __iter__(self):
+        with open(self.path, "rb") as f:
+            for block_idx in range(self.n_blocks):
+                yield from self.read_block(block_idx, f)
+
+    def read_records(self, record_ids) -> list[dict]:
+        """records at `record_ids` (in the given order); only the blocks holding them are decompressed"""
+        record_ids = np.asarray(record_ids, dtype=np.int64)
+        block_ids = np.searchsorted(self.block_starts, record_ids, side="right") - 1
+        blocks = {}
+        with open(self.path, "rb") as f:
+            for block_idx in np.unique(block_ids):
+                blocks[block_idx] = self.read_block(block_idx, f)
+        return [blocks[b][i - self.block_starts[b]] for i, b in zip(record_ids, block_ids)]
+
+
+def iter_documents(path):
+    """records of a `.jsonl` file or `.jsonl.zst` shard, in order"""
+    if is_shard(path):
+        yield from ShardReader(path)
+    else:
+        with open(path) as f:
+            for line in f:
+                yield json.loads(line)
+
+
+def read_documents(path, record_ids) -> list[dict]:
+    """records at `record_ids` (line numbers for `.jsonl`) of a file or shard"""
+    if is_shard(path):
+        return ShardReader(path).read_records(record_ids)
+    record_ids = list(record_ids)
+    wanted = set(record_ids)
+    found = {}
+    with open(path) as f:
+        for line_id, line in enumerate(f):
+            if line_id in wanted:
+                found[line_id] = json.loads(line)
+    return [found[i] for i in record_ids]
+
+
+def find_document_files(input_dir) -> list[Path]:
+    """`.jsonl` files and `.jsonl.zst` shards in `input_dir`"""
+    input_dir = Path(input_dir)
+    return sorted(list(input_dir.glob("*.jsonl")) + list(input_dir.glob(f"*{SHARD_SUFFIX}")))
@@ -1,60 +1,141 @@
 import os
-import re
 import shutil
-import hashlib
-
-def exact_line_deduplication(input_files, output_dir):
-    # generate hash/dict
-    line_dict = {}
-    file_dict = {}
-
-    for file in input_files:
-        with open(file, 'r') as f:
-            content = f.read()
-        
-        lines = re.split(r'\n+', content)
-
-        for i, line in enumerate(lines):
-            if not line.strip():  # skip empty lines
-                continue
-            hash = hashlib.md5(line.encode()).hexdigest()
-            file_basename = os.path.basename(file)
-            if hash not in line_dict:
-                line_dict[hash] = {
-                    "line_id": [i],
-                    "file_basenames": [file_basename]
-                }
-            else:
-                line_dict[hash]["line_id"].append(i)
-                line_dict[hash]["file_basenames"].append(file_basename)
-
-    # file as key, duplicated line_ids as value
-    for _, v in line_dict.items():
-        line_ids, file_basenames = v.values()
-        if len(set(file_basenames)) == 1:
-            continue
-        for line_id, file_basename in zip(line_ids, file_basenames):
-            if file_basename not in file_dict:
-                file_dict[file_basename] = [line_id]
-            else:
-                file_dict[file_basename].append(line_id)
-
-    # write new file to output dir
-    for file in input_files:
-        file_basename = os.path.basename(file)
-        file_tgt = os.path.join(output_dir, file_basename)
-
-        # if file has no duplication, just make a copy
-        if file_basename not in file_dict:
-            shutil.copy(file, file_tgt)
-            continue
-
-        with open(file, 'r') as f:
-            content = f.read()
-        
-        lines = re.split(r'\n+', content)
-        lines2rm_ids = file_dict[file_basename]
-
-        new_lines = [lines[i] for i in range(len(lines)) if i not in lines2rm_ids]
-        with open(file_tgt, 'w') as f:
-            f.write("\n".join(new_lines))
\ No newline at end of file
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+
+import mmh3
+import numpy as np
+
+from cs336_data.cpus import available_cpus
+
+# Streaming exact line deduplication: a line is removed from every file if it occurs more than once
+# in the whole corpus. Lines are identified by a 64-bit MurmurHash3, so memory is 8 bytes per line
+# and never holds any line text.
+#
+# pass 1: input files are hashed in parallel shards. Each shard spills its hashes into
+#         `2**partition_bits` partition files on disk, by the top bits of the hash.
+# count:  each partition is counted on its own with a NumPy sort (`np.unique`), so peak memory is
+#         one partition, not the corpus. Partitions are disjoint hash ranges, so concatenating the
+#         per-partition duplicates in order gives one sorted array of duplicated hashes.
+# pass 2: files are rewritten in parallel, line by line. Membership is a `np.searchsorted` on the
+#         memory-mapped duplicate array.
+
+LINES_PER_CHUNK = 1 << 16
+
+
+def _line_key(line: bytes) -> bytes:
+    return line.rstrip(b"\r\n")
+
+
+def _hash_lines(lines: list[bytes]) -> np.ndarray:
+    return np.fromiter(
+        (mmh3.hash64(_line_key(line), signed=False)[0] for line in lines), dtype=np.uint64, count=len(lines)
+    )
+
+
+def _read_chunks(file_path):
+    """Yield lists of non-blank lines of `file_path`, `LINES_PER_CHUNK` at a time"""
+    with open(file_path, "rb") as f:
+        while chunk := list(islice(f, LINES_PER_CHUNK)):
+            yield [line for line in chunk if line.strip()]
+
+
+def _partition_ids(hashes: np.ndarray, partition_bits: int) -> np.ndarray:
+    if partition_bits == 0:
+        return np.zeros(len(hashes), dtype=np.int64)
+    return (hashes >> np.uint64(64 - partition_bits)).astype(np.int64)
+
+
+def _spill_shard_hashes(shard_idx: int, file_paths: list, spill_dir: str, partition_bits: int) -> int:
+    """pass 1: hash all lines of a shard of files and append them to per-partition spill files"""
+    num_partitions = 1 << partition_bits
+    spill_files = [open(os.path.join(spill_dir, f"part_{p:05d}_shard_{shard_idx:05d}.u64"), "wb")
+                   for p in range(num_partitions)]
+    num_lines = 0
+    try:
+        for file_path in file_paths:
+            for lines in _read_chunks(file_path):
+                hashes = _hash_lines(lines)
+                num_lines += len(hashes)
+                partitions = _partition_ids(hashes, partition_bits)
+                order = np.argsort(partitions, kind="stable")
+                hashes, partitions = hashes[order], partitions[order]
+                bounds = np.searchsorted(partitions, np.arange(num_partitions + 1))
+                for p in np.unique(partitions):
+                    hashes[bounds[p]:bounds[p + 1]].tofile(spill_files[p])
+    finally:
+        for f in spill_files:
+            f.close()
+    return num_lines
+
+
+def _count_partition(partition_idx: int, spill_dir: str) -> np.ndarray:
+    """count: sorted hashes occurring more than once within one partition"""
+    spill_paths = sorted(p for p in os.listdir(spill_dir) if p.startswith(f"part_{partition_idx:05d}_"))
+    hashes = np.concatenate(
+        [np.fromfile(os.path.join(spill_dir, p), dtype=np.uint64) for p in spill_paths] + [np.empty(0, np.uint64)]
+    )
+    for p in spill_paths:
+        os.remove(os.path.join(spill_dir, p))
+    unique_hashes, counts = np.unique(hashes, return_counts=True)
+    return unique_hashes[counts > 1]
+
+
+def _rewrite_file(file_path, output_path: str, duplicates_path: str) -> int:
+    """pass 2: copy `file_path` to `output_path` without duplicated lines, return the number removed"""
+    duplicates = np.load(duplicates_path, mmap_mode="r")
+    if len(duplicates) == 0:
+        shutil.copy(file_path, output_path)
+        return 0
+
+    num_removed = 0
+    with open(file_path, "rb") as f_in, open(output_path, "wb") as f_out:
+        while chunk := list(islice(f_in, LINES_PER_CHUNK)):
+            hashes = _hash_lines(chunk)
+            idx = np.minimum(np.searchsorted(duplicates, hashes), len(duplicates) - 1)
+            is_duplicate = duplicates[idx] == hashes
+            for line, duplicate in zip(chunk, is_duplicate):
+                # blank lines are never counted, so they're never removed
+                if duplicate and line.strip():
+                    num_removed += 1
+                else:
+                    f_out.write(line)
+    return num_removed
+
+
+def exact_line_deduplication(input_files, output_dir, num_workers=None, partition_bits=6, tmp_dir=None):
+    """Write each input file to `output_dir` without the lines that occur more than once in the corpus.
+
+    Args:
+        input_files: paths of the documents; output files keep their basenames.
+        output_dir: directory for the deduplicated files.
+        num_workers: processes for hashing and rewriting; defaults to the available CPUs.
+        partition_bits: hashes are spilled into `2**partition_bits` partitions, and counting holds one
+            partition in memory at a time. Increase it for corpora with more than ~1e9 lines per 64 partitions.
+        tmp_dir: where to spill hash partitions; defaults to the system temp dir.
+    """
+    input_files = [str(p) for p in input_files]
+    os.makedirs(output_dir, exist_ok=True)
+    num_workers = num_workers or available_cpus()
+    num_shards = min(num_workers * 4, len(input_files)) or 1
+    shards = [input_files[i::num_shards] for i in range(num_shards)]
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as spill_dir, ProcessPoolExecutor(num_workers) as executor:
+        # pass 1
+        list(executor.map(_spill_shard_hashes, range(num_shards), shards,
+                          [spill_dir] * num_shards, [partition_bits] * num_shards))
+
+        # count, one partition per task
+        num_partitions = 1 << partition_bits
+        duplicates = np.concatenate(list(executor.map(_count_partition, range(num_partitions),
+                                                      [spill_dir] * num_partitions)))
+        duplicates_path = os.path.join(spill_dir, "duplicates.npy")
+        np.save(duplicates_path, duplicates)
+        del duplicates
+
+        # pass 2
+        output_paths = [os.path.join(output_dir, os.path.basename(p)) for p in input_files]
+        num_removed = sum(executor.map(_rewrite_file, input_files, output_paths,
+                                       [duplicates_path] * len(input_files)))
+    return num_removed
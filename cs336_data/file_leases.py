@@ -0,0 +1,331 @@
+import os
+import json
+import time
+import uuid
+import socket
+import logging
+import threading
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+
+# Work distribution over a shared filesystem: any number of nodes run the same stage on the same task list,
+# and each task runs once.
+#
+# Layout of a run directory (on the shared mount):
+#   tasks.json           task ids of the run, written by the first node; later nodes must bring the same list
+#   leases/<task>        held lease: JSON with the owning node, claimed with `os.link`, which is atomic on
+#                        NFS and local filesystems alike (O_EXCL isn't on older NFS clients)
+#   done/<task>.json     result of a finished task; written atomically, a task is never run again once here
+#   failures/<task>.json attempts and last error of a task that raised; it stays pending (any node retries it)
+#                        until it has failed `max_attempts` times
+#   manifest.json        all results, written once every task is done
+#   clock/<node>         touched to read the filesystem's clock, so lease expiry doesn't depend on clock skew
+#                        between nodes
+#
+# A node renews (touches) its leases every `heartbeat_seconds` from a background thread. A lease whose file
+# hasn't been touched for `lease_seconds` belongs to a dead node: it is renamed away (only one node can
+# rename it) and the task is claimed again. A task that raises gives its lease back and is retried, by any
+# node, up to `max_attempts` times in total; after that it is reported as failed (`failed`, and in the
+# manifest) but never recorded as done, so a later run with a higher `max_attempts` picks it up again. A
+# broken process pool (e.g. an OOM-killed worker) releases the leases of all tasks in flight and stops the
+# node without counting an attempt against them.
+#
+# `run_distributed` is the driver loop for the leaderboard stages: claim up to `max_in_flight` tasks, run
+# them on the local executor, record them done, repeat until every task of the run is done.
+
+TASKS = "tasks.json"
+MANIFEST = "manifest.json"
+
+
+def _write_atomic(path: Path, data) -> None:
+    tmp = path.with_name(f"{path.name}.{uuid.uuid4().hex}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _task_file(task: str) -> str:
+    # task ids are file names, batch names etc.; keep them flat
+    return task.replace(os.sep, "__")
+
+
+class LeaseQueue:
+    """Tasks of one run, claimed through lease files in `run_dir`
+
+    Args:
+        run_dir: shared directory of the run.
+        tasks: task ids, the same on every node (e.g. sorted input file names).
+        lease_seconds: a lease not renewed for this long is reclaimed by other nodes.
+        heartbeat_seconds: renewal interval, well below `lease_seconds`.
+        node_id: name of this node in the lease files; hostname, pid and a random suffix by default.
+        max_attempts: runs of a task that raises before it is given up on.
+    """
+
+    def __init__(self, run_dir, tasks: list[str], lease_seconds: float = 600, heartbeat_seconds: float | None = None,
+                 node_id: str | None = None, max_attempts: int = 3):
+        self.run_dir = Path(run_dir)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.heartbeat_seconds = heartbeat_seconds or lease_seconds / 5
+        self.node_id = node_id or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        for sub in ("leases", "done", "failures", "clock"):
+            (self.run_dir / sub).mkdir(parents=True, exist_ok=True)
+
+        self.tasks = list(tasks)
+        tasks_path = self.run_dir / TASKS
+        if not tasks_path.exists():
+            tmp = self.run_dir / f"{TASKS}.{self.node_id}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(self.tasks, f)
+            try:
+                os.link(tmp, tasks_path)  # first node wins
+            except FileExistsError:
+                pass
+            os.unlink(tmp)
+        with open(tasks_path) as f:
+            if json.load(f) != self.tasks:
+                raise ValueError(f"{self.run_dir} belongs to a run with a different task list")
+
+        self.held = set()
+        self.lost = set()
+        self._lock = threading.Lock()
+        self._heartbeat = None
+        self._stop = threading.Event()
+
+    # ---- filesystem state ----
+
+    def _lease_path(self, task: str) -> Path:
+        return self.run_dir / "leases" / _task_file(task)
+
+    def _done_path(self, task: str) -> Path:
+        return self.run_dir / "done" / f"{_task_file(task)}.json"
+
+    def _failure_path(self, task: str) -> Path:
+        return self.run_dir / "failures" / f"{_task_file(task)}.json"
+
+    def _failure(self, task: str) -> dict:
+        try:
+            with open(self._failure_path(task)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"attempts": 0, "error": None}
+
+    def fs_now(self) -> float:
+        """current time of the shared filesystem"""
+        clock = self.run_dir / "clock" / self.node_id
+        clock.touch()
+        return clock.stat().st_mtime
+
+    def is_done(self, task: str) -> bool:
+        return self._done_path(task).exists()
+
+    def pending(self) -> list[str]:
+        """tasks that aren't done and haven't used up their attempts"""
+        done = {path.name for path in (self.run_dir / "done").iterdir()}
+        given_up = set(self.failed())
+        return [task for task in self.tasks if f"{_task_file(task)}.json" not in done and task not in given_up]
+
+    def failed(self) -> dict:
+        """task -> last error of every task that isn't done and failed `max_attempts` times"""
+        failed_files = {path.name for path in (self.run_dir / "failures").iterdir()}
+        failed = {}
+        for task in self.tasks:
+            if f"{_task_file(task)}.json" in failed_files and not self.is_done(task):
+                failure = self._failure(task)
+                if failure["attempts"] >= self.max_attempts:
+                    failed[task] = failure["error"]
+        return failed
+
+    def owner(self, task: str) -> str | None:
+        try:
+            with open(self._lease_path(task)) as f:
+                return json.load(f)["node"]
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    # ---- leases ----
+
+    def claim(self, task: str) -> bool:
+        """try to take the lease of `task`; False if it is done or held by a live node"""
+        if self.is_done(task):
+            return False
+        lease = self._lease_path(task)
+        tmp = lease.with_name(f"{lease.name}.{self.node_id}.tmp")
+        with open(tmp, "w") as f:
+            json.dump({"node": self.node_id, "claimed": time.time()}, f)
+        try:
+            for _ in range(2):
+                try:
+                    os.link(tmp, lease)
+                except FileExistsError:
+                    if not self._break_expired(lease):
+                        return False
+                    continue
+                # a node may have finished the task between the done check and the link
+                if self.is_done(task):
+                    lease.unlink(missing_ok=True)
+                    return False
+                with self._lock:
+                    self.held.add(task)
+                self._start_heartbeat()
+                return True
+            return False
+        finally:
+            tmp.unlink(missing_ok=True)
+
+    def _break_expired(self, lease: Path) -> bool:
+        """move an expired lease out of the way; True if the task can be claimed again"""
+        try:
+            age = self.fs_now() - lease.stat().st_mtime
+        except FileNotFoundError:
+            return True
+        if age < self.lease_seconds:
+            return False
+        stale = lease.with_name(f"{lease.name}.{self.node_id}.expired")
+        try:
+            os.rename(lease, stale)  # only one node gets to do this
+        except FileNotFoundError:
+            return True
+        # the lease may have been renewed or re-claimed between the check and the rename: put it back
+        if self.fs_now() - stale.stat().st_mtime < self.lease_seconds:
+            try:
+                os.link(stale, lease)
+                stale.unlink()
+                return False
+            except FileExistsError:
+                pass
+        logging.warning(f"Reclaiming expired lease {lease.name} ({age:.0f}s old)")
+        stale.unlink(missing_ok=True)
+        return True
+
+    def release(self, task: str) -> None:
+        """give a lease back without finishing the task"""
+        with self._lock:
+            self.held.discard(task)
+        if self.owner(task) == self.node_id:
+            self._lease_path(task).unlink(missing_ok=True)
+
+    def complete(self, task: str, result=None) -> None:
+        """record `task` as done with its (JSON-serializable) result and drop the lease"""
+        if not self.is_done(task):
+            _write_atomic(self._done_path(task), {"task": task, "node": self.node_id, "result": result})
+        self.release(task)
+
+    def fail(self, task: str, error: str) -> int:
+        """count a failed attempt of `task` and give its lease back, leaving it pending; returns the attempts"""
+        failure = self._failure(task)  # we hold the lease, no other node writes this
+        attempts = failure["attempts"] + 1
+        _write_atomic(self._failure_path(task), {"task": task, "node": self.node_id, "attempts": attempts,
+                                                 "error": error})
+        self.release(task)
+        return attempts
+
+    def _renew(self) -> None:
+        with self._lock:
+            held = list(self.held)
+        for task in held:
+            if self.owner(task) != self.node_id:
+                # expired and taken over; the work still finishes, `complete` keeps the first result
+                logging.warning(f"Lost the lease of {task}")
+                with self._lock:
+                    self.held.discard(task)
+                    self.lost.add(task)
+                continue
+            try:
+                os.utime(self._lease_path(task))
+            except FileNotFoundError:
+                pass
+
+    def _start_heartbeat(self) -> None:
+        if self._heartbeat is not None and self._heartbeat.is_alive():
+            return
+
+        def beat():
+            while not self._stop.wait(self.heartbeat_seconds):
+                self._renew()
+
+        self._heartbeat = threading.Thread(target=beat, name="lease-heartbeat", daemon=True)
+        self._heartbeat.start()
+
+    def close(self) -> None:
+        self._stop.set()
+        for task in list(self.held):
+            self.release(task)
+
+    # ---- results ----
+
+    def results(self) -> dict:
+        """task -> result of every finished task"""
+        results = {}
+        for task in self.tasks:
+            try:
+                with open(self._done_path(task)) as f:
+                    results[task] = json.load(f)["result"]
+            except FileNotFoundError:
+                pass
+        return results
+
+    def write_manifest(self) -> dict:
+        results = self.results()
+        _write_atomic(self.run_dir / MANIFEST, {"tasks": len(self.tasks), "done": len(results), "results": results,
+                                                "failed": self.failed()})
+        return results
+
+
+def run_distributed(queue: LeaseQueue, tasks: dict, fn, executor: concurrent.futures.Executor | None = None,
+                    max_in_flight: int = 1, poll_seconds: float = 10.0, pbar=None) -> dict:
+    """Run `fn(*tasks[task])` for every task of the run that no node has done, until all of them are done
+
+    With an `executor` up to `max_in_flight` tasks run at once on it, otherwise one at a time in this
+    process. `fn` returns the task's result (JSON-serializable). A task that raises is retried up to the
+    queue's `max_attempts`. Returns the results of all tasks that are done, including those other nodes ran;
+    tasks missing from it failed (see `LeaseQueue.failed`).
+    """
+    in_flight = {}
+    try:
+        while True:
+            claimed_any = False
+            if len(in_flight) < max_in_flight:
+                for task in queue.pending():
+                    if task in in_flight.values() or not queue.claim(task):
+                        continue
+                    claimed_any = True
+                    if executor is None:
+                        _finish(queue, task, lambda: fn(*tasks[task]), pbar)
+                        break
+                    in_flight[executor.submit(fn, *tasks[task])] = task
+                    if len(in_flight) >= max_in_flight:
+                        break
+
+            if in_flight:
+                finished, _ = concurrent.futures.wait(in_flight, timeout=poll_seconds,
+                                                      return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    _finish(queue, in_flight.pop(future), future.result, pbar)
+            elif not claimed_any:
+                if not queue.pending():
+                    break
+                # the rest is leased by other nodes; wait for them to finish or expire
+                time.sleep(poll_seconds)
+    finally:
+        queue.close()
+    for task, error in queue.failed().items():
+        logging.error(f"Task {task} failed {queue.max_attempts} times, last error: {error}")
+    return queue.write_manifest()
+
+
+def _finish(queue: LeaseQueue, task: str, get_result, pbar) -> None:
+    try:
+        result = get_result()
+    except BrokenProcessPool:
+        # not the task's fault (a worker died); every task in flight is released by `close`
+        queue.release(task)
+        raise
+    except Exception as e:
+        attempts = queue.fail(task, repr(e))
+        logging.error(f"Task {task} failed (attempt {attempts}/{queue.max_attempts}): {e}")
+        return
+    queue.complete(task, result)
+    if pbar is not None:
+        pbar.update(1)
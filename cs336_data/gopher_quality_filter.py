@@ -28,4 +28,16 @@ def valid_lines(text):
     return False
 
 def gopher_quality_filter(text, min_word_cnt=50, max_word_cnt=1e5):
-    return valid_words(text, min_word_cnt, max_word_cnt) and valid_lines(text)
\ No newline at end of file
+    return valid_words(text, min_word_cnt, max_word_cnt) and valid_lines(text)
+
+def gopher_statistics(text):
+    """Everything `gopher_quality_filter` thresholds, so the thresholds can be applied later without the text"""
+    words = nltk.word_tokenize(text)
+    n_words = len(words)
+    lines = re.split(r"\n+", text)
+    return {
+        "n_words": n_words,
+        "mean_word_len": sum(len(word) for word in words) / n_words if n_words else 0.0,
+        "alpha_word_frac": sum(1 for word in words if re.search(r'[a-zA-Z]', word)) / n_words if n_words else 0.0,
+        "valid_line_frac": sum(1 for line in lines if not line.endswith("...")) / len(lines),
+    }
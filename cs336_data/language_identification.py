@@ -1,7 +1,9 @@
 import fasttext
+from cs336_data.text_windows import classifier_input
 
-def identify_language(text):
-    text = text.replace("\n", " ")
+def identify_language(text, window=None):
+    # `window`: optional `TextWindow`, the part of the text the classifier sees
+    text = classifier_input(text, window)
     model = fasttext.load_model("/home/azureuser/localfiles/cs336-assignment4-data-mine/cs336_data/lid.176.bin")
     lang, score = model.predict(text)
     lang = lang[0].replace("__label__", "")
@@ -1,34 +1,44 @@
-from cs336_data.minhash_dedpulication import normalize_text
+from cs336_data.cpus import available_cpus
+from cs336_data.document_shards import iter_documents, find_document_files
+from cs336_data.lsh_params import LSHParams
+from cs336_data.minhash_signatures import SIGNATURE_MODES, document_signature
+from cs336_data.file_leases import LeaseQueue, run_distributed
 from concurrent.futures import ProcessPoolExecutor, as_completed
 import os
+import hashlib
+import argparse
 from os import PathLike
 import random
-import json
-import mmh3
 from tqdm import tqdm
 import pickle
 from pathlib import Path
 
-def get_signatures_single_file(file_path, file_idx, seeds, ngrams):
-    """Process a single file's signatures"""
+# version of the signature values, recorded in every batch with the rest of `signature_format`; bump it when
+# the hashing of a mode changes (2: k_perm from signed `mmh3.hash` minima of n-gram strings to splitmix64
+# minima of shingle hashes)
+SIGNATURE_VERSION = 2
+
+def get_signatures_single_file(file_path, file_idx, seeds, ngrams, mode="k_perm", bits=None, source=None):
+    """Process a single file's signatures
+
+    `source` is the `batch_source` of the batch the file belongs to, recorded with every document together
+    with the `signature_format`.
+    mode "k_perm" hashes every n-gram with each seed, "one_perm" fills `len(seeds)` bins seeded by `seeds[0]`.
+    A signature is a numpy array of uint32 values, or of b-bit values (uint8 / uint16) with `bits`.
+    """
     signatures = []
-    with open(file_path) as f:
-        for line_id, line in enumerate(f.readlines()):
-            doc = json.loads(line)['text']
-            doc_words = normalize_text(doc)
-            
-            signature = [float("inf")] * len(seeds)
-            for i in range(len(doc_words) - ngrams):
-                ngram_str = " ".join(doc_words[i:i+ngrams])
-                for j, seed in enumerate(seeds):
-                    hash_val = mmh3.hash(ngram_str, seed)
-                    signature[j] = min(signature[j], hash_val)
-            
-            signatures.append({
-                'jsonl_file': Path(file_path).name,
-                'line_id': line_id,
-                'signatures': signature
-            })
+    sig_format = signature_format(mode, ngrams, seeds, bits)
+    # `.jsonl` or `.jsonl.zst` shard; `line_id` is the record index in either
+    for line_id, record in enumerate(iter_documents(file_path)):
+        signature = document_signature(record['text'], seeds, ngrams, mode, bits)
+
+        signatures.append({
+            'jsonl_file': Path(file_path).name,
+            'line_id': line_id,
+            'signatures': signature,
+            'source': source,
+            'format': sig_format,
+        })
     return file_idx, signatures
 
 def get_signatures_parallel_incremental(
@@ -36,11 +46,15 @@ def get_signatures_parallel_incremental(
     num_hashes: int, 
     ngrams: int,
     output_dir: str,
-    batch_size: int = 100
+    batch_size: int = 100,
+    mode: str = "k_perm",
+    bits: int | None = None,
+    seed: int = 0
 ) -> None:
     """Parallel processing with batch-wise saving"""
-    seeds = [random.randint(0, 2**32-1) for _ in range(num_hashes)]
-    n_workers = len(os.sched_getaffinity(0))
+    seeds = make_seeds(num_hashes, seed)
+    sig_format = signature_format(mode, ngrams, seeds, bits)
+    n_workers = available_cpus()
 
     with ProcessPoolExecutor(max_workers=n_workers) as executor:
         # Process in batches
@@ -48,14 +62,20 @@ def get_signatures_parallel_incremental(
             batch_end = min(batch_start + batch_size, len(input_files))
             batch = input_files[batch_start:batch_end]
             
-            # Check if this batch file already exists
+            # Check if this batch file already exists, for the same input files
             batch_output_file = Path(output_dir) / f"signatures_batch_{batch_start:04d}.pkl"
+            source = batch_source(batch)
             if batch_output_file.exists():
-                print(f"Skipping batch {batch_start}-{batch_end}, file already exists")
-                continue
+                recorded = read_batch_header(batch_output_file)
+                if recorded.get('source') == source and recorded.get('format') == sig_format:
+                    print(f"Skipping batch {batch_start}-{batch_end}, file already exists")
+                    continue
+                print(f"Recomputing batch {batch_start}-{batch_end}, its input files or signature format changed")
             
-            futures = {executor.submit(get_signatures_single_file, fp, batch_start + i, seeds, ngrams): batch_start + i
-                       for i, fp in enumerate(batch)}
+            futures = {
+                executor.submit(get_signatures_single_file, fp, file_idx, seeds, ngrams, mode, bits, source): file_idx
+                for file_idx, fp in enumerate(batch, start=batch_start)
+            }
             
             # Collect results in order
             results = {}
@@ -64,23 +84,126 @@ def get_signatures_parallel_incremental(
                 results[file_idx] = signatures
 
             # Save batch to separate file
-            with open(batch_output_file, 'wb') as batch_f:
-                for idx in sorted(results.keys()):
-                    # results[idx] is a list of dicts, save each document's metadata
-                    for doc_data in results[idx]:
-                        pickle.dump(doc_data, batch_f)
+            save_batch(results, batch_output_file)
             
             print(f"Saved batch {batch_start}-{batch_end} to {batch_output_file}")
 
+
+def batch_source(batch) -> str:
+    """content-derived id of a signature batch: a hash of the resolved paths of its input files
+
+    Batch file names are positions in the input list and repeat in every signature dir; the id names
+    the documents themselves, e.g. for the persistent LSH index of `leaderboard_get_clusters --index`.
+    """
+    paths = "\n".join(str(Path(fp).resolve()) for fp in batch)
+    return hashlib.sha1(paths.encode("utf-8", "surrogatepass")).hexdigest()[:20]
+
+
+def signature_format(mode: str, ngrams: int, seeds: list[int], bits: int | None) -> str:
+    """everything the signature values depend on; signatures of different formats can't be banded together"""
+    seeds_id = hashlib.sha1(",".join(map(str, seeds)).encode("ascii")).hexdigest()[:12]
+    return f"v{SIGNATURE_VERSION}:{mode}:{ngrams}gram:{bits or 32}bit:{len(seeds)}x{seeds_id}"
+
+
+def read_batch_header(batch_file) -> dict:
+    """the first record of a batch file, without its signature; empty for an empty file"""
+    with open(batch_file, 'rb') as f:
+        try:
+            record = pickle.load(f)
+        except EOFError:
+            return {}
+    return {key: value for key, value in record.items() if key != 'signatures'}
+
+
+def read_batch_source(batch_file) -> str | None:
+    """`batch_source` recorded in a batch file; None for an empty file or one written before it was recorded"""
+    return read_batch_header(batch_file).get('source')
+
+
+def read_batch_format(batch_file) -> str | None:
+    """`signature_format` recorded in a batch file; None for one written before it was recorded"""
+    return read_batch_header(batch_file).get('format')
+
+
+def make_seeds(num_hashes: int, seed: int) -> list[int]:
+    """hash seeds; fixed by `seed` so resumed runs and every node of a distributed run hash alike"""
+    rng = random.Random(seed)
+    return [rng.randint(0, 2**32-1) for _ in range(num_hashes)]
+
+
+def save_batch(results: dict, batch_output_file) -> None:
+    # written under a temporary name, so a batch file that exists is complete
+    tmp_file = Path(f"{batch_output_file}.tmp")
+    with open(tmp_file, 'wb') as batch_f:
+        for idx in sorted(results.keys()):
+            # results[idx] is a list of dicts, save each document's metadata
+            for doc_data in results[idx]:
+                pickle.dump(doc_data, batch_f)
+    os.replace(tmp_file, batch_output_file)
+
+
+def signature_batch(batch, batch_start, seeds, ngrams, mode, bits, batch_output_file) -> str:
+    """one batch file, computed in a single process (a task of a distributed run)"""
+    source = batch_source(batch)
+    results = dict(get_signatures_single_file(fp, file_idx, seeds, ngrams, mode, bits, source)
+                   for file_idx, fp in enumerate(batch, start=batch_start))
+    save_batch(results, batch_output_file)
+    return str(batch_output_file)
+
 if __name__ == "__main__":
-    input_dir = Path("/home/azureuser/mount/CC-filtered")
-    input_files = sorted(input_dir.glob("*.jsonl"))
+    parser = argparse.ArgumentParser(description='Compute MinHash signatures of the filtered documents')
+    parser.add_argument('--input-dir', type=str, default="/home/azureuser/mount/CC-filtered")
+    parser.add_argument('--output-dir', type=str, default="/home/azureuser/mount/")
+    parser.add_argument('--lsh-params', type=str, default=None,
+                        help='JSON from `python -m cs336_data.lsh_params --output`; sets the number of hashes')
+    parser.add_argument('--num-hashes', type=int, default=2400, help='Used without --lsh-params')
+    parser.add_argument('--ngrams', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=512)
+    parser.add_argument('--mode', type=str, choices=SIGNATURE_MODES, default="k_perm",
+                        help='k_perm: one hash per n-gram and signature value; one_perm: one hash per n-gram')
+    parser.add_argument('--bits', type=int, default=None,
+                        help='Keep the lowest BITS bits of every value (8 or 16 halve / quarter the storage)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the hash functions')
+    parser.add_argument('--run-dir', type=str, default=None,
+                        help='Shared directory of a multi-node run: every node started with it takes batches by lease')
+    parser.add_argument('--lease-seconds', type=float, default=1800)
+    parser.add_argument('--max-attempts', type=int, default=3,
+                        help='Runs of a failing task (across all nodes) before it is given up on')
+    args = parser.parse_args()
+
+    num_hashes = args.num_hashes
+    if args.lsh_params:
+        params = LSHParams.load(args.lsh_params)
+        num_hashes = params.num_hashes
+        # get_clusters picks the banding up from next to the signatures
+        params.save(Path(args.output_dir) / "lsh_params.json")
+        print(f"Using {params.num_bands} bands x {params.rows} rows from {args.lsh_params}")
+
+    input_files = find_document_files(Path(args.input_dir))
     print(f"Total input files: {len(input_files)}.")
-    # Usage
-    get_signatures_parallel_incremental(
-        input_files, 
-        num_hashes=2400, 
-        ngrams=5,
-        output_dir="/home/azureuser/mount/",
-        batch_size=512
-    )
\ No newline at end of file
+    if args.run_dir:
+        seeds = make_seeds(num_hashes, args.seed)
+        tasks = {}
+        for batch_start in range(0, len(input_files), args.batch_size):
+            batch_output_file = Path(args.output_dir) / f"signatures_batch_{batch_start:04d}.pkl"
+            batch = input_files[batch_start:batch_start + args.batch_size]
+            tasks[batch_output_file.name] = (batch, batch_start, seeds, args.ngrams, args.mode, args.bits,
+                                             batch_output_file)
+        queue = LeaseQueue(args.run_dir, list(tasks), lease_seconds=args.lease_seconds,
+                           max_attempts=args.max_attempts)
+        n_workers = available_cpus()
+        with ProcessPoolExecutor(max_workers=n_workers) as executor, \
+                tqdm(total=len(tasks), desc=f"Node {queue.node_id}") as pbar:
+            results = run_distributed(queue, tasks, signature_batch, executor, max_in_flight=n_workers, pbar=pbar)
+        print(f"{len(results)}/{len(tasks)} batches done in {args.run_dir}")
+    else:
+        get_signatures_parallel_incremental(
+            input_files,
+            num_hashes=num_hashes,
+            ngrams=args.ngrams,
+            output_dir=args.output_dir,
+            batch_size=args.batch_size,
+            mode=args.mode,
+            bits=args.bits,
+            seed=args.seed
+        )
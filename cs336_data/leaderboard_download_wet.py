@@ -1,87 +1,168 @@
 import os
-import requests
+import gzip
+import time
+import random
+import asyncio
 import argparse
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import aiohttp
 from xopen import xopen
 from tqdm import tqdm
 
+from cs336_data.cpus import available_cpus
+
 base_url = "https://data.commoncrawl.org/"
 MOUNT_DIR = Path("/home/azureuser/mount/")
-N_CPU = len(os.sched_getaffinity(0))
-
-def download_file(url, output_dir):
-    filename = Path(url).name
-    output_path = output_dir / filename
-    
-    if output_path.exists():
-        return True, f"Skipped: {filename}"
-    
+N_CPU = available_cpus()
+
+CHUNK_SIZE = 1 << 20
+# transient errors worth retrying; everything else (e.g. 404) fails the file right away
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+
+
+class DownloadError(Exception):
+    pass
+
+
+class RetryableError(DownloadError):
+    pass
+
+
+def verify_gzip(path) -> bool:
+    """Decompress the whole file; a truncated or corrupt WET fails here"""
     try:
-        response = requests.get(url, stream=True)
-        with open(output_path, 'wb') as f:
-            for chunk in response.iter_content(chunk_size=8192):
-                f.write(chunk)
-        return True, f"Downloaded: {filename}"
-    except Exception as e:
-        return False, f"Error {filename}: {e}"
+        with gzip.open(path, "rb") as f:
+            while f.read(CHUNK_SIZE):
+                pass
+        return True
+    except (OSError, EOFError, gzip.BadGzipFile):
+        return False
+
+
+class Downloader:
+    """Download WET files with a pooled aiohttp session and bounded concurrency.
+
+    Each file is written to `<name>.part`, resumed with an HTTP Range request after a failure, verified
+    with a full gzip decompression and only then renamed to its final name. So an existing final file
+    is always complete, and a killed run resumes where it stopped.
+    """
+
+    def __init__(self, output_dir, base_url=base_url, concurrency=N_CPU, max_retries=8,
+                 backoff_base=1.0, backoff_max=60.0, timeout=aiohttp.ClientTimeout(sock_connect=30, sock_read=120)):
+        self.output_dir = Path(output_dir)
+        self.base_url = base_url
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.timeout = timeout
+        self.bytes_downloaded = 0
+
+    async def _fetch(self, session, url, part_path) -> None:
+        """One attempt: append the missing bytes of `url` to `part_path`"""
+        offset = part_path.stat().st_size if part_path.exists() else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+        async with session.get(url, headers=headers) as response:
+            if response.status == 416:
+                # nothing left to fetch: the part file is already complete
+                return
+            if response.status in RETRY_STATUSES:
+                raise RetryableError(f"HTTP {response.status}")
+            if response.status not in (200, 206):
+                raise DownloadError(f"HTTP {response.status}")
+            if response.status == 200:
+                # server ignored the Range header, start over
+                offset = 0
+            expected_size = offset + response.content_length if response.content_length is not None else None
+
+            with open(part_path, "r+b" if offset else "wb") as f:
+                f.seek(offset)
+                f.truncate()
+                async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                    await asyncio.to_thread(f.write, chunk)
+                    self.bytes_downloaded += len(chunk)
+            if expected_size is not None and part_path.stat().st_size != expected_size:
+                raise RetryableError(f"Connection closed at {part_path.stat().st_size}/{expected_size} bytes")
+
+    async def download_file(self, session, path):
+        """Return (success, message) like the old thread-pool downloader"""
+        url = self.base_url + path
+        filename = Path(path).name
+        output_path = self.output_dir / filename
+        part_path = self.output_dir / (filename + ".part")
+
+        if output_path.exists():
+            return True, f"Skipped: {filename}"
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                await self._fetch(session, url, part_path)
+                if not await asyncio.to_thread(verify_gzip, part_path):
+                    part_path.unlink(missing_ok=True)
+                    raise RetryableError("gzip verification failed")
+                os.replace(part_path, output_path)
+                return True, f"Downloaded: {filename}"
+            except (RetryableError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if attempt == self.max_retries:
+                    return False, f"Error {filename} after {attempt + 1} attempts: {e!r}"
+                # exponential backoff with full jitter
+                await asyncio.sleep(random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt)))
+            except DownloadError as e:
+                return False, f"Error {filename}: {e}"
+        return False, f"Error {filename}"
+
+    async def run(self, all_paths, n_wet, pbar=None):
+        """Download paths in order until `n_wet` new files succeeded; return the number of successes"""
+        self.output_dir.mkdir(exist_ok=True, parents=True)
+        path_iter = iter(all_paths)
+        successful_downloads = 0
+        start_time = time.perf_counter()
+
+        async def worker(session):
+            nonlocal successful_downloads
+            while successful_downloads < n_wet:
+                path = next(path_iter, None)
+                if path is None:
+                    return
+                success, message = await self.download_file(session, path)
+                if success and not message.startswith("Skipped"):
+                    successful_downloads += 1
+                    if pbar is not None:
+                        pbar.update(1)
+                if pbar is not None:
+                    elapsed = time.perf_counter() - start_time
+                    pbar.set_postfix(MBps=f"{self.bytes_downloaded / elapsed / 1024**2:.1f}")
+                    if not success:
+                        pbar.write(message)
+
+        connector = aiohttp.TCPConnector(limit=self.concurrency)
+        async with aiohttp.ClientSession(connector=connector, timeout=self.timeout) as session:
+            await asyncio.gather(*(worker(session) for _ in range(self.concurrency)))
+        return successful_downloads
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Download Common Crawl WET files')
     parser.add_argument('--n-wet', type=int, default=100, help='Number of WET files to download')
     parser.add_argument('--output-dir', type=str, default=str(MOUNT_DIR/"CC"), help='Output directory for downloaded files')
+    parser.add_argument('--paths-file', type=str, default='wet.paths.gz', help='Common Crawl wet.paths.gz listing')
+    parser.add_argument('--base-url', type=str, default=base_url)
+    parser.add_argument('--concurrency', type=int, default=N_CPU, help='Simultaneous downloads (pooled connections)')
+    parser.add_argument('--max-retries', type=int, default=8)
     args = parser.parse_args()
-    
-    N_WET = args.n_wet
-    
+
     # Read all paths
-    with xopen('wet.paths.gz', 'rt') as f:
+    with xopen(args.paths_file, 'rt') as f:
         all_paths = [line.strip() for line in f]
 
-    output_dir = Path(args.output_dir)
-    output_dir.mkdir(exist_ok=True, parents=True)
-
-    # Download until we have N_WET successful downloads
-    successful_downloads = 0
-    path_idx = 0
-    futures = {}
-    
-    pbar = tqdm(total=N_WET, desc="Downloading WET files", unit="file")
-
-    with ThreadPoolExecutor(max_workers=N_CPU) as executor:
-        # Submit initial batch
-        while path_idx < len(all_paths) and len(futures) < N_CPU:
-            url = base_url + all_paths[path_idx]
-            future = executor.submit(download_file, url, output_dir)
-            futures[future] = path_idx
-            path_idx += 1
-        
-        # Process results and submit new jobs as needed
-        while successful_downloads < N_WET and futures:
-            done, _ = as_completed(futures), None
-            
-            for future in list(futures.keys()):
-                if future.done():
-                    success, message = future.result()
-                    
-                    if success and not message.startswith("Skipped"):
-                        successful_downloads += 1
-                        pbar.update(1)
-                    
-                    if not success:
-                        pbar.write(message)
-                    
-                    del futures[future]
-                    
-                    # Submit new job if we need more downloads
-                    if successful_downloads < N_WET and path_idx < len(all_paths):
-                        url = base_url + all_paths[path_idx]
-                        new_future = executor.submit(download_file, url, output_dir)
-                        futures[new_future] = path_idx
-                        path_idx += 1
-                    
-                    break
-    
+    downloader = Downloader(args.output_dir, base_url=args.base_url, concurrency=args.concurrency,
+                            max_retries=args.max_retries)
+    pbar = tqdm(total=args.n_wet, desc="Downloading WET files", unit="file")
+    start_time = time.perf_counter()
+    successful_downloads = asyncio.run(downloader.run(all_paths, args.n_wet, pbar))
+    elapsed = time.perf_counter() - start_time
     pbar.close()
-    print(f"\nCompleted: {successful_downloads} successful downloads")
+    print(f"\nCompleted: {successful_downloads} successful downloads, "
+          f"{downloader.bytes_downloaded / 1024**3:.2f} GB in {elapsed:.0f}s "
+          f"({downloader.bytes_downloaded / elapsed / 1024**2:.1f} MB/s)")
@@ -1,4 +1,7 @@
 import os
+import sys
+import hashlib
+import argparse
 from pathlib import Path
 import pickle
 from tqdm import tqdm
@@ -8,6 +11,10 @@ import gc
 from collections import defaultdict
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
+from cs336_data.lsh_params import LSHParams
+from cs336_data.lsh_index import LSHIndex
+from cs336_data.leaderboard_create_signature import read_batch_format, read_batch_source
+
 def get_candidates_single_band(sigs, band_idx, band_size=16):
     """Process a single band to find candidate pairs - optimized with numpy"""
     
@@ -15,10 +22,11 @@ def get_candidates_single_band(sigs, band_idx, band_size=16):
     sig_band = sigs[:, start:start+band_size]
     
     # Use numpy for faster hashing: convert each row to bytes for hashing
+    # (works for any signature dtype, including b-bit uint8 / uint16 signatures)
+    sig_band = np.ascontiguousarray(sig_band)
     buckets = defaultdict(set)
     for idx in range(sig_band.shape[0]):
-        # Convert row to tuple for hashing (much faster than .tolist() on whole array)
-        key = tuple(sig_band[idx])
+        key = sig_band[idx].tobytes()
         buckets[key].add(idx)
     
     # Return only buckets with multiple documents
@@ -97,8 +105,136 @@ def merge_overlapping_sets(sets: list[set[int]], keep_singletons: bool = False)
     return clusters
 
 
+def load_signature_batch(batch_file):
+    """signature matrix and per-document metadata of one `signatures_batch_*.pkl`"""
+    signatures, metadata = [], []
+    with open(batch_file, 'rb') as f:
+        while True:
+            try:
+                doc_data = pickle.load(f)
+            except EOFError:
+                break
+            signatures.append(doc_data['signatures'])
+            metadata.append({'jsonl_file': doc_data.get('jsonl_file'), 'line_id': doc_data.get('line_id')})
+    dtype = signatures[0].dtype if signatures and isinstance(signatures[0], np.ndarray) else np.int32
+    return np.array(signatures, dtype=dtype), metadata
+
+
+def batch_source_of(batch_file) -> str:
+    """id a batch is indexed under: the `batch_source` create_signature recorded in it, or for older batch
+    files a hash of their contents"""
+    source = read_batch_source(batch_file)
+    if source is None:
+        with open(batch_file, 'rb') as f:
+            source = hashlib.sha1(f.read()).hexdigest()[:20]
+    return source
+
+
+def check_signature_format(batch_files) -> str | None:
+    """the `signature_format` shared by all batches; batches of different formats (other seeds, bits or
+    hashing) don't band together, so a mix is an error. None for batches written before formats were recorded
+    """
+    formats = {}
+    for batch_file in batch_files:
+        formats.setdefault(read_batch_format(batch_file), []).append(Path(batch_file).name)
+    if len(formats) > 1:
+        details = "; ".join(f"{sig_format or 'unrecorded (older)'}: {', '.join(names[:3])}"
+                            + (f" and {len(names) - 3} more" if len(names) > 3 else "")
+                            for sig_format, names in formats.items())
+        raise ValueError(f"Signature batches of different formats can't be clustered together ({details}); "
+                         f"recompute the batches with create_signature")
+    return next(iter(formats), None)
+
+
+def update_index(index: LSHIndex, batch_files) -> None:
+    """add the signature batches the index hasn't seen yet; earlier batches are never reloaded
+
+    Batches are recognized by their content-derived source id, not by file name, so the signature dirs of
+    separate runs (dumps) can all be added to one index. Documents of input files that are already indexed
+    (a batch recomputed over a shifted file list) are left out instead of being indexed twice. Every batch
+    must have the index's signature format; an empty index takes the format of its first batch.
+    """
+    metadata_dir = index.path / "metadata"
+    metadata_dir.mkdir(exist_ok=True)
+    indexed_files = None
+    for batch_file in batch_files:
+        source = batch_source_of(batch_file)
+        sig_format = read_batch_format(batch_file)
+        if not len(index):
+            index.signature_format = sig_format
+        elif sig_format != index.signature_format:
+            raise ValueError(f"{batch_file} has signature format {sig_format}, the index at {index.path} holds "
+                             f"{index.signature_format}")
+        if source in index.sources:
+            continue
+        sigs, metadata = load_signature_batch(batch_file)
+        if indexed_files is None:
+            indexed_files = {record['jsonl_file'] for name in index.sources for record in _load_metadata(index, name)}
+        keep = [i for i, record in enumerate(metadata) if record['jsonl_file'] not in indexed_files]
+        if len(keep) < len(metadata):
+            print(f"  {batch_file.name}: skipping {len(metadata) - len(keep)} documents of already indexed files")
+            sigs, metadata = sigs[keep], [metadata[i] for i in keep]
+        # written before the index commits the batch, so a rerun after a crash rewrites it
+        with open(metadata_dir / source, 'wb') as f:
+            pickle.dump(metadata, f)
+        doc_ids = index.add(sigs, source=source)
+        indexed_files.update(record['jsonl_file'] for record in metadata)
+        if len(doc_ids):
+            n_old = int(np.sum(index.cluster_ids(doc_ids) < doc_ids[0]))
+            print(f"  Added {batch_file}: {len(doc_ids)} documents, {n_old} duplicates of earlier batches")
+
+
+def _load_metadata(index: LSHIndex, source: str) -> list[dict]:
+    with open(index.path / "metadata" / source, 'rb') as f:
+        return pickle.load(f)
+
+
+def index_clusters(index: LSHIndex) -> tuple[list[set[int]], list[dict]]:
+    """clusters of every indexed document and the metadata, in document id order"""
+    all_metadata = []
+    for name in index.sources:
+        all_metadata.extend(_load_metadata(index, name))
+    return index.clusters(keep_singletons=True), all_metadata
+
+
 if __name__ == "__main__":
-    sig_dir = "/home/azureuser/mount/"
+    parser = argparse.ArgumentParser(description='Cluster near-duplicate documents from their MinHash signatures')
+    parser.add_argument('--sig-dir', type=str, default="/home/azureuser/mount/")
+    parser.add_argument('--lsh-params', type=str, default=None,
+                        help='Banding JSON; defaults to the lsh_params.json create_signature wrote into --sig-dir')
+    parser.add_argument('--band-size', type=int, default=16, help='Rows per band without LSH params')
+    parser.add_argument('--index', type=str, default=None,
+                        help='Persistent LSH index directory: only signature batches it has not seen are added')
+    args = parser.parse_args()
+    sig_dir = args.sig_dir
+
+    lsh_params_path = Path(args.lsh_params or Path(sig_dir) / "lsh_params.json")
+    params = LSHParams.load(lsh_params_path) if lsh_params_path.exists() else None
+    if params is not None:
+        print(f"Using {params.num_bands} bands x {params.rows} rows from {lsh_params_path}")
+
+    if args.index:
+        batch_files = sorted(Path(sig_dir).glob('signatures_batch_*.pkl'))
+        check_signature_format(batch_files)
+        if params is not None:
+            num_bands, band_size = params.num_bands, params.rows
+        else:
+            with open(batch_files[0], 'rb') as f:
+                band_size = args.band_size
+                num_bands = len(pickle.load(f)['signatures']) // band_size
+        index = LSHIndex(args.index, num_bands, band_size)
+        print(f"\n# Updating LSH index {args.index} ({len(index)} documents, {len(index.sources)} batches)")
+        update_index(index, batch_files)
+        final_clusters, all_metadata = index_clusters(index)
+        output_file = Path(sig_dir) / "duplicate_clusters.pkl"
+        with open(output_file, 'wb') as f:
+            pickle.dump({
+                'clusters': final_clusters,
+                'metadata': all_metadata,
+                'num_documents': len(index),
+            }, f)
+        print(f"Saved {len(final_clusters)} clusters of {len(index)} documents to {output_file}")
+        sys.exit()
     
     # Check cache files
     metadata_cache = Path(sig_dir) / "metadata_cache.pkl"
@@ -118,6 +254,7 @@ if __name__ == "__main__":
     else:
         batch_files = sorted(Path(sig_dir).glob('signatures_batch_*.pkl'))
         print(f"Found {len(batch_files)} files to load")
+        print(f"Signature format: {check_signature_format(batch_files) or 'unrecorded'}")
         
         # Memory-efficient: Load files incrementally without massive temp buffers
         # Signature into numpy array, metadata as list of dicts
@@ -136,8 +273,15 @@ if __name__ == "__main__":
 
         print(f"Total documents: {total_docs}")
 
+        # Signature width and dtype are whatever create_signature used: lists of 32-bit ints,
+        # or numpy arrays of b-bit values
+        with open(batch_files[0], 'rb') as f:
+            first_signature = pickle.load(f)['signatures']
+        num_hashes = len(first_signature)
+        sig_dtype = first_signature.dtype if isinstance(first_signature, np.ndarray) else np.int32
+
         # Pre-allocate arrays (much more memory efficient)
-        sigs = np.empty((total_docs, 2400), dtype=np.int32)
+        sigs = np.empty((total_docs, num_hashes), dtype=sig_dtype)
         all_metadata = []
 
         # Second pass: fill arrays incrementally
@@ -181,8 +325,10 @@ if __name__ == "__main__":
             candidates = pickle.load(f)
         print(f"Loaded {len(candidates)} candidate sets")
     else:
-        band_size = 16
-        num_bands = sigs.shape[1] // band_size
+        band_size = params.rows if params is not None else args.band_size
+        num_bands = params.num_bands if params is not None else sigs.shape[1] // band_size
+        assert num_bands * band_size <= sigs.shape[1], \
+            f"{num_bands} bands x {band_size} rows need more than the {sigs.shape[1]} hashes per signature"
         candidates = []
         
         # Sequential processing with progress bar - faster startup, no thread overhead
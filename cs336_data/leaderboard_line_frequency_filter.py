@@ -0,0 +1,198 @@
+import os
+import re
+import json
+import math
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import mmh3
+import numpy as np
+from tqdm import tqdm
+
+from cs336_data.cpus import available_cpus
+from cs336_data.document_shards import find_document_files, iter_documents, open_writer
+
+# Corpus-scale boilerplate removal (cookie banners, nav menus, footers) in fixed memory.
+#
+# Pass 1: count, for every normalized line, the number of documents containing it with a count-min sketch.
+#         Each worker builds a sketch over its share of the `CC-filtered` files; sketches are merged by adding
+#         their tables.
+# Pass 2: drop every line whose estimated document frequency is above a threshold.
+#
+# A count-min sketch never underestimates: with width w and depth d, an estimate exceeds the true count by
+# more than (e / w) * N with probability at most exp(-d), N being the total number of counted lines.
+# So a line can only be removed wrongly if it is rare but collides with frequent lines in all d rows.
+
+MOUNT_DIR = Path("/home/azureuser/mount/")
+
+
+def normalize_line(line: str) -> str:
+    """lowercase, digits mapped to 0 (dates, counters), whitespace collapsed"""
+    line = re.sub(r"\d", "0", line.lower())
+    return " ".join(line.split())
+
+
+def hash_lines(lines: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    """Two independent 64-bit hashes per line, for double hashing into the sketch rows. The second one is made
+    odd: an even step would map all rows of a line into the even or the odd counters only (and h2 = 0 into the
+    same counter of every row)"""
+    hashes = np.array([mmh3.hash64(line, signed=False) for line in lines], dtype=np.uint64).reshape(-1, 2)
+    return hashes[:, 0], hashes[:, 1] | np.uint64(1)
+
+
+class CountMinSketch:
+    """Count-min sketch with `depth` rows of `2**width_bits` uint32 counters
+
+    Row i of item with hashes (h1, h2) is counter (h1 + i * h2) mod width (Kirsch-Mitzenmacher double hashing).
+    """
+
+    def __init__(self, width_bits: int = 24, depth: int = 4, table: np.ndarray | None = None):
+        self.width = 1 << width_bits
+        self.depth = depth
+        self.table = table if table is not None else np.zeros((depth, self.width), dtype=np.uint32)
+        self.total = 0
+
+    def _indices(self, h1: np.ndarray, h2: np.ndarray) -> np.ndarray:
+        rows = np.arange(self.depth, dtype=np.uint64)[:, None]
+        return (h1[None, :] + rows * h2[None, :]) & np.uint64(self.width - 1)
+
+    def add(self, h1: np.ndarray, h2: np.ndarray) -> None:
+        idx = self._indices(h1, h2)
+        for row in range(self.depth):
+            np.add.at(self.table[row], idx[row], 1)
+        self.total += len(h1)
+
+    def estimate(self, h1: np.ndarray, h2: np.ndarray) -> np.ndarray:
+        idx = self._indices(h1, h2)
+        return np.min(np.take_along_axis(self.table, idx.astype(np.int64), axis=1), axis=0)
+
+    def merge(self, other: "CountMinSketch") -> None:
+        self.table += other.table
+        self.total += other.total
+
+    @property
+    def nbytes(self) -> int:
+        return self.table.nbytes
+
+    def error_bound(self) -> tuple[float, float]:
+        """(additive error, probability of exceeding it) of any single estimate"""
+        return math.e / self.width * self.total, math.exp(-self.depth)
+
+    def save(self, path):
+        """table to `path` (.npy), total count to `path`.json"""
+        np.save(path, self.table)
+        with open(f"{path}.json", "w") as f:
+            json.dump({"total": self.total}, f)
+
+    @classmethod
+    def load(cls, path, mmap: bool = False):
+        """with `mmap`, workers share the table through the page cache instead of each holding a copy"""
+        table = np.load(path, mmap_mode="r" if mmap else None)
+        sketch = cls(width_bits=table.shape[1].bit_length() - 1, depth=table.shape[0], table=table)
+        with open(f"{path}.json") as f:
+            sketch.total = json.load(f)["total"]
+        return sketch
+
+
+def build_sketch_for_shard(file_paths, sketch_path, width_bits, depth):
+    """Pass 1 worker: each distinct normalized line counts once per document"""
+    sketch = CountMinSketch(width_bits, depth)
+    for file_path in file_paths:
+        buffer = []
+        for record in iter_documents(file_path):
+            buffer.extend({normalize_line(line) for line in record["text"].split("\n") if line.strip()})
+            if len(buffer) >= 1 << 18:
+                sketch.add(*hash_lines(buffer))
+                buffer = []
+        if buffer:
+            sketch.add(*hash_lines(buffer))
+    sketch.save(sketch_path)
+    return sketch_path
+
+
+def filter_file(input_path, output_path, sketch_path, threshold):
+    """Pass 2 worker: remove lines with estimated document frequency above `threshold`; the other fields of
+    each record are kept, and the output has the format of the input (`.jsonl` or `.jsonl.zst`)"""
+    sketch = CountMinSketch.load(sketch_path, mmap=True)
+    n_lines, n_removed, n_docs_emptied = 0, 0, 0
+    with open_writer(output_path) as writer:
+        for record in iter_documents(input_path):
+            lines = record["text"].split("\n")
+            counted = [i for i, line in enumerate(lines) if line.strip()]
+            if counted:
+                freqs = sketch.estimate(*hash_lines([normalize_line(lines[i]) for i in counted]))
+                drop = {i for i, freq in zip(counted, freqs) if freq > threshold}
+            else:
+                drop = set()
+            n_lines += len(counted)
+            n_removed += len(drop)
+            text = "\n".join(line for i, line in enumerate(lines) if i not in drop)
+            if not text.strip():
+                n_docs_emptied += 1
+                continue
+            record["text"] = text
+            writer.write(record)
+    return n_lines, n_removed, n_docs_emptied
+
+
+def line_frequency_filter(input_files, output_dir, work_dir, threshold, width_bits=24, depth=4, n_workers=None):
+    n_workers = n_workers or available_cpus()
+    output_dir, work_dir = Path(output_dir), Path(work_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    work_dir.mkdir(parents=True, exist_ok=True)
+
+    # Pass 1: per-worker sketches, merged
+    n_shards = min(n_workers, len(input_files))
+    shards = [input_files[i::n_shards] for i in range(n_shards)]
+    sketch = CountMinSketch(width_bits, depth)
+    print(f"Sketch: {depth} x {sketch.width} counters = {sketch.nbytes / 1024**2:.0f} MB per worker")
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(build_sketch_for_shard, shard, work_dir / f"sketch_shard_{i:04d}.npy",
+                                   width_bits, depth)
+                   for i, shard in enumerate(shards)]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Pass 1: sketching"):
+            shard_path = future.result()
+            sketch.merge(CountMinSketch.load(shard_path))
+            os.remove(shard_path)
+            os.remove(f"{shard_path}.json")
+    sketch_path = work_dir / "line_frequency_sketch.npy"
+    sketch.save(sketch_path)
+
+    error, failure_prob = sketch.error_bound()
+    print(f"Counted {sketch.total} (document, line) pairs")
+    print(f"Estimates exceed the true document frequency by at most {error:.1f} "
+          f"with probability {1 - failure_prob:.3f}")
+    if error >= threshold:
+        print(f"WARNING: error bound {error:.1f} >= threshold {threshold}, increase --width-bits")
+
+    # Pass 2: filter
+    n_lines, n_removed, n_docs_emptied = 0, 0, 0
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(filter_file, fp, output_dir / Path(fp).name, sketch_path, threshold)
+                   for fp in input_files]
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Pass 2: filtering"):
+            file_lines, file_removed, file_emptied = future.result()
+            n_lines += file_lines
+            n_removed += file_removed
+            n_docs_emptied += file_emptied
+    print(f"Removed {n_removed}/{n_lines} lines ({n_removed / max(n_lines, 1):.1%}), "
+          f"{n_docs_emptied} documents became empty and were dropped")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Remove frequent boilerplate lines from filtered CC documents')
+    parser.add_argument('--input-dir', type=str, default=str(MOUNT_DIR/"CC-filtered"))
+    parser.add_argument('--output-dir', type=str, default=str(MOUNT_DIR/"CC-filtered-lines"))
+    parser.add_argument('--work-dir', type=str, default=str(MOUNT_DIR/"line_sketch"),
+                        help='Where sketches are stored')
+    parser.add_argument('--threshold', type=int, default=100,
+                        help='Drop lines found in more than this many documents')
+    parser.add_argument('--width-bits', type=int, default=24, help='Sketch width is 2**width_bits counters')
+    parser.add_argument('--depth', type=int, default=4, help='Number of sketch rows')
+    args = parser.parse_args()
+
+    input_files = find_document_files(args.input_dir)
+    print(f"Total input files: {len(input_files)}.")
+    line_frequency_filter(input_files, args.output_dir, args.work_dir, args.threshold,
+                          width_bits=args.width_bits, depth=args.depth)
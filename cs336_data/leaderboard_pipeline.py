@@ -0,0 +1,159 @@
+import time
+import shutil
+import asyncio
+import logging
+import argparse
+import concurrent.futures
+from pathlib import Path
+
+from xopen import xopen
+from tqdm import tqdm
+
+from cs336_data.leaderboard_download_wet import Downloader, base_url, MOUNT_DIR, N_CPU
+from cs336_data.leaderboard_process_wet import process_single_wet_file, OUTPUT_SUFFIX
+
+# Download -> process pipelining: every WET file goes to the filter process pool as soon as its
+# download is verified, so the network and the CPUs are busy at the same time and the wall-clock time
+# approaches max(download, process) instead of their sum.
+#
+# Backpressure: new downloads wait while the raw WET files that are downloaded but not yet processed
+# take more than `max_pending_bytes`, or while the disk has less than `min_free_bytes` free.
+
+
+class PipelinedDownloader(Downloader):
+    """`Downloader` that hands each finished WET file to `process_fn` (`process_single_wet_file`) on `executor`
+
+    A WET file whose filtered output already exists is neither downloaded nor counted towards `n_wet`.
+    """
+
+    def __init__(self, output_dir, filtered_dir, executor, max_pending_bytes, min_free_bytes=0,
+                 delete_raw=False, output_suffix=OUTPUT_SUFFIX, process_fn=process_single_wet_file, **kwargs):
+        super().__init__(output_dir, **kwargs)
+        self.filtered_dir = Path(filtered_dir)
+        self.executor = executor
+        self.process_fn = process_fn
+        self.max_pending_bytes = max_pending_bytes
+        self.min_free_bytes = min_free_bytes
+        self.delete_raw = delete_raw
+        self.output_suffix = output_suffix
+        self.pending_bytes = 0
+        self.n_processed = 0
+        self.n_failed = 0
+        self.process_pbar = None
+        self._tasks = set()
+        self._budget = None
+
+    def _within_budget(self) -> bool:
+        if self.pending_bytes > self.max_pending_bytes:
+            return False
+        return shutil.disk_usage(self.output_dir).free >= self.min_free_bytes
+
+    def _output_path(self, filename: str) -> Path:
+        return self.filtered_dir / filename.replace(".warc.wet.gz", self.output_suffix)
+
+    async def download_file(self, session, path):
+        filename = Path(path).name
+        if self._output_path(filename).exists():
+            # processed by an earlier run; with --delete-raw its raw file is gone on purpose
+            return True, f"Skipped: {filename} (already filtered)"
+        if self._budget is None:
+            self._budget = asyncio.Condition()
+        async with self._budget:
+            # a processed file frees its budget; re-check the disk every few seconds regardless
+            while not self._within_budget():
+                try:
+                    await asyncio.wait_for(self._budget.wait(), timeout=5)
+                except asyncio.TimeoutError:
+                    pass
+
+        success, message = await super().download_file(session, path)
+        if success:
+            self._schedule(self.output_dir / Path(path).name)
+        return success, message
+
+    def _schedule(self, wet_filepath: Path):
+        output_filepath = self._output_path(wet_filepath.name)
+        if output_filepath.exists():
+            # processed by an earlier run
+            return
+        size = wet_filepath.stat().st_size
+        self.pending_bytes += size
+        future = asyncio.get_running_loop().run_in_executor(
+            self.executor, self.process_fn, str(wet_filepath), str(output_filepath)
+        )
+        task = asyncio.ensure_future(self._finish(future, wet_filepath, size))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _finish(self, future, wet_filepath: Path, size: int):
+        output_file = await future
+        if output_file is None:
+            # process_single_wet_file already logged the error; keep the raw file for a rerun
+            self.n_failed += 1
+        else:
+            self.n_processed += 1
+            if self.delete_raw:
+                wet_filepath.unlink(missing_ok=True)
+        if self.process_pbar is not None:
+            self.process_pbar.update(1)
+        async with self._budget:
+            self.pending_bytes -= size
+            self._budget.notify_all()
+
+    async def run(self, all_paths, n_wet, pbar=None):
+        self.filtered_dir.mkdir(parents=True, exist_ok=True)
+        successful_downloads = await super().run(all_paths, n_wet, pbar)
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks))
+        return successful_downloads
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Download Common Crawl WET files and filter them as they arrive')
+    parser.add_argument('--n-wet', type=int, default=100, help='Number of WET files to download')
+    parser.add_argument('--raw-dir', type=str, default=str(MOUNT_DIR/"CC"), help='Directory for downloaded WET files')
+    parser.add_argument('--filtered-dir', type=str, default=str(MOUNT_DIR/"CC-filtered"),
+                        help='Directory for filtered JSONL files')
+    parser.add_argument('--paths-file', type=str, default='wet.paths.gz', help='Common Crawl wet.paths.gz listing')
+    parser.add_argument('--base-url', type=str, default=base_url)
+    parser.add_argument('--concurrency', type=int, default=8, help='Simultaneous downloads')
+    parser.add_argument('--n-workers', type=int, default=N_CPU, help='Filter processes')
+    parser.add_argument('--max-pending-gb', type=float, default=20.0,
+                        help='Pause downloads while this much raw WET data waits to be processed')
+    parser.add_argument('--min-free-gb', type=float, default=10.0,
+                        help='Pause downloads while the raw directory has less free space')
+    parser.add_argument('--delete-raw', action='store_true', help='Delete each WET file once it is processed')
+    parser.add_argument('--compress', action='store_true',
+                        help='Write zstd-compressed .jsonl.zst shards with a block index instead of JSONL')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        filename='leaderboard_process_wet.log',
+        level=logging.ERROR,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+
+    with xopen(args.paths_file, 'rt') as f:
+        all_paths = [line.strip() for line in f]
+
+    start_time = time.perf_counter()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.n_workers) as executor:
+        downloader = PipelinedDownloader(
+            args.raw_dir, args.filtered_dir, executor,
+            max_pending_bytes=args.max_pending_gb * 1024**3,
+            min_free_bytes=args.min_free_gb * 1024**3,
+            delete_raw=args.delete_raw,
+            output_suffix=".jsonl.zst" if args.compress else OUTPUT_SUFFIX,
+            base_url=args.base_url,
+            concurrency=args.concurrency,
+        )
+        download_pbar = tqdm(total=args.n_wet, desc="Downloading", unit="file", position=0)
+        downloader.process_pbar = tqdm(desc="Processing", unit="file", position=1)
+        successful_downloads = asyncio.run(downloader.run(all_paths, args.n_wet, download_pbar))
+        download_pbar.close()
+        downloader.process_pbar.close()
+
+    elapsed = time.perf_counter() - start_time
+    print(f"\nCompleted: {successful_downloads} downloads "
+          f"({downloader.bytes_downloaded / 1024**3:.2f} GB), {downloader.n_processed} processed, "
+          f"{downloader.n_failed} failed, in {elapsed:.0f}s")
@@ -1,60 +1,54 @@
-import os
 import json
+import time
 import logging
+import argparse
+from collections import defaultdict
 from tqdm import tqdm
 from pathlib import Path
 from fastwarc.warc import ArchiveIterator, WarcRecordType
-from tldextract import TLDExtract
 from resiliparse.parse.encoding import detect_encoding
 import concurrent.futures
 import fasttext
 from cs336_data.gopher_quality_filter import gopher_quality_filter
+from cs336_data.cpus import available_cpus
+from cs336_data.url_filter import UrlFilter
+from cs336_data.document_shards import open_writer, document_stem
+from cs336_data.text_windows import FULL_TEXT, classifier_input
+from cs336_data.classifier_cache import ClassifierCache
+from cs336_data.file_leases import LeaseQueue, run_distributed
 
 SCORE_LANG = 0.90
 SCORE_NSFW = 0.90
 SCORE_TOXIC = 0.90
 BATCH_SIZE = 64
+# classifier input windows, e.g. TextWindow("head_tail", 2000); pick them with `python -m cs336_data.text_windows`
+WINDOWS = {"lang": FULL_TEXT, "nsfw": FULL_TEXT, "toxic": FULL_TEXT}
+# ".jsonl.zst" writes compressed shards with a block index instead of plain JSONL
+OUTPUT_SUFFIX = ".jsonl"
 
 model_lang = fasttext.load_model("/home/azureuser/localfiles/cs336-assignment4-data-mine/cs336_data/lid.176.bin")
 model_nsfw = fasttext.load_model("/home/azureuser/localfiles/cs336-assignment4-data-mine/cs336_data/jigsaw_fasttext_bigrams_nsfw_final.bin")
 model_toxic = fasttext.load_model("/home/azureuser/localfiles/cs336-assignment4-data-mine/cs336_data/jigsaw_fasttext_bigrams_hatespeech_final.bin")
 
+# verdict cache shared by all workers and runs, e.g. "/home/azureuser/mount/classifier_cache.sqlite"; None disables it
+CLASSIFIER_CACHE_PATH = None
+# bump the version when a model file is retrained
+CLASSIFIER_CACHE = ClassifierCache(
+    CLASSIFIER_CACHE_PATH,
+    namespace=f"v1|lid.176|jigsaw_nsfw|jigsaw_hatespeech|{SCORE_LANG}|{SCORE_NSFW}|{SCORE_TOXIC}|gopher:50:2e5|"
+              + "|".join(f"{name}={window}" for name, window in sorted(WINDOWS.items())),
+) if CLASSIFIER_CACHE_PATH else None
 
-TLD_EXTRACTOR = TLDExtract()
+
+# e.g. UT1 `adult/domains`; `.npy` lists compiled with `DomainBlocklist.save` load much faster
+URL_BLOCKLIST_PATHS = []
+URL_FILTER = UrlFilter.from_blocklist_files(URL_BLOCKLIST_PATHS)
 def should_filter_url(url: str) -> bool:
     """
     Return True if URL should be filtered out (removed)
     """
-    # Create the extractor instance
-    if not url:
-        return True
     try:
-        extracted = TLD_EXTRACTOR(url)  # Use the class instance
-        domain = extracted.domain.lower()
-        suffix = extracted.suffix.lower()
-        
-        # based on exploration of paloma dataset
-        # it has no intersection with `adult` and `social` domains
-        allowed_tlds = {'com', 'org', 'edu', 'gov', 'net', 'uk', 'ca', 'au', 'us'}
-        adult_domains = {
-            'pornhub', 'xvideos', 'redtube', 'youporn', 'xhamster',
-            'tube8', 'spankbang', 'chaturbate', 'cam4', 'livejasmin'
-        }
-        social_domains = {
-            'facebook', 'twitter', 'instagram', 'tiktok', 'snapchat',
-            'reddit', '4chan', '8chan', 'discord', 'telegram'
-        }
-
-        # 1. Filter by top-level domain (keep only certain TLDs)
-        if suffix not in allowed_tlds:
-            return True
-        # 2. Filter out adult/inappropriate domains
-        if domain in adult_domains:
-            return True
-        # 3. Filter out social media/forum content (often low quality)
-        if domain in social_domains:
-            return True
-        return False
+        return URL_FILTER(url)
     except Exception:
         # Filter out URLs that can't be parsed
         return True
@@ -63,50 +57,97 @@ def filter_batch(
         batch, model_lang, model_nsfw, model_toxic,
         score_lang, score_nsfw, score_toxic,
         filtered_by_lang, filtered_by_quality, filtered_by_nsfw, filtered_by_toxic,
+        timings=None, kept_scores=None, windows=None, cache=None,
 ):
     # major speed up comes from doing language identification on batch of records
+    # `timings`: optional dict accumulating seconds per filter stage
+    # `kept_scores`: optional list, gets (index in batch, lang score, non-nsfw score, non-toxic score)
+    #                for every kept document, aligned with `batch_kept`
+    # `windows`: optional {"lang"|"nsfw"|"toxic": TextWindow}, the part of each text the classifier sees
+    # `cache`: optional `ClassifierCache`; cached documents skip the models, new verdicts are stored
+    timings = timings if timings is not None else defaultdict(float)
+    windows = windows or {}
     batch_nsfw = []
     batch_toxic = []
     batch_kept = []
 
-    texts = [text.replace("\n", " ") for text in batch]
-    preds = model_lang.predict(texts)
-    preds = list(zip(*preds))
-    for i, (pred, score) in enumerate(preds):
+    # per document: (stage it stopped at, lang score, non-nsfw score, non-toxic score), see `classifier_cache`
+    t0 = time.perf_counter()
+    verdicts = cache.get_many(batch) if cache is not None else [None] * len(batch)
+    todo = [i for i, verdict in enumerate(verdicts) if verdict is None]
+    timings["cache"] += time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    texts = [classifier_input(batch[i], windows.get("lang")) for i in todo]
+    preds = list(zip(*model_lang.predict(texts))) if texts else []
+    timings["lang"] += time.perf_counter() - t0
+    t0 = time.perf_counter()
+    for i, (pred, score) in zip(todo, preds):
         pred = pred[0].replace("__label__", "")
         if pred == "en" and score.item() > score_lang:
             if gopher_quality_filter(batch[i], min_word_cnt=50, max_word_cnt=2e5):
-                batch_nsfw.append(batch[i])
+                batch_nsfw.append((i, score.item()))
             else:
-                filtered_by_quality += 1
-                continue
+                verdicts[i] = ("quality", score.item(), None, None)
         else:
-            filtered_by_lang += 1
+            verdicts[i] = ("lang", score.item(), None, None)
+    timings["quality"] += time.perf_counter() - t0
 
+    t0 = time.perf_counter()
     if batch_nsfw: 
-        texts = [text.replace("\n", " ") for text in batch_nsfw]
+        texts = [classifier_input(batch[i], windows.get("nsfw")) for i, _ in batch_nsfw]
         preds = model_nsfw.predict(texts)
         preds = list(zip(*preds))
-        for i, (pred, score) in enumerate(preds):
+        for (i, lang), (pred, score) in zip(batch_nsfw, preds):
             pred = pred[0].replace("__label__", "")
             if pred.startswith("non-") and score.item() > score_nsfw:
-                batch_toxic.append(batch_nsfw[i])
+                batch_toxic.append((i, lang, score.item()))
             else:
-                filtered_by_nsfw += 1
+                verdicts[i] = ("nsfw", lang, score.item(), None)
+    timings["nsfw"] += time.perf_counter() - t0
 
+    t0 = time.perf_counter()
     if batch_toxic: 
-        texts = [text.replace("\n", " ") for text in batch_toxic]
+        texts = [classifier_input(batch[i], windows.get("toxic")) for i, _, _ in batch_toxic]
         preds = model_toxic.predict(texts)
         preds = list(zip(*preds))
-        for i, (pred, score) in enumerate(preds):
+        for (i, lang, nsfw), (pred, score) in zip(batch_toxic, preds):
             pred = pred[0].replace("__label__", "")
             if pred.startswith("non-") and score.item() > score_toxic:
-                batch_kept.append(batch_toxic[i])
+                verdicts[i] = ("kept", lang, nsfw, score.item())
             else:
-                filtered_by_toxic += 1
+                verdicts[i] = ("toxic", lang, nsfw, score.item())
+    timings["toxic"] += time.perf_counter() - t0
+
+    if cache is not None:
+        t0 = time.perf_counter()
+        cache.put_many([batch[i] for i in todo], [verdicts[i] for i in todo])
+        timings["cache"] += time.perf_counter() - t0
+
+    for i, (stage, lang, nsfw, toxic) in enumerate(verdicts):
+        if stage == "lang":
+            filtered_by_lang += 1
+        elif stage == "quality":
+            filtered_by_quality += 1
+        elif stage == "nsfw":
+            filtered_by_nsfw += 1
+        elif stage == "toxic":
+            filtered_by_toxic += 1
+        else:
+            batch_kept.append(batch[i])
+            if kept_scores is not None:
+                kept_scores.append((i, lang, nsfw, toxic))
 
     return batch_kept, filtered_by_lang, filtered_by_quality, filtered_by_nsfw, filtered_by_toxic
 
+def decode_payload(byte_string: bytes) -> str:
+    """WET payloads are UTF-8 by spec, so only run encoding detection if strict UTF-8 decoding fails"""
+    try:
+        return byte_string.decode("utf-8")
+    except UnicodeDecodeError:
+        encoding = detect_encoding(byte_string)
+        return byte_string.decode(encoding, errors="ignore")
+
 def process_single_wet_file(input_path: str, output_path: str) -> str:
     """
     Process a single WET file with language, toxicity, and NSFW filtering.
@@ -115,69 +156,104 @@ def process_single_wet_file(input_path: str, output_path: str) -> str:
     Speed up effort (see leaderboard.ipynb for more detail):
     1. Doing language identification on batch of records
     2. Write to output file incrementally to release memory
+    3. Only `conversion` records are returned by `ArchiveIterator` (the type filter runs in C), and
+       WET records have no HTTP headers to parse
+    4. The URL is checked before the payload is read, so filtered records are never copied into Python bytes
+    5. Payloads are decoded as UTF-8 first; encoding detection only runs if that fails
+
+    Time spent per stage (seconds) is written to the stats file under "timings".
+
+    Each kept record has its text, URL, WARC record id and classifier scores. An `output_path` ending in
+    `.jsonl.zst` is written as a compressed shard with a block index (see `document_shards`).
     """
-    filtered_by_type = 0
     filtered_by_url = 0
     filtered_by_quality = 0
     filtered_by_lang = 0
     filtered_by_nsfw = 0
     filtered_by_toxic = 0
+    timings = defaultdict(float)
+    if CLASSIFIER_CACHE is not None:
+        cache_hits, cache_misses = CLASSIFIER_CACHE.hits, CLASSIFIER_CACHE.misses
+
+    def flush(batch, batch_headers, writer):
+        nonlocal filtered_by_lang, filtered_by_quality, filtered_by_nsfw, filtered_by_toxic
+        kept_scores = []
+        batch_kept, filtered_by_lang, filtered_by_quality, filtered_by_nsfw, filtered_by_toxic = filter_batch(
+            batch, model_lang, model_nsfw, model_toxic, 
+            SCORE_LANG, SCORE_NSFW, SCORE_TOXIC,
+            filtered_by_lang, filtered_by_quality, filtered_by_nsfw, filtered_by_toxic,
+            timings=timings, kept_scores=kept_scores, windows=WINDOWS, cache=CLASSIFIER_CACHE,
+        )
+        t0 = time.perf_counter()
+        for content, (i, lang_score, nsfw_score, toxic_score) in zip(batch_kept, kept_scores):
+            url, record_id = batch_headers[i]
+            writer.write({
+                'text': content,
+                'url': url,
+                'record_id': record_id,
+                'lang_score': lang_score,
+                'non_nsfw_score': nsfw_score,
+                'non_toxic_score': toxic_score,
+            })
+        timings["write"] += time.perf_counter() - t0
+
     try:
-        # Write filtered content to JSONL
+        # Write filtered content to JSONL (or a compressed shard)
         # `utf-8` for writing to JSON; this does not have to match with reading encoding.
-        with open(output_path, 'w', encoding='utf-8') as f:
-            iterator = ArchiveIterator(open(input_path, "rb"))
+        with open_writer(output_path) as writer, open(input_path, "rb") as stream:
+            # 0. record type filtered inside the iterator
+            iterator = ArchiveIterator(stream, record_types=WarcRecordType.conversion, parse_http=False)
             batch = []
+            batch_headers = []
+            t0 = time.perf_counter()
             for record in iterator:
-                # 0. check record type
-                if record.record_type != WarcRecordType.conversion:
-                    filtered_by_type += 1
-                    continue
-                byte_string = record.reader.read()
-                encoding = detect_encoding(byte_string)
-                content = byte_string.decode(encoding, errors="ignore")
+                t1 = time.perf_counter()
+                timings["iterate"] += t1 - t0
 
-                # 1. check URL
-                if should_filter_url(record.headers.get('WARC-Target-URI', '')):
+                # 1. check URL, before touching the payload
+                url = record.headers.get('WARC-Target-URI', '')
+                if should_filter_url(url):
                     filtered_by_url += 1
+                    t0 = time.perf_counter()
+                    timings["url"] += t0 - t1
                     continue
+                t2 = time.perf_counter()
+                timings["url"] += t2 - t1
+
+                content = decode_payload(record.reader.read())
+                t0 = time.perf_counter()
+                timings["read_decode"] += t0 - t2
 
                 batch.append(content)
+                batch_headers.append((url, record.record_id))
                 # 2. Apply filters
                 if len(batch) >= BATCH_SIZE:
-                    batch_kept, filtered_by_lang, filtered_by_quality, filtered_by_nsfw, filtered_by_toxic = filter_batch(
-                        batch, model_lang, model_nsfw, model_toxic, 
-                        SCORE_LANG, SCORE_NSFW, SCORE_TOXIC,
-                        filtered_by_lang, filtered_by_quality, filtered_by_nsfw, filtered_by_toxic
-                    )
-                    if batch_kept:
-                        for content in batch_kept:
-                            json.dump({'text': content}, f)
-                            f.write('\n')    
+                    flush(batch, batch_headers, writer)
                     batch = []
+                    batch_headers = []
+                    t0 = time.perf_counter()
 
             # do once for remainder
             if batch:
-                batch_kept, filtered_by_lang, filtered_by_quality, filtered_by_nsfw, filtered_by_toxic = filter_batch(
-                    batch, model_lang, model_nsfw, model_toxic, 
-                    SCORE_LANG, SCORE_NSFW, SCORE_TOXIC,
-                    filtered_by_lang, filtered_by_quality, filtered_by_nsfw, filtered_by_toxic
-                )
-                if batch_kept:
-                    for content in batch_kept:
-                        json.dump({'text': content}, f)
-                        f.write('\n')    
+                flush(batch, batch_headers, writer)
 
             filtered_dict = {
-                    "by_type": filtered_by_type,
                     "by_url": filtered_by_url,
                     "by_lang": filtered_by_lang,
                     "by_quality": filtered_by_quality,
                     "by_nsfw": filtered_by_nsfw,
-                    "by_toxic": filtered_by_toxic
+                    "by_toxic": filtered_by_toxic,
+                    "timings": dict(timings),
+                }
+            if CLASSIFIER_CACHE is not None:
+                # workers are never closed; one write per file for the touches and counts of its lookups
+                CLASSIFIER_CACHE.save()
+                filtered_dict["cache"] = {
+                    "hits": CLASSIFIER_CACHE.hits - cache_hits,
+                    "misses": CLASSIFIER_CACHE.misses - cache_misses,
                 }
             # Write stats to separate JSON file
-            stats_path = output_path.replace('.jsonl', '_stats.json')
+            stats_path = str(Path(output_path).with_name(document_stem(output_path) + '_stats.json'))
             with open(stats_path, 'w') as f:
                 json.dump(filtered_dict, f, indent=2)
             return output_path
@@ -186,6 +262,16 @@ def process_single_wet_file(input_path: str, output_path: str) -> str:
         return None
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Filter WET files')
+    parser.add_argument('--input-dir', type=str, default="/home/azureuser/mount/CC")
+    parser.add_argument('--output-dir', type=str, default="/home/azureuser/mount/CC-filtered")
+    parser.add_argument('--run-dir', type=str, default=None,
+                        help='Shared directory of a multi-node run: every node started with it takes files by lease')
+    parser.add_argument('--lease-seconds', type=float, default=600)
+    parser.add_argument('--max-attempts', type=int, default=3,
+                        help='Runs of a failing task (across all nodes) before it is given up on')
+    args = parser.parse_args()
+
     # Set up logging
     logging.basicConfig(
         filename='leaderboard_process_wet.log',
@@ -194,34 +280,48 @@ if __name__ == "__main__":
     )
     
     # Set up the executor
-    num_cpus = len(os.sched_getaffinity(0))
+    num_cpus = available_cpus()
     executor = concurrent.futures.ProcessPoolExecutor(max_workers=num_cpus)
 
     # Set up file paths
-    input_directory_path = Path("/home/azureuser/mount/CC")
-    wet_filepaths = list(input_directory_path.glob("*.wet.gz"))
-    output_directory_path = Path("/home/azureuser/mount/CC-filtered")
+    input_directory_path = Path(args.input_dir)
+    # sorted, so every node of a run sees the same task list
+    wet_filepaths = sorted(input_directory_path.glob("*.wet.gz"))
+    output_directory_path = Path(args.output_dir)
     output_directory_path.mkdir(parents=True, exist_ok=True)
 
-    futures = []
-
-    for wet_filepath in wet_filepaths:
-        # For each warc.wet.gz filepath, submit a job to the executor and get a future back
-        output_filename = wet_filepath.name.replace(".warc.wet.gz", ".jsonl")
-        output_filepath = output_directory_path / output_filename
-        
-        future = executor.submit(
-            process_single_wet_file,
-            str(wet_filepath),
-            str(output_filepath)
-        )
-        # Store the futures
-        futures.append(future)
-
-    # Iterate over the completed futures as they finish, using a progress bar
-    # to keep track of progress.
-    for future in tqdm(
-        concurrent.futures.as_completed(futures),
-        total=len(wet_filepaths),
-    ):
-        output_file = future.result()
\ No newline at end of file
+    def output_path_of(wet_filepath):
+        return output_directory_path / wet_filepath.name.replace(".warc.wet.gz", OUTPUT_SUFFIX)
+
+    if args.run_dir:
+        queue = LeaseQueue(args.run_dir, [p.name for p in wet_filepaths], lease_seconds=args.lease_seconds,
+                           max_attempts=args.max_attempts)
+        tasks = {p.name: (str(p), str(output_path_of(p))) for p in wet_filepaths}
+        with tqdm(total=len(tasks), desc=f"Node {queue.node_id}") as pbar:
+            results = run_distributed(queue, tasks, process_single_wet_file, executor, max_in_flight=num_cpus,
+                                      pbar=pbar)
+        print(f"{len(results)}/{len(tasks)} files done in {args.run_dir}")
+    else:
+        futures = []
+
+        for wet_filepath in wet_filepaths:
+            # For each warc.wet.gz filepath, submit a job to the executor and get a future back
+            future = executor.submit(
+                process_single_wet_file,
+                str(wet_filepath),
+                str(output_path_of(wet_filepath))
+            )
+            # Store the futures
+            futures.append(future)
+
+        # Iterate over the completed futures as they finish, using a progress bar
+        # to keep track of progress.
+        for future in tqdm(
+            concurrent.futures.as_completed(futures),
+            total=len(wet_filepaths),
+        ):
+            output_file = future.result()
+
+    if CLASSIFIER_CACHE is not None:
+        stats = CLASSIFIER_CACHE.stats()
+        print(f"Classifier cache: {stats['entries']} entries, lifetime hit rate {stats['hit_rate']:.1%}")
@@ -0,0 +1,239 @@
+import time
+import logging
+import argparse
+import concurrent.futures
+from pathlib import Path
+
+import numpy as np
+from tqdm import tqdm
+
+from cs336_data.cpus import available_cpus
+from cs336_data.document_shards import ShardReader, ShardWriter, open_writer
+from cs336_data.gopher_quality_filter import gopher_statistics
+from cs336_data.text_windows import classifier_input
+
+# Retune filter thresholds without reprocessing WET files.
+#
+# compute: every `conversion` record of a WET file goes through every filter once, with no early exit.
+#          The texts are written to `<stem>.jsonl.zst` and the signals, one row per record, to
+#          `<stem>.signals.npy` (structured array, ~40 bytes per record).
+# select:  any threshold configuration is a vectorized NumPy mask over the signal columns; only the
+#          kept records are decompressed (block-level, see `document_shards`) and written out.
+#          `--dry-run` only prints the counts, so a threshold sweep takes seconds.
+#
+# `select` with the default thresholds keeps the same documents as `process_single_wet_file`.
+
+MOUNT_DIR = Path("/home/azureuser/mount/")
+SIGNALS_SUFFIX = ".signals.npy"
+
+SIGNAL_DTYPE = np.dtype([
+    ("url_filtered", np.bool_),
+    ("lang", "S8"),                 # fastText langid label, e.g. b"en"
+    ("lang_score", np.float32),
+    ("non_nsfw_score", np.float32),  # probability of the `non-nsfw` label
+    ("non_toxic_score", np.float32),  # probability of the `non-toxic` label
+    ("n_words", np.int32),
+    ("mean_word_len", np.float32),
+    ("alpha_word_frac", np.float32),
+    ("valid_line_frac", np.float32),
+])
+
+
+def _non_label_scores(preds) -> list[float]:
+    """binary fastText classifier: probability of the `non-*` label from the top-1 prediction"""
+    return [score.item() if label[0].replace("__label__", "").startswith("non-") else 1 - score.item()
+            for label, score in zip(*preds)]
+
+
+def compute_signals_batch(batch, model_lang, model_nsfw, model_toxic, windows=None) -> list[dict]:
+    """all signals for every text in `batch` (see `filter_batch` for the filtering version)"""
+    windows = windows or {}
+    lang_labels, lang_scores = model_lang.predict([classifier_input(text, windows.get("lang")) for text in batch])
+    non_nsfw = _non_label_scores(model_nsfw.predict([classifier_input(text, windows.get("nsfw")) for text in batch]))
+    non_toxic = _non_label_scores(model_toxic.predict([classifier_input(text, windows.get("toxic")) for text in batch]))
+    signals = []
+    for i, text in enumerate(batch):
+        signals.append({
+            "lang": lang_labels[i][0].replace("__label__", ""),
+            "lang_score": lang_scores[i].item(),
+            "non_nsfw_score": non_nsfw[i],
+            "non_toxic_score": non_toxic[i],
+            **gopher_statistics(text),
+        })
+    return signals
+
+
+def compute_signals_single_wet_file(input_path: str, output_dir: str) -> str:
+    """compute: write `<stem>.jsonl.zst` (all records) and `<stem>.signals.npy` (one row per record)"""
+    # the classifiers are loaded at import time, only in the workers that need them
+    from fastwarc.warc import ArchiveIterator, WarcRecordType
+    from cs336_data.leaderboard_process_wet import (
+        model_lang, model_nsfw, model_toxic, should_filter_url, decode_payload, BATCH_SIZE, WINDOWS
+    )
+
+    stem = Path(input_path).name.replace(".warc.wet.gz", "")
+    shard_path = Path(output_dir) / f"{stem}.jsonl.zst"
+    rows = []
+
+    def add_rows(batch, batch_url_filtered):
+        signals = compute_signals_batch(batch, model_lang, model_nsfw, model_toxic, WINDOWS)
+        rows.extend((url_filtered, *doc_signals.values())
+                    for url_filtered, doc_signals in zip(batch_url_filtered, signals))
+
+    try:
+        with ShardWriter(shard_path) as writer, open(input_path, "rb") as stream:
+            batch, batch_url_filtered = [], []
+            for record in ArchiveIterator(stream, record_types=WarcRecordType.conversion, parse_http=False):
+                url = record.headers.get('WARC-Target-URI', '')
+                content = decode_payload(record.reader.read())
+                writer.write({'text': content, 'url': url, 'record_id': record.record_id})
+                batch.append(content)
+                batch_url_filtered.append(should_filter_url(url))
+                if len(batch) >= BATCH_SIZE:
+                    add_rows(batch, batch_url_filtered)
+                    batch, batch_url_filtered = [], []
+            if batch:
+                add_rows(batch, batch_url_filtered)
+        # written last: an existing signals file means the shard next to it is complete
+        np.save(Path(output_dir) / f"{stem}{SIGNALS_SUFFIX}", np.array(rows, dtype=SIGNAL_DTYPE))
+        return str(shard_path)
+    except Exception as e:
+        logging.error(f"Error computing signals for {input_path}: {e}")
+        return None
+
+
+def select_mask(
+        signals: np.ndarray,
+        score_lang: float = 0.90,
+        score_nsfw: float = 0.90,
+        score_toxic: float = 0.90,
+        min_word_cnt: float = 50,
+        max_word_cnt: float = 2e5,
+        min_mean_word_len: float = 3.0,
+        max_mean_word_len: float = 10.0,
+        min_alpha_word_frac: float = 0.8,
+        min_valid_line_frac: float = 0.7,
+        lang: str = "en",
+        url_filter: bool = True,
+) -> dict[str, np.ndarray]:
+    """Boolean mask per filter stage, in pipeline order, plus the combined `kept` mask
+
+    Same comparisons as `filter_batch` and `gopher_quality_filter`. `score_nsfw` / `score_toxic` are thresholds
+    on the probability of the `non-*` label, which matches `filter_batch` for thresholds >= 0.5.
+    """
+    masks = {
+        "url": ~signals["url_filtered"] if url_filter else np.ones(len(signals), dtype=bool),
+        "lang": (signals["lang"] == lang.encode()) & (signals["lang_score"] > score_lang),
+        "quality": (
+            (signals["n_words"] >= min_word_cnt) & (signals["n_words"] <= max_word_cnt)
+            & (signals["mean_word_len"] >= min_mean_word_len) & (signals["mean_word_len"] <= max_mean_word_len)
+            & (signals["alpha_word_frac"] >= min_alpha_word_frac)
+            & (signals["valid_line_frac"] > min_valid_line_frac)
+        ),
+        "nsfw": signals["non_nsfw_score"] > score_nsfw,
+        "toxic": signals["non_toxic_score"] > score_toxic,
+    }
+    masks["kept"] = np.logical_and.reduce(list(masks.values()))
+    return masks
+
+
+def stage_counts(masks: dict[str, np.ndarray]) -> dict[str, int]:
+    """documents removed by each stage, counting a document only at the first stage that removes it,
+    like the `by_*` counters of `process_single_wet_file`"""
+    remaining = np.ones_like(masks["kept"])
+    counts = {}
+    for stage, mask in masks.items():
+        if stage == "kept":
+            continue
+        counts[f"by_{stage}"] = int(np.count_nonzero(remaining & ~mask))
+        remaining &= mask
+    counts["kept"] = int(np.count_nonzero(remaining))
+    return counts
+
+
+def materialize(signals_path, output_path, thresholds: dict) -> int:
+    """select: write the kept records of one shard, with their scores, to `output_path`"""
+    signals = np.load(signals_path)
+    kept = np.flatnonzero(select_mask(signals, **thresholds)["kept"])
+    shard_path = str(signals_path)[: -len(SIGNALS_SUFFIX)] + ".jsonl.zst"
+    records = ShardReader(shard_path).read_records(kept) if len(kept) else []
+    with open_writer(output_path) as writer:
+        for idx, record in zip(kept, records):
+            row = signals[idx]
+            record.update(lang_score=float(row["lang_score"]), non_nsfw_score=float(row["non_nsfw_score"]),
+                          non_toxic_score=float(row["non_toxic_score"]))
+            writer.write(record)
+    return len(kept)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compute filter signals once per WET record, then select with '
+                                                 'any thresholds')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    compute_parser = subparsers.add_parser('compute', help='Run every filter on every record of the WET files')
+    compute_parser.add_argument('--input-dir', type=str, default=str(MOUNT_DIR/"CC"))
+    compute_parser.add_argument('--signals-dir', type=str, default=str(MOUNT_DIR/"CC-signals"))
+
+    select_parser = subparsers.add_parser('select', help='Apply thresholds and write the kept documents')
+    select_parser.add_argument('--signals-dir', type=str, default=str(MOUNT_DIR/"CC-signals"))
+    select_parser.add_argument('--output-dir', type=str, default=str(MOUNT_DIR/"CC-filtered"))
+    select_parser.add_argument('--output-suffix', type=str, default=".jsonl", choices=[".jsonl", ".jsonl.zst"])
+    select_parser.add_argument('--dry-run', action='store_true', help='Only print what each stage removes')
+    select_parser.add_argument('--score-lang', type=float, default=0.90)
+    select_parser.add_argument('--score-nsfw', type=float, default=0.90)
+    select_parser.add_argument('--score-toxic', type=float, default=0.90)
+    select_parser.add_argument('--min-word-cnt', type=float, default=50)
+    select_parser.add_argument('--max-word-cnt', type=float, default=2e5)
+    select_parser.add_argument('--min-mean-word-len', type=float, default=3.0)
+    select_parser.add_argument('--max-mean-word-len', type=float, default=10.0)
+    select_parser.add_argument('--min-alpha-word-frac', type=float, default=0.8)
+    select_parser.add_argument('--min-valid-line-frac', type=float, default=0.7)
+    select_parser.add_argument('--no-url-filter', dest='url_filter', action='store_false')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        filename='leaderboard_signals.log',
+        level=logging.ERROR,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    num_cpus = available_cpus()
+    signals_dir = Path(args.signals_dir)
+
+    if args.command == 'compute':
+        signals_dir.mkdir(parents=True, exist_ok=True)
+        wet_filepaths = sorted(Path(args.input_dir).glob("*.wet.gz"))
+        # skip files done by an earlier run
+        wet_filepaths = [p for p in wet_filepaths
+                         if not (signals_dir / p.name.replace(".warc.wet.gz", SIGNALS_SUFFIX)).exists()]
+        with concurrent.futures.ProcessPoolExecutor(max_workers=num_cpus) as executor:
+            futures = [executor.submit(compute_signals_single_wet_file, str(p), str(signals_dir))
+                       for p in wet_filepaths]
+            for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
+                future.result()
+    else:
+        thresholds = {key: getattr(args, key) for key in (
+            'score_lang', 'score_nsfw', 'score_toxic', 'min_word_cnt', 'max_word_cnt', 'min_mean_word_len',
+            'max_mean_word_len', 'min_alpha_word_frac', 'min_valid_line_frac', 'url_filter')}
+        signals_paths = sorted(signals_dir.glob(f"*{SIGNALS_SUFFIX}"))
+
+        start_time = time.perf_counter()
+        signals = np.concatenate([np.load(p) for p in signals_paths]) if signals_paths \
+            else np.empty(0, dtype=SIGNAL_DTYPE)
+        counts = stage_counts(select_mask(signals, **thresholds))
+        print(f"{len(signals)} records in {len(signals_paths)} files, selected in "
+              f"{time.perf_counter() - start_time:.2f}s")
+        for stage, count in counts.items():
+            print(f"  {stage}: {count} ({count / max(len(signals), 1):.1%})")
+
+        if not args.dry_run:
+            output_dir = Path(args.output_dir)
+            output_dir.mkdir(parents=True, exist_ok=True)
+            with concurrent.futures.ProcessPoolExecutor(max_workers=num_cpus) as executor:
+                output_paths = [output_dir / (p.name[:-len(SIGNALS_SUFFIX)] + args.output_suffix)
+                                for p in signals_paths]
+                futures = [executor.submit(materialize, p, output_path, thresholds)
+                           for p, output_path in zip(signals_paths, output_paths)]
+                n_kept = sum(future.result() for future in tqdm(concurrent.futures.as_completed(futures),
+                                                                total=len(futures), desc="Writing"))
+            print(f"Wrote {n_kept} documents to {output_dir}")
@@ -1,12 +1,19 @@
+import os
+import shutil
+import argparse
 import multiprocessing
+import concurrent.futures
 import numpy as np
 from tqdm import tqdm
 from transformers import AutoTokenizer
 import pickle
 import random
-import json
 from pathlib import Path
 import pandas as pd
+from cs336_basics.data import SHARD_HEADER_SIZE, SHARD_SUFFIX, ShardWriter, read_shard_header
+from cs336_data.document_shards import read_documents
+from cs336_data.file_leases import LeaseQueue, run_distributed
+from cs336_data.token_cache import TokenCache
 
 INPUT_DIR = Path("/home/azureuser/mount/CC-filtered")
 OUTPUT_DIR = Path("/home/azureuser/mount")
@@ -16,9 +23,42 @@ tokenizer = AutoTokenizer.from_pretrained("gpt2")
 def tokenize_line_and_add_eos(line):
     return tokenizer.encode(line) + [tokenizer.eos_token_id]
 
-def tokenize_incremental(input_file_dict, output_file, batch_size):
+def tokenize_cached(texts, writer, cache=None, map_fn=map) -> int:
+    """append the tokens of `texts` to `writer`; with a `TokenCache`, cached documents are copied out of it
+    and only the others are tokenized (with `map_fn`) and added to it. Returns the number tokenized
+
+    New documents are written from their fresh tokens as `map_fn` streams them, between the copied runs of
+    cached ones. They reach the cache index on its next `flush`, which is left to the caller (once per part
+    or batch), so the store doesn't fragment into one shard per call.
+    """
+    if cache is None:
+        for ids in map_fn(tokenize_line_and_add_eos, texts):
+            writer.write(ids)
+        return len(texts)
+    spans = cache.spans(texts)
+    todo = [i for i, span in enumerate(spans) if span is None]
+    fresh = iter(map_fn(tokenize_line_and_add_eos, [texts[i] for i in todo]))
+    run = []
+    for text, span in zip(texts, spans):
+        if span is not None:
+            run.append(span)
+            continue
+        cache.copy(run, writer)
+        run = []
+        ids = next(fresh)
+        cache.add(text, ids)
+        writer.write(ids)
+    cache.copy(run, writer)
+    return len(todo)
+
+
+def tokenize_incremental(input_file_dict, shards_dir, batch_size, cache=None):
+    """tokenize the kept lines batch by batch, one shard per batch"""
     pool = multiprocessing.Pool(multiprocessing.cpu_count())
     files_list = list(input_file_dict.items())
+    remove_stale_parts(shards_dir)
+    shard_files = []
+    total_tokens = 0
     
     for batch_start in range(0, len(files_list), batch_size):
         batch_end = min(batch_start + batch_size, len(files_list))
@@ -29,43 +69,98 @@ def tokenize_incremental(input_file_dict, output_file, batch_size):
         # Load lines from all files in batch
         all_lines = []
         for file, line_ids in batch_files:
-            with open(INPUT_DIR/file) as f:
-                file_lines = f.readlines()
-                texts = [json.loads(file_lines[i])["text"] for i in line_ids]
-                all_lines.extend(texts)
-        
-        # Tokenize batch
-        results = []
-        for result in tqdm(
-            pool.imap(tokenize_line_and_add_eos, all_lines, chunksize=100),
-            total=len(all_lines),
-            desc=f"Tokenizing batch {batch_start//batch_size + 1}"
-        ):
-            results.append(result)
+            # for `.jsonl.zst` shards only the blocks holding `line_ids` are decompressed
+            texts = [record["text"] for record in read_documents(INPUT_DIR/file, line_ids)]
+            all_lines.extend(texts)
         
-        # Flatten and save incrementally
-        all_ids = [token_id for sublist in results for token_id in sublist]
-        ids_array = np.array(all_ids, dtype=np.uint16)
+        # Tokenize batch into its own shard
+        shard_file = Path(shards_dir)/part_name(batch_start // batch_size)
+        desc = f"Tokenizing batch {batch_start//batch_size + 1}"
+        with ShardWriter(shard_file, len(tokenizer), tokenizer.eos_token_id) as writer:
+            n_tokenized = tokenize_cached(
+                all_lines, writer, cache,
+                map_fn=lambda fn, lines: tqdm(pool.imap(fn, lines, chunksize=100), total=len(lines), desc=desc),
+            )
+        if cache is not None:
+            cache.flush()
+        shard_files.append(shard_file)
+        total_tokens += writer.header.num_tokens
         
-        # Append to file
-        with open(output_file, 'ab') as f:
-            ids_array.tofile(f)
-        
-        print(f"Saved batch {batch_start//batch_size + 1}, total tokens so far: {(batch_end * len(all_ids)) // len(batch_files)}")
+        print(f"Saved batch {batch_start//batch_size + 1} ({n_tokenized}/{len(all_lines)} docs tokenized), "
+              f"total tokens so far: {total_tokens}")
     
     pool.close()
     pool.join()
+    return shard_files
+
+
+def remove_stale_parts(parts_dir, keep=()) -> None:
+    """delete the shards in `parts_dir` not named in `keep`: `TokenDataset(parts_dir)` reads every shard, so
+    parts of an earlier run with more batches would be trained on"""
+    for part_file in Path(parts_dir).glob(f"*{SHARD_SUFFIX}"):
+        if part_file.name not in keep:
+            print(f"Removing stale {part_file}")
+            part_file.unlink(missing_ok=True)
+
+
+def part_name(part_idx: int) -> str:
+    return f"part_{part_idx:05d}{SHARD_SUFFIX}"
+
+
+def tokenize_part(file_items, part_file, cache=None) -> int:
+    """tokenize the kept lines of `file_items` ((file, line_ids) pairs) into one shard; a task of a
+    distributed run"""
+    with ShardWriter(part_file, len(tokenizer), tokenizer.eos_token_id) as writer:
+        for file, line_ids in file_items:
+            texts = [record["text"] for record in read_documents(INPUT_DIR/file, line_ids)]
+            tokenize_cached(texts, writer, cache)
+    if cache is not None:
+        # the worker's copy of the cache is dropped with the task: one store shard per part
+        cache.flush()
+        cache.save_counters()
+    return writer.header.num_tokens
+
+
+def concatenate_parts(part_files, output_file) -> None:
+    """the tokens of all shards as one headerless uint16 file, the input of the token-space stages
+    (`suffix_array_dedup`, `decontamination`)"""
+    tmp_file = Path(f"{output_file}.tmp")
+    with open(tmp_file, 'wb') as out:
+        for part_file in part_files:
+            header = read_shard_header(part_file)
+            if header.dtype != np.uint16:
+                raise ValueError(f"{part_file} holds {header.dtype} tokens, the flat file is uint16")
+            with open(part_file, 'rb') as f:
+                f.seek(SHARD_HEADER_SIZE)
+                shutil.copyfileobj(f, out)
+    os.replace(tmp_file, output_file)
 
 
 if __name__ == "__main__":
-    # read clusters
-    cluster_file = "/home/azureuser/mount/duplicate_clusters.pkl"
+    parser = argparse.ArgumentParser(description='Tokenize one document of every duplicate cluster')
+    parser.add_argument('--cluster-file', type=str, default="/home/azureuser/mount/duplicate_clusters.pkl")
+    parser.add_argument('--batch-size', type=int, default=200, help='Files per batch (per task with --run-dir)')
+    parser.add_argument('--seed', type=int, default=0, help='Picks the document kept from every cluster')
+    parser.add_argument('--run-dir', type=str, default=None,
+                        help='Shared directory of a multi-node run: every node started with it takes batches by lease')
+    parser.add_argument('--lease-seconds', type=float, default=1800)
+    parser.add_argument('--max-attempts', type=int, default=3,
+                        help='Runs of a failing task (across all nodes) before it is given up on')
+    parser.add_argument('--token-cache', type=str, default=None,
+                        help='Tokenization cache directory, e.g. /home/azureuser/mount/token_cache: documents '
+                             'tokenized by an earlier run are copied from it instead of tokenized again')
+    parser.add_argument('--no-flat', action='store_true',
+                        help='Only write the shard directory train.py reads, not the flat CC_filtered_tokens.bin '
+                             'the token-space dedup / decontamination stages read')
+    args = parser.parse_args()
 
-    with open(cluster_file, "rb") as f:
+    # read clusters
+    with open(args.cluster_file, "rb") as f:
         all_clusters = pickle.load(f)
 
-    # choose a random element from each set
-    files_2keep = [random.choice(list(c)) for c in all_clusters["clusters"]]
+    # choose a random element from each set; seeded, so every node of a run keeps the same documents
+    rng = random.Random(args.seed)
+    files_2keep = [rng.choice(sorted(c)) for c in all_clusters["clusters"]]
     metadata = all_clusters["metadata"]
     print(f"Total docs: {len(metadata)/1e6}M")
     print(f"Kept docs: {len(files_2keep)/1e6}M")
@@ -74,6 +169,54 @@ if __name__ == "__main__":
     metadata_2keep = [metadata[i] for i in sorted(files_2keep)]
     input_file_dict = pd.DataFrame(metadata_2keep).groupby("jsonl_file")["line_id"].agg(list).to_dict()
 
-    # Tokenization
-    tokenize_incremental(input_file_dict, OUTPUT_DIR/"CC_filtered_tokens.bin", 200)
+    output_file = OUTPUT_DIR/"CC_filtered_tokens.bin"
+    # one token shard per batch; the directory is the training dataset (`cs336_basics.data.TokenDataset`)
+    parts_dir = OUTPUT_DIR/"CC_filtered_tokens_parts"
+    parts_dir.mkdir(parents=True, exist_ok=True)
+    cache = None
+    if args.token_cache:
+        cache = TokenCache(args.token_cache, len(tokenizer), tokenizer.eos_token_id, namespace="gpt2")
+        cache_before = cache.stats()
+    if args.run_dir:
+        files_list = list(input_file_dict.items())
+        tasks = {}
+        for part_idx, batch_start in enumerate(range(0, len(files_list), args.batch_size)):
+            part_file = parts_dir/part_name(part_idx)
+            tasks[part_file.name] = (files_list[batch_start:batch_start + args.batch_size], part_file, cache)
+        queue = LeaseQueue(args.run_dir, list(tasks), lease_seconds=args.lease_seconds,
+                           max_attempts=args.max_attempts)
+        n_workers = multiprocessing.cpu_count()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor, \
+                tqdm(total=len(tasks), desc=f"Node {queue.node_id}") as pbar:
+            n_tokens = run_distributed(queue, tasks, tokenize_part, executor, max_in_flight=n_workers, pbar=pbar)
+        print(f"{sum(n_tokens.values())} tokens in {len(n_tokens)}/{len(tasks)} parts")
+
+        # a single node writes the flat file, once every part is done
+        failed = [name for name in tasks if name not in n_tokens]
+        if failed:
+            raise SystemExit(f"{len(failed)} parts failed ({', '.join(failed[:5])}...), see {args.run_dir}/failures; "
+                             f"rerun with the same --run-dir and a higher --max-attempts to retry them")
+        # every node does this once all parts are done; stale names are never part names of this run
+        remove_stale_parts(parts_dir, keep=set(tasks))
+        if not args.no_flat and queue.claim("concatenate"):
+            try:
+                concatenate_parts([parts_dir/name for name in tasks], output_file)
+            except BaseException:
+                queue.release("concatenate")
+                raise
+            queue.complete("concatenate", str(output_file))
+            queue.close()
+            print(f"Saved {output_file}")
+    else:
+        # Tokenization
+        part_files = tokenize_incremental(input_file_dict, parts_dir, args.batch_size, cache)
+        if not args.no_flat:
+            concatenate_parts(part_files, output_file)
+            print(f"Saved {output_file}")
 
+    if cache is not None:
+        stats = cache.stats()
+        hits, misses = stats["hits"] - cache_before["hits"], stats["misses"] - cache_before["misses"]
+        print(f"Token cache: {hits} docs copied, {misses} tokenized (hit rate {hits / max(hits + misses, 1):.1%}), "
+              f"{stats['entries']} entries")
+        cache.close()
@@ -0,0 +1,364 @@
+import os
+import json
+import time
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+from cs336_data.text_normalization import mix64
+
+# Persistent, incremental MinHash LSH index.
+#
+# `leaderboard_get_clusters` buckets the full signature matrix from scratch, so every new crawl dump redoes
+# the clustering of all previous ones. This index keeps the band buckets on disk and only ever touches the
+# new documents:
+#
+#   band keys     every signature gives `num_bands` 64-bit keys, a hash of (band index, band values)
+#   segments      immutable pairs of .npy files, band keys sorted ascending and the document id of each,
+#                 opened with mmap; a key's posting list is a `searchsorted` range in every segment
+#   LSM merging   each `insert` writes one level-0 segment; `fanout` segments of one level are merged into
+#                 one segment of the next level, so a key is rewritten O(log_fanout(n)) times in total
+#   clusters      union-find over document ids in `parent.npy` (mmapped, capacity doubles as it grows).
+#                 The root of a cluster is its smallest id, i.e. its earliest document, so documents that
+#                 were kept once stay kept when later dumps add duplicates of them.
+#   manifest      `manifest.json`, rewritten atomically after every `add`; segment files are only listed
+#                 there once they are complete
+#   recovery      `add` unions in `parent.npy` before its manifest commit. A `parent.dirty` marker is created
+#                 first and removed after the commit; an index opened with the marker present rebuilds the
+#                 union-find from the committed segments, dropping unions of an `add` that never committed
+#
+# Every document sharing a band key is unioned when it is added, so clustering a new document only needs
+# one document of each matching posting list: `add` costs O(new documents * bands * segments * log n).
+# `query` returns complete posting lists, for callers that want all candidate pairs.
+#
+# A crash during `add` leaves the manifest (and, after recovery, the clusters) at the previous batch; adding
+# the same batch again redoes it.
+
+MANIFEST = "manifest.json"
+PARENT = "parent.npy"
+DIRTY = "parent.dirty"
+
+# odd multiplier for folding band values, and one for the band index
+_FOLD = np.uint64(0x100000001B3)
+_BAND = np.uint64(0x9E3779B97F4A7C15)
+
+
+def band_keys(signatures: np.ndarray, num_bands: int, rows: int) -> np.ndarray:
+    """(n_docs, num_bands) uint64 key of every band of every signature
+
+    Any integer dtype works (int32 k-permutation minima, b-bit uint8 / uint16 values); the first
+    `num_bands * rows` columns are used.
+    """
+    signatures = np.asarray(signatures)
+    n_docs = signatures.shape[0]
+    bands = signatures[:, :num_bands * rows].reshape(n_docs, num_bands, rows).astype(np.int64).view(np.uint64)
+    with np.errstate(over="ignore"):
+        h = np.zeros((n_docs, num_bands), dtype=np.uint64)
+        for i in range(rows):
+            h = h * _FOLD + bands[:, :, i]
+        return mix64(h ^ (np.arange(1, num_bands + 1, dtype=np.uint64) * _BAND))
+
+
+class _Segment:
+    """sorted band keys and their document ids, memory-mapped"""
+
+    def __init__(self, directory: Path, name: str, level: int):
+        self.name = name
+        self.level = level
+        self.keys = np.load(directory / f"{name}.keys.npy", mmap_mode="r")
+        self.doc_ids = np.load(directory / f"{name}.docs.npy", mmap_mode="r")
+
+    def __len__(self):
+        return len(self.keys)
+
+
+class LSHIndex:
+    """On-disk LSH index with incremental cluster membership
+
+    Args:
+        path: index directory, created on first use.
+        num_bands, rows: banding of the signatures (see `lsh_params`). Required to create an index, checked
+            against the manifest when opening one.
+        fanout: number of segments of one level merged into one segment of the next.
+        signature_format: what the signatures were computed with (e.g. `leaderboard_create_signature.
+            signature_format`); checked against the manifest when given. Signatures of another format land
+            in unrelated buckets, so an index only holds one.
+    """
+
+    def __init__(self, path, num_bands: int | None = None, rows: int | None = None, fanout: int = 4,
+                 signature_format: str | None = None):
+        self.path = Path(path)
+        manifest_path = self.path / MANIFEST
+        if manifest_path.exists():
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+            for name, value in (("num_bands", num_bands), ("rows", rows), ("signature_format", signature_format)):
+                if value is not None and value != self.manifest.get(name):
+                    raise ValueError(f"{self.path} was built with {name}={self.manifest.get(name)}, not {value}")
+        else:
+            if num_bands is None or rows is None:
+                raise ValueError(f"num_bands and rows are required to create an index at {self.path}")
+            self.path.mkdir(parents=True, exist_ok=True)
+            self.manifest = {"num_bands": num_bands, "rows": rows, "fanout": fanout, "n_docs": 0,
+                             "parent_capacity": 0, "next_segment": 0, "segments": [], "sources": {},
+                             "signature_format": signature_format}
+        self.num_bands = self.manifest["num_bands"]
+        self.rows = self.manifest["rows"]
+        self.segments = [_Segment(self.path, s["name"], s["level"]) for s in self.manifest["segments"]]
+        self._parent = None
+        if (self.path / DIRTY).exists():
+            self._rebuild_parent()
+
+    def __len__(self) -> int:
+        return self.manifest["n_docs"]
+
+    @property
+    def signature_format(self) -> str | None:
+        """format of the indexed signatures; None for an index created without one"""
+        return self.manifest.get("signature_format")
+
+    @signature_format.setter
+    def signature_format(self, value: str | None) -> None:
+        if len(self):
+            raise ValueError(f"{self.path} already holds signatures of format {self.signature_format}")
+        # committed with the manifest of the next `add`
+        self.manifest["signature_format"] = value
+
+    @property
+    def sources(self) -> dict:
+        """source name -> (first document id, number of documents), in the order they were added"""
+        return {name: tuple(ids) for name, ids in self.manifest["sources"].items()}
+
+    # ---- segments ----
+
+    def _write_segment(self, keys: np.ndarray, doc_ids: np.ndarray, level: int) -> _Segment:
+        name = f"seg_{self.manifest['next_segment']:06d}"
+        self.manifest["next_segment"] += 1
+        for suffix, array in ((".keys.npy", keys), (".docs.npy", doc_ids)):
+            tmp = self.path / f"{name}{suffix}.tmp"
+            with open(tmp, "wb") as f:
+                np.save(f, array)
+            os.replace(tmp, self.path / f"{name}{suffix}")
+        return _Segment(self.path, name, level)
+
+    def _merge(self) -> list[str]:
+        """merge full levels; return the names of the segments that were replaced"""
+        replaced = []
+        fanout = self.manifest["fanout"]
+        level = 0
+        while True:
+            same_level = [s for s in self.segments if s.level == level]
+            if not same_level:
+                break
+            if len(same_level) >= fanout:
+                keys = np.concatenate([s.keys for s in same_level])
+                doc_ids = np.concatenate([s.doc_ids for s in same_level])
+                order = np.argsort(keys, kind="stable")
+                merged = self._write_segment(keys[order], doc_ids[order], level + 1)
+                self.segments = [s for s in self.segments if s.level != level] + [merged]
+                replaced.extend(s.name for s in same_level)
+            level += 1
+        return replaced
+
+    def _lookup(self, keys: np.ndarray):
+        """per segment: (segment, first position of every key, number of matches of every key)"""
+        for segment in self.segments:
+            lo = np.searchsorted(segment.keys, keys, side="left")
+            hi = np.searchsorted(segment.keys, keys, side="right")
+            yield segment, lo, hi - lo
+
+    # ---- union-find ----
+
+    @property
+    def parent(self) -> np.ndarray:
+        if self._parent is None and self.manifest["parent_capacity"]:
+            self._parent = np.load(self.path / PARENT, mmap_mode="r+")
+        return self._parent
+
+    def _grow_parent(self, n_docs: int) -> None:
+        capacity = self.manifest["parent_capacity"]
+        if n_docs <= capacity:
+            return
+        new_capacity = max(n_docs, 2 * capacity, 1024)
+        parent = np.lib.format.open_memmap(self.path / f"{PARENT}.tmp", mode="w+", dtype=np.int64,
+                                           shape=(new_capacity,))
+        if capacity:
+            parent[:capacity] = self.parent
+        parent[capacity:] = np.arange(capacity, new_capacity)
+        parent.flush()
+        del parent
+        self._parent = None
+        os.replace(self.path / f"{PARENT}.tmp", self.path / PARENT)
+        self.manifest["parent_capacity"] = new_capacity
+
+    def _find(self, x: int) -> int:
+        parent = self.parent
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]  # path halving
+            x = parent[x]
+        return int(x)
+
+    def _union(self, a: np.ndarray, b: np.ndarray) -> None:
+        # the smaller id becomes the root, so a cluster's root is its earliest document
+        parent = self.parent
+        for x, y in zip(a.tolist(), b.tolist()):
+            root_x, root_y = self._find(x), self._find(y)
+            if root_x != root_y:
+                parent[max(root_x, root_y)] = min(root_x, root_y)
+
+    def _rebuild_parent(self) -> None:
+        """recompute the union-find from the committed segments (after a crash during `add`)"""
+        if self.parent is not None:
+            self.parent[:] = np.arange(len(self.parent))
+            # `insert` doesn't cluster: a pair is unioned only if its later document was added by `add`
+            clustered = np.ones(len(self), dtype=bool)
+            for first_id, n in self.manifest.get("unclustered", []):
+                clustered[first_id:first_id + n] = False
+
+            def union(a, b):
+                keep = clustered[np.maximum(a, b)]
+                self._union(a[keep], b[keep])
+
+            for i, segment in enumerate(self.segments):
+                keys, doc_ids = np.asarray(segment.keys), np.asarray(segment.doc_ids)
+                same = np.flatnonzero(keys[1:] == keys[:-1])
+                union(doc_ids[same], doc_ids[same + 1])
+                # one document per posting list of every earlier segment
+                for other in self.segments[:i]:
+                    lo = np.searchsorted(other.keys, keys, side="left")
+                    found = lo < len(other)
+                    found[found] = np.asarray(other.keys)[lo[found]] == keys[found]
+                    union(doc_ids[found], np.asarray(other.doc_ids)[lo[found]])
+            self.parent.flush()
+        (self.path / DIRTY).unlink()
+
+    def cluster_ids(self, doc_ids) -> np.ndarray:
+        """root (= smallest document id) of the cluster of every document"""
+        return np.array([self._find(x) for x in np.asarray(doc_ids).tolist()], dtype=np.int64)
+
+    def clusters(self, keep_singletons: bool = True) -> list[set[int]]:
+        """all clusters as sets of document ids, like `merge_overlapping_sets`"""
+        n_docs = len(self)
+        if n_docs == 0:
+            return []
+        parent = np.array(self.parent[:n_docs])
+        # pointer jumping: every pass halves the distance of each document to its root
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+        order = np.argsort(parent, kind="stable")
+        starts = np.flatnonzero(np.r_[True, np.diff(parent[order]) != 0])
+        groups = np.split(order, starts[1:])
+        return [set(group.tolist()) for group in groups if keep_singletons or len(group) > 1]
+
+    # ---- public API ----
+
+    def query(self, signatures: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """candidate pairs of new signatures with indexed documents: (row in `signatures`, document id)
+
+        Every pair that shares at least one band is returned once.
+        """
+        keys = band_keys(signatures, self.num_bands, self.rows)
+        rows = np.repeat(np.arange(len(keys)), self.num_bands)
+        keys = keys.ravel()
+        query_rows, doc_ids = [], []
+        for segment, lo, count in self._lookup(keys):
+            total = int(count.sum())
+            if total == 0:
+                continue
+            offsets = np.arange(total) - np.repeat(np.cumsum(count) - count, count)
+            query_rows.append(np.repeat(rows, count))
+            doc_ids.append(np.asarray(segment.doc_ids)[np.repeat(lo, count) + offsets])
+        if not query_rows:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        pairs = np.unique(np.stack([np.concatenate(query_rows), np.concatenate(doc_ids)], axis=1), axis=0)
+        return pairs[:, 0], pairs[:, 1]
+
+    def insert(self, signatures: np.ndarray, source: str | None = None) -> np.ndarray:
+        """add signatures to the index without clustering them; return their document ids"""
+        return self.add(signatures, source, cluster=False)
+
+    def add(self, signatures: np.ndarray, source: str | None = None, cluster: bool = True) -> np.ndarray:
+        """index new signatures and merge them into the clusters of the documents they share a band with
+
+        Returns the document ids assigned to `signatures`, consecutive from `len(self)`.
+        """
+        if source is not None and source in self.manifest["sources"]:
+            raise ValueError(f"{source} is already in {self.path}")
+        signatures = np.asarray(signatures)
+        n_new = len(signatures)
+        first_id = len(self)
+        doc_ids = np.arange(first_id, first_id + n_new, dtype=np.int64)
+        if n_new == 0:
+            return doc_ids
+        keys = band_keys(signatures, self.num_bands, self.rows).ravel()
+        key_docs = np.repeat(doc_ids, self.num_bands)
+        order = np.argsort(keys, kind="stable")
+        keys, key_docs = keys[order], key_docs[order]
+
+        # unions below aren't committed until the manifest is; see "recovery" at the top of the file
+        (self.path / DIRTY).touch()
+        self._grow_parent(first_id + n_new)
+        if cluster:
+            # within the batch: consecutive equal keys
+            same = np.flatnonzero(keys[1:] == keys[:-1])
+            self._union(key_docs[same], key_docs[same + 1])
+            # against the index: one document per posting list is enough (see the top of the file)
+            for segment, lo, count in self._lookup(keys):
+                found = count > 0
+                self._union(key_docs[found], np.asarray(segment.doc_ids)[lo[found]])
+            self.parent.flush()
+
+        self.segments.append(self._write_segment(keys, key_docs, level=0))
+        replaced = self._merge()
+        self.manifest["n_docs"] = first_id + n_new
+        if not cluster:
+            self.manifest.setdefault("unclustered", []).append([first_id, n_new])
+        if source is not None:
+            self.manifest["sources"][source] = [first_id, n_new]
+        self._save_manifest()
+        (self.path / DIRTY).unlink()
+        for name in replaced:
+            for suffix in (".keys.npy", ".docs.npy"):
+                (self.path / f"{name}{suffix}").unlink(missing_ok=True)
+        return doc_ids
+
+    def _save_manifest(self) -> None:
+        self.manifest["segments"] = [{"name": s.name, "level": s.level, "n_keys": len(s)} for s in self.segments]
+        tmp = self.path / f"{MANIFEST}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(self.manifest, f, indent=2)
+        os.replace(tmp, self.path / MANIFEST)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmark incremental LSH index inserts on random signatures')
+    parser.add_argument('path', type=str, help='Index directory (should not exist yet)')
+    parser.add_argument('--n-batches', type=int, default=16)
+    parser.add_argument('--batch-docs', type=int, default=50_000)
+    parser.add_argument('--num-bands', type=int, default=17)
+    parser.add_argument('--rows', type=int, default=15)
+    parser.add_argument('--duplicate-rate', type=float, default=0.1,
+                        help='Fraction of every batch copied from earlier batches')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    index = LSHIndex(args.path, args.num_bands, args.rows)
+    width = args.num_bands * args.rows
+    history = []
+    for batch in range(args.n_batches):
+        signatures = rng.integers(0, 2**16, size=(args.batch_docs, width), dtype=np.uint16)
+        if history:
+            n_dup = int(args.batch_docs * args.duplicate_rate)
+            old = np.concatenate(history)
+            signatures[:n_dup] = old[rng.integers(0, len(old), size=n_dup)]
+        history.append(signatures)
+        start = time.perf_counter()
+        doc_ids = index.add(signatures, source=f"batch_{batch:04d}")
+        elapsed = time.perf_counter() - start
+        n_old_dup = int(np.sum(index.cluster_ids(doc_ids) < doc_ids[0]))
+        print(f"batch {batch:3d}: {len(index):>10} docs, {len(index.segments):2d} segments, "
+              f"{n_old_dup:>7} duplicates of earlier batches, {elapsed:6.2f}s")
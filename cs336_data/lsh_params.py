@@ -0,0 +1,127 @@
+import json
+import argparse
+from dataclasses import dataclass, asdict
+
+import numpy as np
+
+# Pick the MinHash LSH banding (num_bands x rows) for a target Jaccard threshold.
+#
+# With b bands of r rows, two documents with Jaccard similarity s become candidates with probability
+#     P(s) = 1 - (1 - s^r)^b
+# an S-curve whose steepest point sits near (1/b)^(1/r). Below the threshold t the area under P is the
+# false-positive mass, above it the area over P is the false-negative mass:
+#     FP = integral_0^t P(s) ds        FN = integral_t^1 (1 - P(s)) ds
+# `optimal_lsh_params` minimizes fp_weight * FP + fn_weight * FN over all b * r <= hash budget.
+# Every hash costs signature time and storage per document, so among (near-)equal costs the smallest
+# b * r wins.
+
+
+@dataclass
+class LSHParams:
+    num_bands: int
+    rows: int
+    threshold: float
+    false_positive: float
+    false_negative: float
+
+    @property
+    def num_hashes(self) -> int:
+        return self.num_bands * self.rows
+
+    def candidate_probability(self, similarity):
+        return collision_probability(similarity, self.num_bands, self.rows)
+
+    def save(self, path):
+        with open(path, "w") as f:
+            json.dump({**asdict(self), "num_hashes": self.num_hashes}, f, indent=2)
+
+    @classmethod
+    def load(cls, path) -> "LSHParams":
+        with open(path) as f:
+            params = json.load(f)
+        params.pop("num_hashes", None)
+        return cls(**params)
+
+
+def collision_probability(similarity, num_bands: int, rows: int):
+    """probability that a pair with Jaccard `similarity` shares at least one band"""
+    # 1 - (1 - s^r)^b, written to stay accurate when s^r is tiny
+    with np.errstate(divide="ignore"):
+        return -np.expm1(num_bands * np.log1p(-np.asarray(similarity, dtype=np.float64) ** rows))
+
+
+def _integrate(fn, lo: float, hi: float, n_points: int = 1001) -> float:
+    s = np.linspace(lo, hi, n_points)
+    y = fn(s)
+    return float(np.sum((y[1:] + y[:-1]) * np.diff(s)) / 2)
+
+
+def false_positive_mass(threshold: float, num_bands: int, rows: int) -> float:
+    return _integrate(lambda s: collision_probability(s, num_bands, rows), 0.0, threshold)
+
+
+def false_negative_mass(threshold: float, num_bands: int, rows: int) -> float:
+    return _integrate(lambda s: 1 - collision_probability(s, num_bands, rows), threshold, 1.0)
+
+
+def optimal_lsh_params(threshold: float, max_hashes: int, fp_weight: float = 0.5, fn_weight: float = 0.5,
+                       tolerance: float = 1e-4) -> LSHParams:
+    """(num_bands, rows) with num_bands * rows <= `max_hashes` minimizing the weighted FP / FN mass
+
+    Candidates within `tolerance` of the best weighted error are considered equal and the one with
+    the fewest hashes is returned.
+    """
+    candidates = []
+    for num_bands in range(1, max_hashes + 1):
+        for rows in range(1, max_hashes // num_bands + 1):
+            fp = false_positive_mass(threshold, num_bands, rows)
+            fn = false_negative_mass(threshold, num_bands, rows)
+            candidates.append((fp_weight * fp + fn_weight * fn, num_bands * rows, num_bands, rows, fp, fn))
+    best_error = min(c[0] for c in candidates)
+    _, _, num_bands, rows, fp, fn = min((c for c in candidates if c[0] <= best_error + tolerance),
+                                        key=lambda c: (c[1], c[0]))
+    return LSHParams(num_bands, rows, threshold, fp, fn)
+
+
+def describe(params: LSHParams, background_similarity: float | None = None) -> str:
+    lines = [
+        f"num_bands={params.num_bands} rows={params.rows} ({params.num_hashes} hashes)",
+        f"S-curve midpoint (1/b)^(1/r) = {(1 / params.num_bands) ** (1 / params.rows):.3f}, "
+        f"target threshold {params.threshold}",
+        f"false-positive mass {params.false_positive:.4f}, false-negative mass {params.false_negative:.4f}",
+        "candidate probability by Jaccard similarity:",
+    ]
+    for s in (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 0.95):
+        lines.append(f"  s={s:.2f}  {params.candidate_probability(s):.4f}")
+    if background_similarity is not None:
+        lines.append(f"expected candidate rate of unrelated pairs (s={background_similarity}): "
+                     f"{params.candidate_probability(background_similarity):.2e}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Choose MinHash LSH bands x rows for a Jaccard threshold')
+    parser.add_argument('--threshold', type=float, default=0.8, help='Target Jaccard similarity')
+    parser.add_argument('--max-hashes', type=int, default=256, help='Hash budget (bands x rows)')
+    parser.add_argument('--fp-weight', type=float, default=0.5)
+    parser.add_argument('--fn-weight', type=float, default=0.5)
+    parser.add_argument('--tolerance', type=float, default=1e-4,
+                        help='Settings within this weighted error of the best count as equal; the fewest hashes win')
+    parser.add_argument('--background-similarity', type=float, default=0.05,
+                        help='Typical similarity of unrelated documents, for the expected candidate rate')
+    parser.add_argument('--compare', type=str, nargs='*', default=['150x16'],
+                        help='Other settings (BANDSxROWS) to print for comparison')
+    parser.add_argument('--output', type=str, default=None,
+                        help='Write the chosen parameters as JSON, for create_signature / get_clusters')
+    args = parser.parse_args()
+
+    params = optimal_lsh_params(args.threshold, args.max_hashes, args.fp_weight, args.fn_weight, args.tolerance)
+    print(describe(params, args.background_similarity))
+    for setting in args.compare:
+        num_bands, rows = map(int, setting.split("x"))
+        other = LSHParams(num_bands, rows, args.threshold, false_positive_mass(args.threshold, num_bands, rows),
+                          false_negative_mass(args.threshold, num_bands, rows))
+        print(f"\nfor comparison:\n{describe(other, args.background_similarity)}")
+    if args.output:
+        params.save(args.output)
+        print(f"\nSaved to {args.output}")
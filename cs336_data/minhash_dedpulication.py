@@ -6,8 +6,13 @@ import mmh3
 import random
 import shutil
 
+from cs336_data.minhash_signatures import document_signature
+from cs336_data.text_normalization import normalize_words
+
 # `normalize_text`: punctuation removed, text lowercased, NFD unicode normalization applied, accents removed, whitespace is normalized.
 # `minhashing` and `get_signature`: requires arguments `num_hashes`, `ngrams`.
+#   Signatures are computed on `normalize_words` + `shingle_hashes` (see `text_normalization`, `minhash_signatures`).
+#   `signature_mode="one_perm"`: one-permutation MinHash; `signature_bits`: b-bit values.
 # `get_candidates` and `get_clusters`: requires arguments `num_bands` and `jaccard_threshold`.
 # `minhash_deduplication`: put all together
 
@@ -40,7 +45,8 @@ def minhashing(doc_words: list[str], ngrams: int, seed: int) -> int:
         minhash = min(hash_32bit, minhash)
     return minhash
 
-def get_signatures(input_files: list[str | PathLike], num_hashes: int, ngrams: int) -> list[list[int]]:
+def get_signatures(input_files: list[str | PathLike], num_hashes: int, ngrams: int,
+                   signature_mode: str = "k_perm", signature_bits: int | None = None) -> list[list[int]]:
     """num_hashes minhashing of each doc"""
     signatures = []
     seeds = [random.randint(0, 2**32-1) for _ in range(num_hashes)]
@@ -48,28 +54,14 @@ def get_signatures(input_files: list[str | PathLike], num_hashes: int, ngrams: i
     for file_path in input_files:
         with open(file_path) as f:
             doc = f.read()
-        doc_words = normalize_text(doc)
-
-        signature = [minhashing(doc_words, ngrams, seed) for seed in seeds]
-        signatures.append(signature)
+        signatures.append(document_signature(doc, seeds, ngrams, signature_mode, signature_bits).tolist())
     return signatures
 
-# faster solution would be run all hashes for the same ngram at inner loop
+# faster solution: all hashes of a block of ngrams at once, see `minhash_signatures.k_perm_signature`
 def get_signature_fast(file_path, seeds, ngrams):
     """Process a single file's signatures"""
-    file_signatures = []
     with open(file_path) as f:
-        doc_words = normalize_text(f.read())
-        
-        signature = [float("inf")] * len(seeds)
-        for i in range(len(doc_words) - ngrams):
-            ngram_str = " ".join(doc_words[i:i+ngrams])
-            for j, seed in enumerate(seeds):
-                hash_val = mmh3.hash(ngram_str, seed)
-                signature[j] = min(signature[j], hash_val)
-        
-        file_signatures.append(signature)
-    return file_signatures
+        return [document_signature(f.read(), seeds, ngrams, "k_perm").tolist()]
 
 
 # this is O(n**2) which is bad
@@ -110,17 +102,18 @@ def get_clusters(input_files: list[str | PathLike], candidates: list[tuple[int]]
     for fid_0, fid_1 in candidates:
         with open(input_files[fid_0]) as f:
             doc_0 = f.read()
-            doc_words_0 = normalize_text(doc_0)
+            doc_words_0 = normalize_words(doc_0)
         with open(input_files[fid_1]) as f:
             doc_1 = f.read()
-            doc_words_1 = normalize_text(doc_1)
+            doc_words_1 = normalize_words(doc_1)
 
         if get_jaccard_similarity(doc_words_0, doc_words_1) > jaccard_threshold:
             clusters.append((fid_0, fid_1))
     return clusters
 
-def minhash_deduplication(input_files: list[str | PathLike], output_directory: str | PathLike, num_hashes: str, ngrams: str, num_bands: str, jaccard_threshold: float = 0.8):
-    signatures = get_signatures(input_files, num_hashes, ngrams)
+def minhash_deduplication(input_files: list[str | PathLike], output_directory: str | PathLike, num_hashes: str, ngrams: str, num_bands: str, jaccard_threshold: float = 0.8,
+                          signature_mode: str = "k_perm", signature_bits: int | None = None):
+    signatures = get_signatures(input_files, num_hashes, ngrams, signature_mode, signature_bits)
     candidates = get_candidates(signatures, num_bands)
     clusters = get_clusters(input_files, candidates, jaccard_threshold)
 
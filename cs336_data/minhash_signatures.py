@@ -0,0 +1,201 @@
+import time
+import random
+import argparse
+from pathlib import Path
+
+import numpy as np
+
+from cs336_data.text_normalization import mix64, normalize_words, shingle_hashes
+
+# One-permutation MinHash (OPH) with optimal densification, and b-bit signature storage.
+#
+# k-permutation MinHash hashes every shingle k times and keeps k minima: O(k) per shingle. OPH hashes every
+# shingle once, uses the high bits of the hash to pick one of k bins and keeps the minimum of the low bits
+# per bin: O(1) per shingle, and two documents agree in a bin with probability ~ their Jaccard similarity.
+#
+# Short documents leave bins empty. Optimal densification (Shrivastava, ICML 2017) fills every empty bin i
+# from a non-empty one: probe bins h(i, 1), h(i, 2), ... until one was filled by a shingle and copy its value.
+# The probe sequence depends only on (i, attempt, seed), so it is the same for every document, which is what
+# keeps the estimator unbiased.
+#
+# b-bit storage keeps the lowest `bits` bits of every value (uint8 / uint16 instead of 4-byte ints). Unrelated
+# values then collide with probability 2^-bits, which `estimate_jaccard` corrects for:
+#     P(match) = J + (1 - J) 2^-bits   =>   J = (P(match) - 2^-bits) / (1 - 2^-bits)
+#
+# `k_perm_signature` is the classic k-permutation MinHash over the same shingle hashes: every seed is one
+# hash function (splitmix64 of the shingle hash xor the seed), vectorized over a block of shingles x all
+# seeds. Both modes see a document shorter than `ngrams` words as one shingle and an empty document as no
+# shingle at all (the all-0xFFFFFFFF signature).
+#
+# `python -m cs336_data.minhash_signatures` compares both on the fuzzy-duplicate fixtures and on synthetic
+# document pairs.
+
+SIGNATURE_MODES = ("k_perm", "one_perm")
+
+_EMPTY = np.uint32(0xFFFFFFFF)
+# odd multipliers for the densification probe hash
+_PROBE_BIN = np.uint64(0x9E3779B97F4A7C15)
+_PROBE_ATTEMPT = np.uint64(0xC2B2AE3D27D4EB4F)
+# spreads 32-bit k-permutation seeds over all 64 bits
+_SEED_MULT = np.uint64(0x9E3779B97F4A7C15)
+# shingles x seeds hashed at once by `k_perm_signature`
+_K_PERM_BLOCK = 1 << 20
+
+
+def _to_bin(h: np.ndarray, num_bins: int) -> np.ndarray:
+    """high 32 bits of `h` mapped onto [0, num_bins) by a multiply-shift"""
+    return ((h >> np.uint64(32)) * np.uint64(num_bins)) >> np.uint64(32)
+
+
+def one_permutation_signature(shingles: np.ndarray, num_bins: int, seed: int) -> np.ndarray:
+    """densified one-permutation MinHash of 64-bit shingle hashes, as `num_bins` uint32 values
+
+    A document without shingles gets the all-0xFFFFFFFF signature.
+    """
+    seed = np.uint64(seed)
+    signature = np.full(num_bins, _EMPTY, dtype=np.uint32)
+    if len(shingles) == 0:
+        return signature
+    with np.errstate(over="ignore"):
+        h = mix64(shingles ^ seed)
+        bins = _to_bin(h, num_bins).astype(np.intp)
+        np.minimum.at(signature, bins, (h & np.uint64(0xFFFFFFFF)).astype(np.uint32))
+        filled = np.zeros(num_bins, dtype=bool)
+        filled[bins] = True
+
+        # optimal densification: only bins filled by a shingle are copied from
+        todo = np.flatnonzero(~filled)
+        attempt = 0
+        while len(todo):
+            attempt += 1
+            probe = _to_bin(mix64(todo.astype(np.uint64) * _PROBE_BIN + np.uint64(attempt) * _PROBE_ATTEMPT ^ seed),
+                            num_bins).astype(np.intp)
+            hit = filled[probe]
+            signature[todo[hit]] = signature[probe[hit]]
+            todo = todo[~hit]
+    return signature
+
+
+def k_perm_signature(shingles: np.ndarray, seeds) -> np.ndarray:
+    """k-permutation MinHash of 64-bit shingle hashes: per seed, the minimum seeded 32-bit hash, as uint32
+
+    A document without shingles gets the all-0xFFFFFFFF signature.
+    """
+    signature = np.full(len(seeds), _EMPTY, dtype=np.uint32)
+    with np.errstate(over="ignore"):
+        seeds = np.asarray(seeds, dtype=np.uint64) * _SEED_MULT
+        block = max(1, _K_PERM_BLOCK // max(len(seeds), 1))
+        for start in range(0, len(shingles), block):
+            h = mix64(shingles[start:start + block, None] ^ seeds[None, :])
+            np.minimum(signature, (h & np.uint64(0xFFFFFFFF)).astype(np.uint32).min(axis=0), out=signature)
+    return signature
+
+
+def signature_dtype(bits: int | None):
+    """smallest unsigned dtype that holds `bits`-bit values; None keeps full 32-bit values"""
+    if bits is None or bits > 16:
+        return np.uint32
+    return np.uint16 if bits > 8 else np.uint8
+
+
+def truncate_bits(signature, bits: int | None) -> np.ndarray:
+    """lowest `bits` bits of every value, in the narrowest dtype (b-bit MinHash)
+
+    Works for uint32 signatures and for the signed 32-bit `mmh3.hash` minima of older k-permutation
+    signatures, whose empty positions are `inf`; those become 0xFFFFFFFF like empty uint32 positions.
+    """
+    signature = np.asarray(signature)
+    if signature.dtype.kind == "f":
+        signature = np.where(np.isfinite(signature), signature, float(_EMPTY))
+    values = signature.astype(np.int64) & ((1 << (bits or 32)) - 1)
+    return values.astype(signature_dtype(bits))
+
+
+def estimate_jaccard(signature_a: np.ndarray, signature_b: np.ndarray, bits: int | None = None) -> float:
+    """Jaccard similarity estimate from the fraction of agreeing positions, corrected for b-bit collisions"""
+    match = float(np.mean(np.asarray(signature_a) == np.asarray(signature_b)))
+    if bits is None or bits >= 32:
+        return match
+    collision = 2.0 ** -bits
+    return max(0.0, (match - collision) / (1 - collision))
+
+
+def document_signature(text: str, seeds: list[int], ngrams: int, mode: str = "one_perm",
+                       bits: int | None = None) -> np.ndarray:
+    """signature of a document with `len(seeds)` values, truncated to `bits` bits
+
+    mode "k_perm" uses one hash function per seed, "one_perm" fills `len(seeds)` bins seeded by `seeds[0]`.
+    """
+    shingles = shingle_hashes(normalize_words(text), ngrams)
+    if mode == "one_perm":
+        signature = one_permutation_signature(shingles, len(seeds), seeds[0])
+    elif mode == "k_perm":
+        signature = k_perm_signature(shingles, seeds)
+    else:
+        raise ValueError(f"Unknown signature mode {mode!r}, expected one of {SIGNATURE_MODES}")
+    return truncate_bits(signature, bits)
+
+
+def _synthetic_pairs(n_pairs: int, n_words: int, rng: random.Random):
+    """document pairs with Jaccard similarities spread over [0, 1]: a random word sequence and a copy with
+    a random fraction of its words replaced"""
+    vocab = [f"w{i}" for i in range(50_000)]
+    pairs = []
+    for _ in range(n_pairs):
+        words = rng.choices(vocab, k=n_words)
+        edited = list(words)
+        for i in rng.sample(range(n_words), int(n_words * rng.random() * 0.3)):
+            edited[i] = rng.choice(vocab)
+        pairs.append((" ".join(words), " ".join(edited)))
+    return pairs
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Accuracy and speed of one-permutation / b-bit MinHash signatures')
+    parser.add_argument('--num-hashes', type=int, default=256)
+    parser.add_argument('--ngrams', type=int, default=5)
+    parser.add_argument('--n-pairs', type=int, default=200, help='Synthetic document pairs')
+    parser.add_argument('--n-words', type=int, default=500, help='Words per synthetic document')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    k_perm_seeds = [rng.randint(0, 2**32 - 1) for _ in range(args.num_hashes)]
+    oph_seed = rng.randint(0, 2**64 - 1)
+    methods = {
+        "k_perm": lambda words: k_perm_signature(shingle_hashes(words, args.ngrams), k_perm_seeds),
+        "k_perm 16-bit": lambda words: truncate_bits(
+            k_perm_signature(shingle_hashes(words, args.ngrams), k_perm_seeds), 16),
+        "one_perm": lambda words: one_permutation_signature(shingle_hashes(words, args.ngrams), args.num_hashes,
+                                                            oph_seed),
+        "one_perm 16-bit": lambda words: truncate_bits(
+            one_permutation_signature(shingle_hashes(words, args.ngrams), args.num_hashes, oph_seed), 16),
+        "one_perm 8-bit": lambda words: truncate_bits(
+            one_permutation_signature(shingle_hashes(words, args.ngrams), args.num_hashes, oph_seed), 8),
+    }
+    method_bits = {"k_perm": None, "k_perm 16-bit": 16, "one_perm": None, "one_perm 16-bit": 16, "one_perm 8-bit": 8}
+
+    def true_jaccard(words_a, words_b):
+        a, b = set(shingle_hashes(words_a, args.ngrams).tolist()), set(shingle_hashes(words_b, args.ngrams).tolist())
+        return len(a & b) / len(a | b) if a | b else 1.0
+
+    def report(name, pairs):
+        words = [(normalize_words(a), normalize_words(b)) for a, b in pairs]
+        truth = np.array([true_jaccard(a, b) for a, b in words])
+        print(f"\n{name}: {len(pairs)} pairs, true Jaccard {truth.min():.2f}-{truth.max():.2f}, "
+              f"{args.num_hashes} hashes, {args.ngrams}-grams")
+        print(f"{'method':<18}{'bytes/doc':>10}{'mean |err|':>12}{'max |err|':>11}{'ms/doc':>9}")
+        for method, signature_fn in methods.items():
+            start = time.perf_counter()
+            signatures = [(signature_fn(a), signature_fn(b)) for a, b in words]
+            elapsed = time.perf_counter() - start
+            estimates = np.array([estimate_jaccard(a, b, method_bits[method]) for a, b in signatures])
+            errors = np.abs(estimates - truth)
+            n_bytes = signatures[0][0].astype(signature_dtype(method_bits[method])).nbytes
+            print(f"{method:<18}{n_bytes:>10}{errors.mean():>12.4f}{errors.max():>11.4f}"
+                  f"{elapsed * 1000 / (2 * len(pairs)):>9.2f}")
+
+    fixtures = Path(__file__).parent.parent / "tests" / "fixtures" / "documents_with_fuzzy_duplicates"
+    texts = [path.read_text() for path in sorted(fixtures.glob("*.txt"))]
+    report("documents_with_fuzzy_duplicates", [(a, b) for i, a in enumerate(texts) for b in texts[i + 1:]])
+    report("synthetic", _synthetic_pairs(args.n_pairs, args.n_words, rng))
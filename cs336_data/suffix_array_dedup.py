@@ -0,0 +1,311 @@
+import os
+import math
+import time
+import argparse
+import concurrent.futures
+from pathlib import Path
+
+import numpy as np
+
+from cs336_data.cpus import available_cpus
+
+# Exact-substring deduplication of a uint16 token stream (`CC_filtered_tokens.bin`) with a suffix array.
+#
+# Two positions start the same `min_length`-token span iff their suffixes share a prefix of `min_length`
+# tokens, i.e. they are neighbours in the suffix array sorted by that prefix. Only that prefix matters, so
+# the suffix array is truncated to it: suffixes with the same `min_length` tokens are ordered by position.
+# Every position whose span occurred at a smaller position is a duplicate start, and the union of
+# [start, start + min_length) over all duplicate starts is removed (the first occurrence stays).
+#
+# Construction runs in bounded memory, in four passes:
+#   1. chunks      the stream is cut into `chunk_tokens` chunks (+ min_length - 1 tokens of overlap); every
+#                  chunk's truncated suffix array is built by prefix doubling on integer ranks (rank of the
+#                  1-, 2-, 4-, ... token prefix; the last round combines two overlapping power-of-two prefixes
+#                  into exactly min_length), one chunk per worker process
+#   2. splitters   a regular sample of every chunk suffix array gives (prefix, position) splitters that cut
+#                  the global order into buckets of ~`bucket_suffixes` suffixes; each chunk array is split
+#                  at them by a vectorized binary search. Splitting on (prefix, position) keeps buckets
+#                  balanced even for a span that repeats millions of times
+#   3. buckets     every bucket merges its slices of all chunk arrays (a sort of their fixed-width prefix
+#                  keys), writes its part of the global suffix array and the duplicate starts it contains,
+#                  one bucket per worker process
+#   4. removal     the stream is rewritten chunk by chunk without the duplicate spans
+#
+# Peak memory per worker is O(chunk_tokens) words in pass 1 and O(bucket_suffixes * min_length) bytes in
+# pass 3 (`worker_memory`), so the number of workers is bounded by the memory budget as well as by the CPUs.
+# Disk use in `work_dir` is ~16 bytes per token (chunk arrays, then the global array).
+#
+# `keep_token` (the EOS token) is never removed, so documents stay separated.
+
+TOKEN_DTYPE = np.uint16
+GPT2_EOS = 50256
+# pass 1 peak per chunk token: int32 ranks, their int64 pair keys, the argsort order and the sorted copy
+CHUNK_BYTES_PER_TOKEN = 30
+# fraction of the available memory used when no budget is given
+DEFAULT_MEMORY_FRACTION = 0.8
+
+
+def open_tokens(path) -> np.ndarray:
+    return np.memmap(path, dtype=TOKEN_DTYPE, mode="r")
+
+
+def prefix_keys(tokens: np.ndarray, positions: np.ndarray, min_length: int) -> np.ndarray:
+    """the `min_length` tokens at every position as fixed-width byte strings, which order like the spans"""
+    # one row copy per position from a strided window view; big-endian so bytewise order is numeric order
+    windows = np.lib.stride_tricks.sliding_window_view(tokens, min_length)
+    keys = windows[np.asarray(positions, dtype=np.int64)].astype(">u2")
+    return keys.view(f"S{2 * min_length}").ravel()
+
+
+def _combine(rank: np.ndarray, offset: int) -> np.ndarray:
+    """dense rank of the pairs (rank[i], rank[i + offset]), 0 past the end"""
+    second = np.zeros_like(rank)
+    second[:len(rank) - offset] = rank[offset:]
+    new_group = np.empty(len(rank), dtype=bool)
+    new_group[0] = True
+    if rank.dtype == np.int32:
+        # both ranks fit in one 64-bit key: one argsort instead of a two-key lexsort
+        pair = (rank.astype(np.int64) << 32) | second
+        order = np.argsort(pair)
+        pair = pair[order]
+        new_group[1:] = pair[1:] != pair[:-1]
+    else:
+        order = np.lexsort((second, rank))
+        first_sorted, second_sorted = rank[order], second[order]
+        new_group[1:] = (first_sorted[1:] != first_sorted[:-1]) | (second_sorted[1:] != second_sorted[:-1])
+    combined = np.empty_like(rank)
+    combined[order] = np.cumsum(new_group)
+    return combined
+
+
+def chunk_suffix_array(tokens: np.ndarray, start: int, end: int, min_length: int) -> np.ndarray:
+    """global positions in [start, end) sorted by their `min_length`-token prefix, then by position
+
+    Positions whose span would run past the end of the stream are left out.
+    """
+    n_valid = min(end, len(tokens) - min_length + 1) - start
+    if n_valid <= 0:
+        return np.zeros(0, dtype=np.uint64)
+    # ranks start at 1: 0 is "past the end of the chunk", only reached by positions that are left out
+    n_ranked = n_valid + min_length - 1
+    rank_dtype = np.int32 if n_ranked < np.iinfo(np.int32).max else np.int64
+    rank = tokens[start:start + n_ranked].astype(rank_dtype) + 1
+    k = 1
+    while 2 * k <= min_length:
+        rank = _combine(rank, k)
+        k *= 2
+    if k < min_length:
+        # [i, i + k) and [i + min_length - k, i + min_length) overlap and cover the whole span
+        rank = _combine(rank, min_length - k)
+    return (np.argsort(rank[:n_valid], kind="stable") + start).astype(np.uint64)
+
+
+def worker_memory(chunk_tokens: int, bucket_suffixes: int, min_length: int) -> int:
+    """estimated peak bytes of one worker: a chunk suffix array in pass 1 or a bucket merge in pass 3"""
+    # a bucket holds positions, keys (2 * min_length bytes, built through a copy of the same size), the argsort
+    # order and sorted copies of both
+    bucket_bytes = (4 * min_length + 24) * bucket_suffixes
+    return max(CHUNK_BYTES_PER_TOKEN * (chunk_tokens + min_length), bucket_bytes)
+
+
+def available_memory() -> int:
+    """bytes of memory available to new processes: MemAvailable on Linux, physical memory elsewhere"""
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+
+
+def default_workers(chunk_tokens: int, bucket_suffixes: int, min_length: int, memory_budget: int | None = None) -> int:
+    """as many workers as there are CPUs and as fit in `memory_budget` bytes (default: 80% of the available
+    memory), at least one"""
+    if memory_budget is None:
+        memory_budget = int(available_memory() * DEFAULT_MEMORY_FRACTION)
+    n_fit = memory_budget // worker_memory(chunk_tokens, bucket_suffixes, min_length)
+    return max(1, min(available_cpus(), n_fit))
+
+
+def _precedes(keys, positions, split_keys, split_positions) -> np.ndarray:
+    return (keys < split_keys) | ((keys == split_keys) & (positions < split_positions))
+
+
+def split_points(tokens, suffix_array, split_keys, split_positions, min_length) -> np.ndarray:
+    """for every (key, position) splitter, the number of entries of `suffix_array` that precede it"""
+    lo = np.zeros(len(split_keys), dtype=np.int64)
+    hi = np.full(len(split_keys), len(suffix_array), dtype=np.int64)
+    active = lo < hi
+    while active.any():
+        mid = (lo[active] + hi[active]) // 2
+        positions = np.asarray(suffix_array[mid], dtype=np.int64)
+        before = _precedes(prefix_keys(tokens, positions, min_length), positions,
+                           split_keys[active], split_positions[active])
+        lo[active] = np.where(before, mid + 1, lo[active])
+        hi[active] = np.where(before, hi[active], mid)
+        active = lo < hi
+    return lo
+
+
+# ---- worker tasks ----
+
+def _build_chunk(tokens_path, start, end, min_length, output_path) -> int:
+    suffix_array = chunk_suffix_array(open_tokens(tokens_path), start, end, min_length)
+    np.save(output_path, suffix_array)
+    return len(suffix_array)
+
+
+def _merge_bucket(tokens_path, chunk_paths, slices, predecessors, offset, min_length, sa_path, dups_path) -> int:
+    """merge one bucket; write its suffix array part and its duplicate starts; return the number of them"""
+    tokens = open_tokens(tokens_path)
+    # chunks are in position order and each slice is sorted, so a stable sort keeps equal spans by position
+    positions = np.concatenate([np.load(path, mmap_mode="r")[lo:hi] for path, (lo, hi) in zip(chunk_paths, slices)])
+    keys = prefix_keys(tokens, positions, min_length)
+    order = np.argsort(keys, kind="stable")
+    positions, keys = positions[order], keys[order]
+
+    suffix_array = np.load(sa_path, mmap_mode="r+")
+    suffix_array[offset:offset + len(positions)] = positions
+    suffix_array.flush()
+
+    duplicate = np.zeros(len(positions), dtype=bool)
+    duplicate[1:] = keys[1:] == keys[:-1]
+    # the first span of the bucket may continue a group of the previous bucket
+    if len(positions) and len(predecessors):
+        duplicate[0] = bool(np.any(prefix_keys(tokens, predecessors, min_length) == keys[0]))
+    np.save(dups_path, np.sort(positions[duplicate]))
+    return int(duplicate.sum())
+
+
+def removal_mask(tokens: np.ndarray, start: int, end: int, duplicate_starts: np.ndarray, min_length: int,
+                 keep_token: int | None = None) -> np.ndarray:
+    """True for the tokens in [start, end) covered by a duplicate span"""
+    coverage = np.zeros(end - start + 1, dtype=np.int32)
+    starts = np.asarray(duplicate_starts, dtype=np.int64)
+    np.add.at(coverage, np.clip(starts, start, end) - start, 1)
+    np.add.at(coverage, np.clip(starts + min_length, start, end) - start, -1)
+    mask = np.cumsum(coverage[:-1]) > 0
+    if keep_token is not None:
+        mask &= tokens[start:end] != keep_token
+    return mask
+
+
+def deduplicate_tokens(tokens_path, output_path, work_dir, min_length: int = 50, chunk_tokens: int = 1 << 26,
+                       bucket_suffixes: int = 1 << 24, n_workers: int | None = None,
+                       keep_token: int | None = GPT2_EOS, sample_stride: int = 4096,
+                       memory_budget: int | None = None) -> dict:
+    """Remove every repeated span of at least `min_length` tokens but its first occurrence
+
+    Writes the deduplicated stream to `output_path` and the truncated suffix array to
+    `work_dir/suffix_array.npy`; returns statistics. Without `n_workers`, the number of workers is derived
+    from `memory_budget` (bytes, see `default_workers`).
+    """
+    work_dir = Path(work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    tokens = open_tokens(tokens_path)
+    n_tokens = len(tokens)
+    n_workers = n_workers or default_workers(chunk_tokens, bucket_suffixes, min_length, memory_budget)
+    chunks = [(start, min(start + chunk_tokens, n_tokens)) for start in range(0, n_tokens, chunk_tokens)]
+    chunk_paths = [work_dir / f"chunk_{i:05d}.sa.npy" for i in range(len(chunks))]
+    timings = {}
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+        # 1. chunk suffix arrays
+        t0 = time.perf_counter()
+        futures = [executor.submit(_build_chunk, tokens_path, start, end, min_length, path)
+                   for (start, end), path in zip(chunks, chunk_paths)]
+        n_suffixes = sum(future.result() for future in futures)
+        timings["chunks"] = time.perf_counter() - t0
+
+        # 2. splitters: every `sample_stride`-th suffix of every chunk, in (key, position) order
+        t0 = time.perf_counter()
+        chunk_arrays = [np.load(path, mmap_mode="r") for path in chunk_paths]
+        stride = max(1, min(sample_stride, bucket_suffixes // 8))
+        sample = np.sort(np.concatenate([np.asarray(sa[::stride], dtype=np.int64) for sa in chunk_arrays]
+                                        or [np.zeros(0, dtype=np.int64)]))
+        sample_keys = prefix_keys(tokens, sample, min_length)
+        order = np.argsort(sample_keys, kind="stable")
+        sample, sample_keys = sample[order], sample_keys[order]
+        n_buckets = max(1, min(math.ceil(n_suffixes / bucket_suffixes), len(sample)))
+        picks = np.unique((np.arange(1, n_buckets) * len(sample)) // n_buckets)
+        split_positions, split_keys = sample[picks], sample_keys[picks]
+        # bounds[c] = [0, split points..., len(chunk c)]
+        bounds = [np.r_[0, split_points(tokens, sa, split_keys, split_positions, min_length), len(sa)]
+                  for sa in chunk_arrays]
+        timings["splitters"] = time.perf_counter() - t0
+
+        # 3. bucket merges
+        t0 = time.perf_counter()
+        sa_path = work_dir / "suffix_array.npy"
+        np.lib.format.open_memmap(sa_path, mode="w+", dtype=np.uint64, shape=(n_suffixes,)).flush()
+        futures, offset = [], 0
+        dups_paths = [work_dir / f"dups_{b:05d}.npy" for b in range(len(picks) + 1)]
+        for b, dups_path in enumerate(dups_paths):
+            slices = [(int(bound[b]), int(bound[b + 1])) for bound in bounds]
+            predecessors = np.array([sa[lo - 1] for sa, (lo, _) in zip(chunk_arrays, slices) if lo > 0],
+                                    dtype=np.int64)
+            futures.append(executor.submit(_merge_bucket, tokens_path, chunk_paths, slices, predecessors, offset,
+                                           min_length, sa_path, dups_path))
+            offset += sum(hi - lo for lo, hi in slices)
+        n_duplicate_starts = sum(future.result() for future in futures)
+        timings["buckets"] = time.perf_counter() - t0
+    del chunk_arrays
+    for path in chunk_paths:
+        path.unlink()
+
+    # 4. rewrite without the duplicate spans
+    t0 = time.perf_counter()
+    dups = [np.load(path, mmap_mode="r") for path in dups_paths]
+    n_removed = 0
+    tmp_path = Path(f"{output_path}.tmp")
+    with open(tmp_path, "wb") as out:
+        for start, end in chunks:
+            # spans starting up to min_length - 1 tokens before the chunk reach into it
+            first = max(start - min_length + 1, 0)
+            starts = np.concatenate([d[np.searchsorted(d, first):np.searchsorted(d, end)]
+                                     for d in dups] or [np.zeros(0, dtype=np.uint64)])
+            mask = removal_mask(tokens, start, end, starts, min_length, keep_token)
+            n_removed += int(mask.sum())
+            np.asarray(tokens[start:end])[~mask].tofile(out)
+    os.replace(tmp_path, output_path)
+    timings["removal"] = time.perf_counter() - t0
+    for path in dups_paths:
+        path.unlink()
+
+    return {"tokens": n_tokens, "removed": n_removed, "duplicate_starts": n_duplicate_starts,
+            "chunks": len(chunks), "buckets": len(dups_paths), "workers": n_workers, "timings": timings}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Remove repeated token spans with a suffix array')
+    parser.add_argument('--input', type=str, default="/home/azureuser/mount/CC_filtered_tokens.bin")
+    parser.add_argument('--output', type=str, default="/home/azureuser/mount/CC_filtered_tokens_dedup.bin")
+    parser.add_argument('--work-dir', type=str, default="/home/azureuser/mount/suffix_array")
+    parser.add_argument('--min-length', type=int, default=50, help='Shortest repeated span removed, in tokens')
+    parser.add_argument('--chunk-tokens', type=int, default=1 << 26,
+                        help='Tokens per chunk suffix array (~30 bytes of memory per token per worker)')
+    parser.add_argument('--bucket-suffixes', type=int, default=1 << 24,
+                        help='Suffixes per merge bucket (~4 * min-length bytes of memory each per worker)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Worker processes; by default as many as there are CPUs and as fit in --memory-budget')
+    parser.add_argument('--memory-budget', type=float, default=None,
+                        help=f'GB of memory for all workers together (default: {DEFAULT_MEMORY_FRACTION:.0%} of the '
+                             f'available memory)')
+    parser.add_argument('--keep-suffix-array', action='store_true', help='Keep suffix_array.npy in --work-dir')
+    args = parser.parse_args()
+
+    memory_budget = int(args.memory_budget * 1024**3) if args.memory_budget is not None else None
+    per_worker = worker_memory(args.chunk_tokens, args.bucket_suffixes, args.min_length)
+    n_workers = args.workers or default_workers(args.chunk_tokens, args.bucket_suffixes, args.min_length,
+                                                memory_budget)
+    print(f"{n_workers} workers, ~{per_worker / 1024**3:.1f} GB each")
+    stats = deduplicate_tokens(args.input, args.output, args.work_dir, args.min_length, args.chunk_tokens,
+                               args.bucket_suffixes, n_workers)
+    if not args.keep_suffix_array:
+        (Path(args.work_dir) / "suffix_array.npy").unlink()
+    print(f"{stats['tokens']:,} tokens, {stats['chunks']} chunks, {stats['buckets']} buckets")
+    print(f"Removed {stats['removed']:,} tokens ({stats['removed'] / max(stats['tokens'], 1):.2%}) "
+          f"in spans of >= {args.min_length} tokens")
+    print("Time (s): " + ", ".join(f"{name} {seconds:.1f}" for name, seconds in stats["timings"].items()))
@@ -0,0 +1,110 @@
+import sys
+import time
+import string
+import argparse
+import unicodedata
+from pathlib import Path
+
+import mmh3
+import numpy as np
+
+# Fast equivalent of `minhash_dedpulication.normalize_text`, plus shingle hashing.
+#
+# `normalize_text` loops over every character in Python (`in string.punctuation`, then an NFD + `combining`
+# generator). Here every step is a C-level pass over the whole text, with precomputed tables:
+#   1. ASCII punctuation -> " ", ASCII lowercase     `bytes.translate` on the UTF-8 encoding with a
+#                                                     256-byte table (ASCII bytes never occur inside
+#                                                     multi-byte UTF-8 sequences)
+#   2. lowercase the rest                            `str.lower`, whole-string: Greek final sigma is contextual
+#   3. NFD + drop combining marks                    `unicodedata.normalize`, then a NumPy gather over a
+#                                                     per-code-point mask
+#   4. split on whitespace                           `str.split`, same characters as `re.split(r"\s+")` but
+#                                                     without the empty tokens at the edges
+# Steps 2-3 only run on text that isn't pure ASCII. `str.translate` with a dict is a per-character
+# dict lookup for non-ASCII strings, which is why it isn't used for steps 1 and 3.
+#
+# `shingle_hashes` hashes every word once and combines the word hashes of each n-gram with a polynomial
+# rolling hash in NumPy, so no n-gram string is ever joined.
+
+_BYTE_TABLE = bytes(
+    ord(" ") if chr(i) in string.punctuation else ord(chr(i).lower()) if i < 128 else i for i in range(256)
+)
+# False for combining marks (`unicodedata.combining(c) != 0`)
+_KEEP_CODEPOINT = np.array([not unicodedata.combining(chr(c)) for c in range(sys.maxunicode + 1)], dtype=bool)
+
+
+def normalize_words(text: str) -> list[str]:
+    """`normalize_text(text)` without the empty strings it returns at the edges"""
+    text = text.encode("utf-8", "surrogatepass").translate(_BYTE_TABLE).decode("utf-8", "surrogatepass")
+    if not text.isascii():
+        text = unicodedata.normalize("NFD", text.lower())
+        codepoints = np.frombuffer(text.encode("utf-32-le", "surrogatepass"), dtype=np.uint32)
+        text = codepoints[_KEEP_CODEPOINT[codepoints]].tobytes().decode("utf-32-le", "surrogatepass")
+    return text.split()
+
+
+# odd 64-bit multiplier for combining word hashes
+_SHINGLE_PRIME = np.uint64(0x100000001B3)
+
+
+def mix64(h: np.ndarray) -> np.ndarray:
+    """splitmix64 finalizer: spreads a 64-bit hash over all 64 bits. Shingle hashes, k-permutation signatures,
+    LSH band keys and the decontamination Bloom filter all depend on its exact output"""
+    h = (h ^ (h >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    h = (h ^ (h >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return h ^ (h >> np.uint64(31))
+
+
+def word_hashes(words: list[str]) -> np.ndarray:
+    return np.fromiter((mmh3.hash64(word, signed=False)[0] for word in words), dtype=np.uint64, count=len(words))
+
+
+def shingle_hashes(words: list[str], ngrams: int) -> np.ndarray:
+    """64-bit hash of every `ngrams`-word shingle (`len(words) - ngrams + 1` of them), in order
+
+    A document shorter than `ngrams` words is a single shingle.
+    """
+    hashes = word_hashes(words)
+    if len(hashes) == 0:
+        return hashes
+    n = min(ngrams, len(hashes))
+    n_shingles = len(hashes) - n + 1
+    with np.errstate(over="ignore"):
+        shingles = hashes[:n_shingles].copy()
+        for k in range(1, n):
+            shingles = shingles * _SHINGLE_PRIME + hashes[k:k + n_shingles]
+        return mix64(shingles)
+
+
+if __name__ == "__main__":
+    from cs336_data.minhash_dedpulication import normalize_text
+
+    parser = argparse.ArgumentParser(description='Benchmark normalize_words against normalize_text (MB/s)')
+    parser.add_argument('inputs', nargs='*', help='Text files; defaults to the test fixtures')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--ngrams', type=int, default=5)
+    args = parser.parse_args()
+
+    fixtures = Path(__file__).parent.parent / "tests" / "fixtures"
+    paths = [Path(p) for p in args.inputs] or sorted(fixtures.rglob("*.txt"))
+    texts = [p.read_text(errors="ignore") for p in paths]
+    n_mb = sum(len(t.encode("utf-8")) for t in texts) / 1024**2
+    print(f"{len(texts)} documents, {n_mb:.2f} MB")
+
+    mismatches = sum(normalize_words(t) != [w for w in normalize_text(t) if w] for t in texts)
+    print(f"Parity with normalize_text: {len(texts) - mismatches}/{len(texts)} documents identical")
+
+    def bench(name, fn):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for t in texts:
+                fn(t)
+        elapsed = (time.perf_counter() - start) / args.repeat
+        print(f"{name:<40} {n_mb / elapsed:8.1f} MB/s")
+
+    bench("normalize_text", normalize_text)
+    bench("normalize_words", normalize_words)
+    bench(f"normalize_text + join {args.ngrams}-grams",
+          lambda t: [" ".join(w[i:i + args.ngrams]) for w in [normalize_text(t)] for i in range(len(w) - args.ngrams)])
+    bench(f"normalize_words + shingle_hashes({args.ngrams})", lambda t: shingle_hashes(normalize_words(t), args.ngrams))
+    sys.exit(1 if mismatches else 0)
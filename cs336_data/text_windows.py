@@ -0,0 +1,177 @@
+import time
+import zlib
+import random
+import argparse
+from dataclasses import dataclass
+from pathlib import Path
+
+# Classifier input windows.
+#
+# fastText cost is linear in the input length, and a few giant pages (Gopher keeps up to 2e5 words)
+# dominate classifier time. A window cuts every document down to at most `n_chars` characters before
+# langid / nsfw / toxic see it:
+#   full        the whole text (no window)
+#   head        the first `n_chars`
+#   head_tail   the first and the last `n_chars // 2`
+#   spans       `n_spans` non-overlapping spans of `n_chars // n_spans` at random positions (seeded by the
+#               document's content, so reruns give the same predictions)
+#
+# `python -m cs336_data.text_windows` measures how often each window agrees with the full-text
+# prediction on a sample of filtered documents, and how much classifier time it saves.
+
+WINDOW_STRATEGIES = ("full", "head", "head_tail", "spans")
+# spec of each strategy, for `TextWindow.parse`
+WINDOW_SPECS = {"full": "full", "head": "head:N", "head_tail": "head_tail:N", "spans": "spans:K:N"}
+
+
+@dataclass(frozen=True)
+class TextWindow:
+    strategy: str = "full"
+    n_chars: int = 2000
+    n_spans: int = 4
+    seed: int = 0
+
+    def __post_init__(self):
+        if self.strategy not in WINDOW_STRATEGIES:
+            raise ValueError(f"Unknown window strategy {self.strategy!r}, expected one of {WINDOW_STRATEGIES}")
+        if self.strategy == "spans" and not 1 <= self.n_spans <= self.n_chars:
+            raise ValueError(f"spans window needs 1 <= n_spans <= n_chars, got {self.n_spans} spans of "
+                             f"{self.n_chars} chars")
+
+    @classmethod
+    def parse(cls, spec: str) -> "TextWindow":
+        """`full`, `head:N`, `head_tail:N` or `spans:K:N` (K spans, N characters in total); without arguments
+        the defaults are used"""
+        strategy, *args = spec.split(":")
+        if strategy not in WINDOW_SPECS:
+            raise ValueError(f"Unknown window {spec!r}, expected one of {', '.join(WINDOW_SPECS.values())}")
+        n_args = WINDOW_SPECS[strategy].count(":")
+        if (args and len(args) != n_args) or not all(arg.isdigit() for arg in args):
+            raise ValueError(f"Bad window {spec!r}, expected {WINDOW_SPECS[strategy]}")
+        if not args:
+            return cls(strategy)
+        if strategy == "spans":
+            return cls(strategy, n_chars=int(args[1]), n_spans=int(args[0]))
+        return cls(strategy, n_chars=int(args[0]))
+
+    def __str__(self):
+        if self.strategy == "full":
+            return "full"
+        if self.strategy == "spans":
+            return f"spans:{self.n_spans}:{self.n_chars}"
+        return f"{self.strategy}:{self.n_chars}"
+
+    def __call__(self, text: str) -> str:
+        if self.strategy == "full" or len(text) <= self.n_chars:
+            return text
+        if self.strategy == "head":
+            return text[: self.n_chars]
+        if self.strategy == "head_tail":
+            half = self.n_chars // 2
+            return text[:half] + " " + text[-half:]
+        span_len = self.n_chars // self.n_spans
+        rng = random.Random(self.seed ^ zlib.crc32(text.encode("utf-8", "surrogatepass")))
+        # the characters outside the spans, split into n_spans + 1 gaps: a sorted sample of n_spans distinct
+        # values of range(free + n_spans), minus their rank, is a uniform split
+        free = len(text) - self.n_spans * span_len
+        cuts = sorted(rng.sample(range(free + self.n_spans), self.n_spans))
+        starts = [cut - i + i * span_len for i, cut in enumerate(cuts)]
+        return " ".join(text[start:start + span_len] for start in starts)
+
+
+FULL_TEXT = TextWindow()
+
+
+def classifier_input(text: str, window: TextWindow | None = None) -> str:
+    """what a fastText classifier sees: the windowed text on a single line"""
+    return (window or FULL_TEXT)(text).replace("\n", " ")
+
+
+def _predict(model, texts):
+    labels, scores = model.predict(texts)
+    return [label[0].replace("__label__", "") for label in labels], [score.item() for score in scores]
+
+
+def evaluate_windows(texts, models: dict, thresholds: dict, windows: list[TextWindow]) -> list[dict]:
+    """Agreement of each window with full-text predictions
+
+    For every classifier: `label` is the fraction of documents with the same top label, `decision` the fraction
+    with the same keep / remove outcome at the classifier's threshold (as in `filter_batch`), `speedup` the
+    classifier time on full texts over the time on windows.
+    """
+    def keep(name, label, score):
+        if name == "lang":
+            return label == "en" and score > thresholds[name]
+        return label.startswith("non-") and score > thresholds[name]
+
+    reference = {}
+    for name, model in models.items():
+        start = time.perf_counter()
+        labels, scores = _predict(model, [classifier_input(text) for text in texts])
+        reference[name] = (labels, scores, time.perf_counter() - start)
+
+    results = []
+    for window in windows:
+        result = {"window": str(window)}
+        for name, model in models.items():
+            ref_labels, ref_scores, ref_time = reference[name]
+            start = time.perf_counter()
+            labels, scores = _predict(model, [classifier_input(text, window) for text in texts])
+            elapsed = time.perf_counter() - start
+            n = max(len(texts), 1)
+            result[f"{name}_label"] = sum(a == b for a, b in zip(labels, ref_labels)) / n
+            result[f"{name}_decision"] = sum(
+                keep(name, *a) == keep(name, *b) for a, b in zip(zip(labels, scores), zip(ref_labels, ref_scores))
+            ) / n
+            result[f"{name}_speedup"] = ref_time / max(elapsed, 1e-9)
+        results.append(result)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Agreement of classifier input windows with full-text predictions')
+    parser.add_argument('inputs', nargs='+', help='.jsonl files or .jsonl.zst shards to sample documents from')
+    parser.add_argument('--n-docs', type=int, default=10000, help='Sample size')
+    parser.add_argument('--min-chars', type=int, default=0,
+                        help='Only sample documents at least this long (windows only change long documents)')
+    parser.add_argument('--windows', nargs='+',
+                        default=['head:1000', 'head:2000', 'head_tail:2000', 'head_tail:4000', 'spans:4:2000'],
+                        help='full, head:N, head_tail:N or spans:K:N')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    from cs336_data.document_shards import iter_documents
+    # loads the classifiers
+    from cs336_data.leaderboard_process_wet import (
+        model_lang, model_nsfw, model_toxic, SCORE_LANG, SCORE_NSFW, SCORE_TOXIC
+    )
+
+    # reservoir sample, so inputs of any size stream through once
+    rng = random.Random(args.seed)
+    texts, n_seen = [], 0
+    for path in args.inputs:
+        for record in iter_documents(Path(path)):
+            if len(record["text"]) < args.min_chars:
+                continue
+            n_seen += 1
+            if len(texts) < args.n_docs:
+                texts.append(record["text"])
+            elif (j := rng.randrange(n_seen)) < args.n_docs:
+                texts[j] = record["text"]
+    mean_chars = sum(map(len, texts)) / max(len(texts), 1)
+    print(f"Sampled {len(texts)} of {n_seen} documents, mean length {mean_chars:.0f} chars")
+
+    results = evaluate_windows(
+        texts,
+        {"lang": model_lang, "nsfw": model_nsfw, "toxic": model_toxic},
+        {"lang": SCORE_LANG, "nsfw": SCORE_NSFW, "toxic": SCORE_TOXIC},
+        [TextWindow.parse(spec) for spec in args.windows],
+    )
+    header = f"{'window':<16}" + "".join(f"{name + ' label':>13}{name + ' keep':>12}{name + ' x':>9}"
+                                          for name in ("lang", "nsfw", "toxic"))
+    print(header)
+    for result in results:
+        print(f"{result['window']:<16}" + "".join(
+            f"{result[f'{name}_label']:>13.2%}{result[f'{name}_decision']:>12.2%}{result[f'{name}_speedup']:>9.1f}"
+            for name in ("lang", "nsfw", "toxic")
+        ))
@@ -0,0 +1,240 @@
+import os
+import uuid
+import sqlite3
+import argparse
+from pathlib import Path
+from collections import OrderedDict
+
+import mmh3
+import numpy as np
+
+from cs336_basics.data import SHARD_SUFFIX, ShardWriter, open_shard
+
+# Content-addressed cache of tokenized documents: 128-bit hash of the text -> span of its tokens in a shard store.
+#
+# Changing a filter threshold or the dedup survivors changes which documents are kept, but nearly all of them
+# were tokenized by the previous run. With the cache a rerun tokenizes only the documents it hasn't seen and
+# copies the rest out of the store.
+#
+# Layout of the cache directory:
+#   index.sqlite       spans(key, shard, start, length), in WAL mode so every worker of a pool can use it
+#   shards/<id>.tok    token shards (`cs336_basics.data` format) holding the cached documents back to back
+#
+# Every writer (one per process) appends new documents to its own shard and records their spans only once the
+# shard is closed, so the index never points into a partial file. A writer rolls over to a new shard after
+# `shard_tokens` tokens or on `flush`.
+#
+# Output is assembled with `copy`: consecutive documents whose spans are adjacent in the same store shard
+# (the common case, since the previous run wrote them in the same order) are merged into one run and copied
+# with large sequential reads. At most `max_open_shards` store shards stay mapped (least recently used ones
+# are dropped), so a store of many small shards doesn't run out of file descriptors.
+#
+# Tokens depend on the tokenizer, which goes into `namespace` together with the text.
+#
+# Hits and misses are counted in memory and added to the shared `counters` row by `save_counters` (called by
+# `stats` and `close`), so lookups stay read-only and workers don't serialize on the row.
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS spans (
+    key BLOB PRIMARY KEY,
+    shard TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    length INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER NOT NULL);
+INSERT OR IGNORE INTO counters VALUES ('hits', 0), ('misses', 0);
+"""
+
+# keys per `SELECT ... IN (...)`, below sqlite's host parameter limit
+_LOOKUP_BATCH = 500
+# tokens per read when copying a run
+_COPY_TOKENS = 1 << 23
+
+
+def coalesce(spans):
+    """merge consecutive (shard, start, length) spans that are adjacent in the same shard into
+    (shard, start, stop) runs"""
+    run = None
+    for shard, start, length in spans:
+        if run is not None and run[0] == shard and run[2] == start:
+            run[2] = start + length
+            continue
+        if run is not None:
+            yield tuple(run)
+        run = [shard, start, start + length]
+    if run is not None:
+        yield tuple(run)
+
+
+class TokenCache:
+    """sqlite index + token shard store: document text -> tokens
+
+    Args:
+        path: cache directory, shared by all processes.
+        vocab_size: vocabulary of the tokenizer, recorded in the store shards.
+        eos_id: end-of-text id of the tokenizer.
+        namespace: everything the tokens depend on (the tokenizer name).
+        shard_tokens: tokens per store shard before a writer starts a new one.
+        max_open_shards: store shards kept memory-mapped at once, per process.
+    """
+
+    def __init__(self, path, vocab_size: int, eos_id: int | None = None, namespace: str = "",
+                 shard_tokens: int = 1 << 28, max_open_shards: int = 64):
+        self.path = Path(path)
+        (self.path / "shards").mkdir(parents=True, exist_ok=True)
+        self.vocab_size = vocab_size
+        self.eos_id = eos_id
+        self.namespace = namespace.encode("utf-8")
+        self.shard_tokens = shard_tokens
+        self.max_open_shards = max_open_shards
+        # hits / misses of this process since it opened the cache
+        self.hits = 0
+        self.misses = 0
+        # counted but not yet added to the `counters` table
+        self._unsaved = {"hits": 0, "misses": 0}
+        self._conn = None
+        self._pid = None
+        self._writer = None
+        self._writer_pid = None
+        self._pending = {}
+        # name -> memmap, least recently used first
+        self._shards = OrderedDict()
+
+    def __getstate__(self):
+        # connections, open shards and the writer stay in the process that made them
+        state = self.__dict__.copy()
+        state.update(_conn=None, _pid=None, _writer=None, _writer_pid=None, _pending={}, _shards=OrderedDict(),
+                     _unsaved={"hits": 0, "misses": 0})
+        return state
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path / "index.sqlite", timeout=60)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.executescript(_SCHEMA)
+            self._pid = os.getpid()
+        return self._conn
+
+    def key(self, text: str) -> bytes:
+        return mmh3.hash_bytes(self.namespace + b"\0" + text.encode("utf-8", "surrogatepass"))
+
+    # ---- lookup ----
+
+    def spans(self, texts: list[str]) -> list[tuple | None]:
+        """(shard, start, length) of every text, None where it isn't cached"""
+        keys = [self.key(text) for text in texts]
+        found = {}
+        for batch_start in range(0, len(keys), _LOOKUP_BATCH):
+            batch = keys[batch_start:batch_start + _LOOKUP_BATCH]
+            rows = self.conn.execute(
+                f"SELECT key, shard, start, length FROM spans WHERE key IN ({','.join('?' * len(batch))})", batch
+            ).fetchall()
+            found.update((row[0], row[1:]) for row in rows)
+        spans = [found.get(key) for key in keys]
+        n_hits = sum(span is not None for span in spans)
+        self.hits += n_hits
+        self.misses += len(keys) - n_hits
+        self._unsaved["hits"] += n_hits
+        self._unsaved["misses"] += len(keys) - n_hits
+        return spans
+
+    def shard(self, name: str) -> np.ndarray:
+        if name in self._shards:
+            self._shards.move_to_end(name)
+            return self._shards[name]
+        if len(self._shards) >= self.max_open_shards:
+            # unmapped (and its descriptor closed) once the last view of it is gone
+            self._shards.popitem(last=False)
+        self._shards[name], _ = open_shard(self.path / "shards" / f"{name}{SHARD_SUFFIX}")
+        return self._shards[name]
+
+    def tokens(self, span: tuple) -> np.ndarray:
+        shard, start, length = span
+        return self.shard(shard)[start:start + length]
+
+    def copy(self, spans, writer: ShardWriter) -> int:
+        """write the tokens of `spans` to `writer` in order, one sequential copy per run of adjacent spans;
+        returns the number of runs"""
+        n_runs = 0
+        for shard, start, stop in coalesce(spans):
+            tokens = self.shard(shard)
+            for chunk_start in range(start, stop, _COPY_TOKENS):
+                writer.write(tokens[chunk_start:min(chunk_start + _COPY_TOKENS, stop)])
+            n_runs += 1
+        return n_runs
+
+    # ---- insertion ----
+
+    def add(self, text: str, tokens) -> None:
+        """store the tokens of `text`; they can be looked up after the next `flush`"""
+        if self._writer is not None and self._writer_pid != os.getpid():
+            # inherited through a fork, the shard belongs to the parent
+            self._writer, self._pending = None, {}
+        key = self.key(text)
+        if key in self._pending:
+            return
+        if self._writer is None:
+            self._writer_pid = os.getpid()
+            self._writer = ShardWriter(self.path / "shards" / f"{uuid.uuid4().hex}{SHARD_SUFFIX}",
+                                       self.vocab_size, self.eos_id)
+        start = self._writer.num_tokens
+        self._writer.write(tokens)
+        self._pending[key] = (start, self._writer.num_tokens - start)
+        if self._writer.num_tokens >= self.shard_tokens:
+            self.flush()
+
+    def flush(self) -> None:
+        """close the current store shard and record the spans of its documents"""
+        if self._writer is None:
+            return
+        self._writer.close()
+        name = self._writer.path.name[:-len(SHARD_SUFFIX)]
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO spans VALUES (?, ?, ?, ?)",
+                                  [(key, name, start, length) for key, (start, length) in self._pending.items()])
+        self._writer, self._pending = None, {}
+
+    # ---- bookkeeping ----
+
+    def __len__(self) -> int:
+        return self.conn.execute("SELECT count(*) FROM spans").fetchone()[0]
+
+    def save_counters(self) -> None:
+        """add the hits / misses counted since the last call to the shared counters"""
+        if not any(self._unsaved.values()):
+            return
+        with self.conn:
+            self.conn.executemany("UPDATE counters SET value = value + ? WHERE name = ?",
+                                  [(value, name) for name, value in self._unsaved.items()])
+        self._unsaved = {"hits": 0, "misses": 0}
+
+    def stats(self) -> dict:
+        """lifetime counters of the cache, across all processes and runs (that saved theirs)"""
+        self.save_counters()
+        counters = dict(self.conn.execute("SELECT name, value FROM counters").fetchall())
+        n_tokens = self.conn.execute("SELECT coalesce(sum(length), 0) FROM spans").fetchone()[0]
+        total = counters["hits"] + counters["misses"]
+        return {"entries": len(self), "tokens": n_tokens, "hits": counters["hits"], "misses": counters["misses"],
+                "hit_rate": counters["hits"] / total if total else 0.0}
+
+    def close(self) -> None:
+        self.flush()
+        self.save_counters()
+        self._shards = OrderedDict()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Show a tokenization cache')
+    parser.add_argument('path', type=str, help='cache directory')
+    args = parser.parse_args()
+
+    cache = TokenCache(args.path, vocab_size=0)
+    stats = cache.stats()
+    n_shards = len(list((cache.path / "shards").glob(f"*{SHARD_SUFFIX}")))
+    print(f"{stats['entries']} documents, {stats['tokens']} tokens in {n_shards} shards, "
+          f"{stats['hits']} hits / {stats['misses']} misses (hit rate {stats['hit_rate']:.1%})")
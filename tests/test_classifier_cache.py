@@ -0,0 +1,78 @@
+import multiprocessing
+
+from cs336_data.classifier_cache import ClassifierCache
+
+
+def _put(args):
+    path, worker = args
+    cache = ClassifierCache(path, namespace="test")
+    texts = [f"shared {i}" for i in range(50)] + [f"worker {worker} doc {i}" for i in range(50)]
+    cache.put_many(texts, [("kept", 0.9, 0.95, 0.99)] * len(texts))
+    return len(cache.get_many(texts))
+
+
+def test_cache_roundtrip_namespace_and_stats(tmp_path):
+    path = tmp_path / "cache.sqlite"
+    cache = ClassifierCache(path, namespace="a")
+    assert cache.get_many(["doc one", "doc two"]) == [None, None]
+    cache.put_many(["doc one", "doc two"], [("kept", 0.95, 0.99, 0.98), ("lang", 0.2, None, None)])
+    # line endings and surrounding whitespace don't matter
+    assert cache.get_many(["  doc one\r\n", "doc two", "doc three"]) == [
+        ("kept", 0.95, 0.99, 0.98), ("lang", 0.2, None, None), None
+    ]
+    assert (cache.hits, cache.misses) == (2, 3)
+    # another namespace (e.g. other thresholds) doesn't see these verdicts
+    other = ClassifierCache(path, namespace="b")
+    assert other.get_many(["doc one"]) == [None]
+    # counts reach the file on save / close
+    assert ClassifierCache(path).stats()["misses"] == 0
+    cache.close()
+    other.close()
+    stats = ClassifierCache(path).stats()
+    assert stats["entries"] == 2
+    assert stats["hits"] == 2 and stats["misses"] == 4
+
+
+def test_cache_eviction(tmp_path):
+    cache = ClassifierCache(tmp_path / "cache.sqlite", max_entries=10, evict_every=5)
+    for i in range(30):
+        cache.put_many([f"doc {i}"], [("quality", 0.99, None, None)])
+    assert len(cache) <= 10
+    assert cache.evict() == 0
+
+
+def test_lookups_are_batched(tmp_path):
+    path = tmp_path / "cache.sqlite"
+    cache = ClassifierCache(path, save_every=100)
+    cache.put_many([f"doc {i}" for i in range(10)], [("kept", 0.9, 0.95, 0.99)] * 10)
+    cache.conn.execute("UPDATE verdicts SET last_used = 0")
+    cache.conn.commit()
+    changes = cache.conn.total_changes
+    for _ in range(9):
+        cache.get_many([f"doc {i}" for i in range(5)] + ["missing"] * 5)
+    # lookups don't write
+    assert cache.conn.total_changes == changes
+    assert ClassifierCache(path).stats()["hits"] == 0
+    # the 100th lookup writes the touches and counts in one go
+    cache.get_many([f"doc {i}" for i in range(5)] + ["missing"] * 5)
+    stats = ClassifierCache(path).stats()
+    assert (stats["hits"], stats["misses"]) == (50, 50)
+    last_used = dict(cache.conn.execute("SELECT key, last_used FROM verdicts").fetchall())
+    assert [last_used[cache.key(f"doc {i}")] > 0 for i in range(10)] == [True] * 5 + [False] * 5
+
+
+def test_eviction_keeps_recent_hits(tmp_path):
+    cache = ClassifierCache(tmp_path / "cache.sqlite", max_entries=10)
+    cache.put_many([f"doc {i}" for i in range(20)], [("kept", 0.9, 0.95, 0.99)] * 20)
+    cache.conn.execute("UPDATE verdicts SET last_used = key = ?", (cache.key("doc 0"),))
+    cache.conn.commit()
+    cache.get_many(["doc 19"])
+    cache.evict()
+    assert cache.get_many(["doc 0", "doc 19"]) == [("kept", 0.9, 0.95, 0.99)] * 2
+
+
+def test_cache_shared_across_processes(tmp_path):
+    path = str(tmp_path / "cache.sqlite")
+    with multiprocessing.get_context("spawn").Pool(4) as pool:
+        assert pool.map(_put, [(path, w) for w in range(4)]) == [100] * 4
+    assert len(ClassifierCache(path)) == 50 + 4 * 50
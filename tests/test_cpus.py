@@ -0,0 +1,13 @@
+import os
+
+from cs336_data.cpus import available_cpus
+
+
+def test_available_cpus_without_affinity(monkeypatch):
+    assert available_cpus() >= 1
+    # macOS has no sched_getaffinity
+    monkeypatch.delattr(os, "sched_getaffinity", raising=False)
+    monkeypatch.setattr(os, "cpu_count", lambda: 6)
+    assert available_cpus() == 6
+    monkeypatch.setattr(os, "cpu_count", lambda: None)
+    assert available_cpus() == 1
@@ -0,0 +1,56 @@
+import numpy as np
+
+from cs336_data.decontamination import NgramIndex, ngram_hashes, scan_tokens, write_without_documents
+
+NGRAM = 5
+EOS = 99
+
+
+def _documents(rng, n_docs):
+    return [np.r_[rng.integers(0, 50, size=rng.integers(3, 40)), EOS].astype(np.uint16) for _ in range(n_docs)]
+
+
+def test_ngram_hashes():
+    tokens = np.array([1, 2, 3, 4, 5, 1, 2, 3, 4, 5, EOS, 1, 2, 3, 4, 5], dtype=np.uint16)
+    hashes, valid = ngram_hashes(tokens, NGRAM, separator=EOS)
+    assert len(hashes) == len(tokens) - NGRAM + 1
+    assert hashes[0] == hashes[5] == hashes[11]
+    assert len(set(hashes[:6].tolist())) == 5
+    # windows 6..10 hold the separator
+    assert valid.tolist() == [True] * 6 + [False] * 5 + [True]
+
+
+def test_index_contains(tmp_path):
+    rng = np.random.default_rng(0)
+    members = rng.integers(0, 2**63, size=5000).astype(np.uint64)
+    others = rng.integers(0, 2**63, size=100_000).astype(np.uint64)
+    for num_probes in (1, 3):
+        index = NgramIndex.from_hashes(members, NGRAM, EOS, num_probes=num_probes)
+        index.save(tmp_path / "index")
+        index = NgramIndex.load(tmp_path / "index")
+        assert index.contains(members).all()
+        assert not index.contains(others).any()
+
+
+def test_scan_and_drop(tmp_path):
+    rng = np.random.default_rng(1)
+    evals, train = _documents(rng, 30), _documents(rng, 300)
+    for doc in (3, 77, 150, 299):
+        source = evals[doc % len(evals)]
+        train[doc] = np.r_[rng.integers(0, 50, size=4), source[:-1], EOS].astype(np.uint16)
+    np.concatenate(evals).tofile(tmp_path / "eval.bin")
+    np.concatenate(train).tofile(tmp_path / "train.bin")
+
+    NgramIndex.from_token_files([tmp_path / "eval.bin"], NGRAM, EOS).save(tmp_path / "index")
+    result = scan_tokens(tmp_path / "train.bin", tmp_path / "index", chunk_tokens=257, n_workers=2)
+
+    eval_ngrams = {tuple(doc[i:i + NGRAM]) for doc in evals for i in range(len(doc) - NGRAM)}
+    expected = [sum(tuple(doc[i:i + NGRAM]) in eval_ngrams for i in range(len(doc) - NGRAM)) for doc in train]
+    assert result["hits"].tolist() == expected
+    assert result["windows"].tolist() == [max(len(doc) - NGRAM, 0) for doc in train]
+
+    drop = result["hits"] > 0
+    write_without_documents(tmp_path / "train.bin", tmp_path / "clean.bin", result["starts"], result["ends"], drop,
+                            chunk_tokens=64)
+    kept = np.concatenate([doc for doc, dropped in zip(train, drop) if not dropped])
+    np.testing.assert_array_equal(np.fromfile(tmp_path / "clean.bin", dtype=np.uint16), kept)
@@ -0,0 +1,38 @@
+import json
+
+import zstandard
+
+from cs336_data.document_shards import ShardReader, ShardWriter, iter_documents, read_documents
+
+
+def _records(n):
+    return [{"text": f"document {i}\nsecond line", "url": f"https://example.com/{i}", "record_id": f"<urn:{i}>",
+             "lang_score": 0.95, "non_nsfw_score": 0.99, "non_toxic_score": 0.98} for i in range(n)]
+
+
+def test_shard_roundtrip_and_random_access(tmp_path):
+    records = _records(1000)
+    path = tmp_path / "shard.jsonl.zst"
+    with ShardWriter(path, block_records=64) as writer:
+        for record in records:
+            writer.write(record)
+
+    reader = ShardReader(path)
+    assert len(reader) == 1000
+    assert reader.n_blocks == 16
+    assert list(iter_documents(path)) == records
+    ids = [999, 0, 64, 63, 500, 500]
+    assert read_documents(path, ids) == [records[i] for i in ids]
+    # frames concatenate into one valid zstd stream of plain JSONL
+    with open(path, "rb") as f:
+        text = zstandard.ZstdDecompressor().stream_reader(f).read().decode()
+    assert [json.loads(line) for line in text.splitlines()] == records
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def test_plain_jsonl_readers(tmp_path):
+    records = _records(10)
+    path = tmp_path / "docs.jsonl"
+    path.write_text("".join(json.dumps(r) + "\n" for r in records))
+    assert list(iter_documents(path)) == records
+    assert read_documents(path, [7, 2]) == [records[7], records[2]]
@@ -0,0 +1,58 @@
+import asyncio
+import gzip
+import http.server
+import threading
+
+from cs336_data.leaderboard_download_wet import Downloader
+
+
+class FlakyRangeHandler(http.server.BaseHTTPRequestHandler):
+    """Local stand-in for data.commoncrawl.org: supports Range requests, and cuts off the first
+    response for every file halfway to exercise resuming."""
+
+    files: dict[str, bytes] = {}
+    requests: list[tuple[str, str | None]] = []
+
+    def do_GET(self):
+        range_header = self.headers.get("Range")
+        self.requests.append((self.path, range_header))
+        data = self.files.get(self.path)
+        if data is None:
+            self.send_error(404)
+            return
+        start = int(range_header.removeprefix("bytes=").split("-")[0]) if range_header else 0
+        body = data[start:]
+        self.send_response(206 if range_header else 200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        first_attempt = sum(path == self.path for path, _ in self.requests) == 1
+        self.wfile.write(body[: len(body) // 2] if first_attempt else body)
+        self.close_connection = True
+
+    def log_message(self, *args):
+        pass
+
+
+def test_download_resumes_and_verifies(tmp_path):
+    FlakyRangeHandler.files = {
+        f"/crawl/file{i}.warc.wet.gz": gzip.compress(f"WARC record {i}\n".encode() * 20000) for i in range(3)
+    }
+    FlakyRangeHandler.requests = []
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FlakyRangeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        downloader = Downloader(
+            tmp_path, base_url=f"http://127.0.0.1:{server.server_port}/", concurrency=2, backoff_base=0.01
+        )
+        paths = [p.lstrip("/") for p in FlakyRangeHandler.files] + ["crawl/missing.warc.wet.gz"]
+        n_downloaded = asyncio.run(downloader.run(paths, n_wet=10))
+    finally:
+        server.shutdown()
+
+    assert n_downloaded == 3
+    for path, data in FlakyRangeHandler.files.items():
+        assert (tmp_path / path.split("/")[-1]).read_bytes() == data
+    assert not list(tmp_path.glob("*.part"))
+    assert not (tmp_path / "missing.warc.wet.gz").exists()
+    # every file was cut off once and then resumed from where it stopped
+    assert sum(range_header is not None for _, range_header in FlakyRangeHandler.requests) == 3
@@ -0,0 +1,111 @@
+import os
+import json
+import time
+import multiprocessing
+import concurrent.futures
+
+import pytest
+
+from cs336_data.file_leases import LeaseQueue, run_distributed
+
+TASKS = [f"task_{i:03d}" for i in range(24)]
+
+
+def _work(run_dir, task, crash_on):
+    # stands in for a stage: one output file per task
+    if task == crash_on:
+        os._exit(1)  # the node dies holding the lease
+    time.sleep(0.02)
+    with open(os.path.join(run_dir, "outputs", task), "a") as f:
+        f.write(f"{os.getpid()}\n")
+    return task.upper()
+
+
+def _node(run_dir, crash_on=None, use_executor=False):
+    queue = LeaseQueue(run_dir, TASKS, lease_seconds=1.0, heartbeat_seconds=0.1)
+    tasks = {task: (run_dir, task, crash_on) for task in TASKS}
+    if use_executor:
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            run_distributed(queue, tasks, _work, executor, max_in_flight=2, poll_seconds=0.05)
+    else:
+        run_distributed(queue, tasks, _work, poll_seconds=0.05)
+
+
+def test_nodes_share_tasks(tmp_path):
+    run_dir = str(tmp_path / "run")
+    os.makedirs(os.path.join(run_dir, "outputs"))
+    ctx = multiprocessing.get_context("spawn")
+    nodes = [ctx.Process(target=_node, args=(run_dir, "task_005")),
+             ctx.Process(target=_node, args=(run_dir,)),
+             ctx.Process(target=_node, args=(run_dir, None, True))]
+    for node in nodes:
+        node.start()
+    for node in nodes:
+        node.join(timeout=60)
+    assert sorted(node.exitcode for node in nodes) in ([0, 0, 0], [0, 0, 1])
+
+    # every task ran exactly once, the crashed node's task was taken over after its lease expired
+    assert sorted(os.listdir(os.path.join(run_dir, "outputs"))) == TASKS
+    for task in TASKS:
+        with open(os.path.join(run_dir, "outputs", task)) as f:
+            assert len(f.read().split()) == 1
+    with open(os.path.join(run_dir, "manifest.json")) as f:
+        manifest = json.load(f)
+    assert manifest["done"] == len(TASKS)
+    assert manifest["results"]["task_005"] == "TASK_005"
+    assert os.listdir(os.path.join(run_dir, "leases")) == []
+
+
+def test_claim_and_expiry(tmp_path):
+    a = LeaseQueue(tmp_path, ["x", "y"], lease_seconds=0.5, heartbeat_seconds=10, node_id="a")
+    b = LeaseQueue(tmp_path, ["x", "y"], lease_seconds=0.5, heartbeat_seconds=10, node_id="b")
+    assert a.claim("x")
+    assert not b.claim("x")
+    assert a.owner("x") == "a"
+    time.sleep(1.1)  # a never renews
+    assert b.claim("x")
+    assert b.owner("x") == "b"
+    b.complete("x", {"n": 1})
+    assert not a.claim("x")
+    assert b.pending() == ["y"]
+    assert a.results() == {"x": {"n": 1}}
+    a.close()
+    b.close()
+
+
+def test_task_list_must_match(tmp_path):
+    LeaseQueue(tmp_path, ["x"])
+    with pytest.raises(ValueError):
+        LeaseQueue(tmp_path, ["x", "y"])
+
+
+def _flaky(counts, task):
+    counts[task] = counts.get(task, 0) + 1
+    if task == "flaky" and counts[task] == 1:
+        raise OSError("transient")
+    if task == "broken":
+        raise ValueError("always")
+    return counts[task]
+
+
+def test_failed_task_is_retried(tmp_path):
+    tasks = ["ok", "flaky", "broken"]
+    counts = {}
+    queue = LeaseQueue(tmp_path, tasks, max_attempts=2, node_id="a")
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        results = run_distributed(queue, {task: (counts, task) for task in tasks}, _flaky, executor,
+                                  max_in_flight=2, poll_seconds=0.05)
+    # the transient failure was rerun, the permanent one given up on without being recorded as done
+    assert results == {"ok": 1, "flaky": 2}
+    assert counts["broken"] == 2
+    assert not queue.is_done("broken")
+    assert list(queue.failed()) == ["broken"]
+    with open(tmp_path / "manifest.json") as f:
+        assert "ValueError" in json.load(f)["failed"]["broken"]
+    assert os.listdir(tmp_path / "leases") == []
+
+    # a later run with more attempts picks it up again
+    queue = LeaseQueue(tmp_path, tasks, max_attempts=3, node_id="b")
+    assert queue.pending() == ["broken"]
+    run_distributed(queue, {task: (counts, task) for task in tasks}, _flaky, poll_seconds=0.05)
+    assert counts["broken"] == 3 and counts["ok"] == 1
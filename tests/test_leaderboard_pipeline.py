@@ -0,0 +1,50 @@
+import asyncio
+import concurrent.futures
+import gzip
+import http.server
+import threading
+
+from .test_download_wet import FlakyRangeHandler
+
+
+def _process(wet_path, output_path):
+    # stands in for `process_single_wet_file`
+    with gzip.open(wet_path, "rb") as f, open(output_path, "wb") as out:
+        out.write(f.read()[:10])
+    return output_path
+
+
+def test_rerun_skips_filtered_files(tmp_path):
+    # imported here like in `adapters`: leaderboard_process_wet loads the fastText models on import
+    from cs336_data.leaderboard_pipeline import PipelinedDownloader
+
+    FlakyRangeHandler.files = {
+        f"/crawl/file{i}.warc.wet.gz": gzip.compress(f"WARC record {i}\n".encode() * 20000) for i in range(4)
+    }
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FlakyRangeHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    paths = [p.lstrip("/") for p in FlakyRangeHandler.files]
+
+    def run(n_wet):
+        FlakyRangeHandler.requests = []
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            downloader = PipelinedDownloader(
+                tmp_path / "raw", tmp_path / "filtered", executor, max_pending_bytes=1 << 30, delete_raw=True,
+                process_fn=_process, base_url=f"http://127.0.0.1:{server.server_port}/", concurrency=1,
+                backoff_base=0.01,
+            )
+            n_downloaded = asyncio.run(downloader.run(paths, n_wet))
+        return n_downloaded, downloader
+
+    try:
+        n_downloaded, downloader = run(n_wet=2)
+        assert n_downloaded == 2 and downloader.n_processed == 2
+        # the rerun downloads the next two files instead of the two already filtered ones
+        n_downloaded, downloader = run(n_wet=2)
+    finally:
+        server.shutdown()
+
+    assert n_downloaded == 2 and downloader.n_processed == 2
+    assert {path for path, _ in FlakyRangeHandler.requests} == {"/crawl/file2.warc.wet.gz", "/crawl/file3.warc.wet.gz"}
+    assert sorted(p.name for p in (tmp_path / "filtered").iterdir()) == [f"file{i}.jsonl" for i in range(4)]
+    assert list((tmp_path / "raw").iterdir()) == []
@@ -0,0 +1,94 @@
+from collections import Counter
+
+import numpy as np
+
+from cs336_data.document_shards import find_document_files, iter_documents, open_writer
+from cs336_data.leaderboard_line_frequency_filter import (
+    CountMinSketch, build_sketch_for_shard, filter_file, hash_lines, line_frequency_filter, normalize_line,
+)
+
+BOILERPLATE = ["Accept all cookies", "Home | About | Contact", "Copyright 2024 Example Inc."]
+
+
+def _word(i):
+    # digits are normalized away, letters aren't
+    return "".join("abcdefghij"[int(digit)] for digit in str(i))
+
+
+def _records(n):
+    # every document has its own lines, the first boilerplate line is in all of them and the others in some
+    return [{"text": "\n".join([f"Story {_word(i)} starts here.", BOILERPLATE[0], f"It ends with {_word(7 * i)}!"]
+                               + BOILERPLATE[1:1 + i % 3]),
+             "url": f"https://example.com/{i}", "lang_score": 0.9} for i in range(n)]
+
+
+def _write(path, records):
+    with open_writer(path) as writer:
+        for record in records:
+            writer.write(record)
+
+
+def _document_frequencies(records):
+    return Counter(line for record in records
+                   for line in {normalize_line(line) for line in record["text"].split("\n") if line.strip()})
+
+
+def test_second_hash_is_odd():
+    _, h2 = hash_lines([f"line {i}" for i in range(1000)])
+    assert (h2 & np.uint64(1)).all()
+
+
+def test_sketch_estimates_document_frequencies(tmp_path):
+    records = _records(300)
+    _write(tmp_path / "docs.jsonl", records)
+    exact = _document_frequencies(records)
+
+    lines = list(exact)
+    true = np.array([exact[line] for line in lines])
+    # wide enough for no collisions: exact counts
+    build_sketch_for_shard([tmp_path / "docs.jsonl"], tmp_path / "wide.npy", width_bits=16, depth=4)
+    sketch = CountMinSketch.load(tmp_path / "wide.npy")
+    assert sketch.total == true.sum()
+    np.testing.assert_array_equal(sketch.estimate(*hash_lines(lines)), true)
+
+    # narrow: never below the true count, and within the error bound for almost all lines
+    build_sketch_for_shard([tmp_path / "docs.jsonl"], tmp_path / "narrow.npy", width_bits=7, depth=4)
+    sketch = CountMinSketch.load(tmp_path / "narrow.npy")
+    estimates = sketch.estimate(*hash_lines(lines))
+    assert (estimates >= true).all()
+    error, failure_prob = sketch.error_bound()
+    assert np.mean(estimates - true > error) <= 2 * failure_prob
+
+
+def test_filter_file_drops_frequent_lines(tmp_path):
+    records = _records(30) + [{"text": BOILERPLATE[0], "url": "https://example.com/banner", "lang_score": 0.5}]
+    _write(tmp_path / "docs.jsonl", records)
+    build_sketch_for_shard([tmp_path / "docs.jsonl"], tmp_path / "sketch.npy", width_bits=16, depth=4)
+
+    # the boilerplate lines are in 31, 20 and 10 documents
+    n_lines, n_removed, n_emptied = filter_file(tmp_path / "docs.jsonl", tmp_path / "out.jsonl",
+                                                tmp_path / "sketch.npy", threshold=15)
+    out = list(iter_documents(tmp_path / "out.jsonl"))
+    assert n_lines == sum(len(record["text"].split("\n")) for record in records)
+    assert n_removed == 31 + 20
+    # the banner-only document is dropped, the others keep their fields and only lose the frequent lines
+    assert n_emptied == 1
+    assert len(out) == 30
+    for record, kept in zip(records, out):
+        assert kept == {**record, "text": "\n".join(line for line in record["text"].split("\n")
+                                                    if line not in BOILERPLATE[:2])}
+
+
+def test_filter_reads_and_writes_shards(tmp_path):
+    records = _records(40)
+    (tmp_path / "in").mkdir()
+    _write(tmp_path / "in" / "a.jsonl", records[:20])
+    _write(tmp_path / "in" / "b.jsonl.zst", records[20:])
+    line_frequency_filter(find_document_files(tmp_path / "in"), tmp_path / "out", tmp_path / "work", threshold=35,
+                          width_bits=16, n_workers=2)
+
+    assert [path.name for path in find_document_files(tmp_path / "out")] == ["a.jsonl", "b.jsonl.zst"]
+    out = list(iter_documents(tmp_path / "out" / "a.jsonl")) + list(iter_documents(tmp_path / "out" / "b.jsonl.zst"))
+    assert [record["url"] for record in out] == [record["url"] for record in records]
+    assert not any(BOILERPLATE[0] in record["text"] for record in out)
+    assert all(f"Story {_word(i)} " in record["text"] for i, record in enumerate(out))
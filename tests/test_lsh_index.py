@@ -0,0 +1,174 @@
+import json
+
+import numpy as np
+import pytest
+
+from cs336_data.leaderboard_create_signature import (
+    get_signatures_parallel_incremental, make_seeds, read_batch_format, signature_batch, signature_format,
+)
+from cs336_data.leaderboard_get_clusters import check_signature_format, index_clusters, update_index
+from cs336_data.lsh_index import LSHIndex, band_keys
+
+
+def _signatures(rng, n, width=12):
+    return rng.integers(0, 2**16, size=(n, width), dtype=np.uint16)
+
+
+def test_band_keys():
+    rng = np.random.default_rng(0)
+    sigs = _signatures(rng, 5)
+    keys = band_keys(sigs, num_bands=4, rows=3)
+    assert keys.shape == (5, 4) and keys.dtype == np.uint64
+    # same band values in different bands give different keys
+    same = np.tile(sigs[:1, :3], (1, 4))
+    assert len(set(band_keys(same, 4, 3)[0].tolist())) == 4
+    np.testing.assert_array_equal(band_keys(sigs.astype(np.int32), 4, 3), keys)
+
+
+def test_incremental_clusters(tmp_path):
+    rng = np.random.default_rng(1)
+    batches = [_signatures(rng, 50) for _ in range(9)]
+    # near duplicates across batches: one band in common
+    batches[3][0, :3] = batches[0][7, :3]
+    batches[8][1, 3:6] = batches[3][0, 3:6]
+    batches[8][2] = batches[8][5]
+
+    index = LSHIndex(tmp_path / "index", num_bands=4, rows=3, fanout=2)
+    for i, batch in enumerate(batches):
+        doc_ids = index.add(batch, source=f"batch_{i}")
+        assert doc_ids[0] == 50 * i
+    assert len(index.segments) < len(batches)
+
+    # reopening keeps everything
+    index = LSHIndex(tmp_path / "index")
+    clusters = index.clusters(keep_singletons=False)
+    assert sorted(map(sorted, clusters)) == [[7, 150, 401], [402, 405]]
+    assert sum(map(len, index.clusters())) == 450
+    np.testing.assert_array_equal(index.cluster_ids([401, 405, 3]), [7, 402, 3])
+
+
+def test_query(tmp_path):
+    rng = np.random.default_rng(2)
+    index = LSHIndex(tmp_path / "index", num_bands=4, rows=3)
+    old = _signatures(rng, 20)
+    index.insert(old)
+    new = _signatures(rng, 3)
+    new[1, 6:9] = old[4, 6:9]
+    new[2] = old[9]
+    rows, doc_ids = index.query(new)
+    assert list(zip(rows.tolist(), doc_ids.tolist())) == [(1, 4), (2, 9)]
+
+
+def test_source_added_once(tmp_path):
+    index = LSHIndex(tmp_path / "index", num_bands=4, rows=3)
+    index.add(_signatures(np.random.default_rng(3), 4), source="a")
+    with pytest.raises(ValueError):
+        index.add(_signatures(np.random.default_rng(3), 4), source="a")
+    with pytest.raises(ValueError):
+        LSHIndex(tmp_path / "index", num_bands=5, rows=3)
+
+
+def test_crash_during_add_is_rolled_back(tmp_path, monkeypatch):
+    rng = np.random.default_rng(4)
+    first, second = _signatures(rng, 20), _signatures(rng, 20)
+    # second[1] joins first[0] and first[1]
+    second[0, :3] = first[0, :3]
+    second[1, :3] = first[1, :3]
+    second[1, 3:6] = first[0, 3:6]
+    index = LSHIndex(tmp_path / "index", num_bands=4, rows=3)
+    index.add(first, source="first")
+    index.insert(_signatures(rng, 5))
+    expected = sorted(map(sorted, index.clusters()))
+
+    def crash(*args, **kwargs):
+        raise OSError("disk full")
+
+    # the unions of `second` reach parent.npy, the manifest commit doesn't happen
+    monkeypatch.setattr(index, "_write_segment", crash)
+    with pytest.raises(OSError):
+        index.add(second, source="second")
+    assert sorted(map(sorted, index.clusters())) != expected
+
+    index = LSHIndex(tmp_path / "index")
+    assert len(index) == 25
+    assert sorted(map(sorted, index.clusters())) == expected
+    index.add(second, source="second")
+    assert sorted(map(sorted, index.clusters(keep_singletons=False))) == [[0, 1, 25, 26]]
+
+
+def _write_dump(directory, texts_per_file):
+    directory.mkdir()
+    for i, texts in enumerate(texts_per_file):
+        (directory / f"{directory.name}_{i}.jsonl").write_text("".join(json.dumps({"text": t}) + "\n" for t in texts))
+    return sorted(directory.glob("*.jsonl"))
+
+
+def test_update_index_from_separate_signature_dirs(tmp_path):
+    words = [f"w{i}" for i in range(400)]
+    original = " ".join(words[:200])
+    dumps = {
+        "dump_a": [[original, " ".join(words[200:300])]],
+        # same batch file name in its own sig dir; the first document is a copy from dump_a
+        "dump_b": [[original, " ".join(words[300:])]],
+    }
+    seeds = make_seeds(64, 0)
+    index = LSHIndex(tmp_path / "index", num_bands=16, rows=4)
+    for name, texts_per_file in dumps.items():
+        input_files = _write_dump(tmp_path / name, texts_per_file)
+        sig_dir = tmp_path / f"sigs_{name}"
+        sig_dir.mkdir()
+        batch_file = sig_dir / "signatures_batch_0000.pkl"
+        signature_batch(input_files, 0, seeds, 5, "one_perm", None, batch_file)
+        update_index(index, [batch_file])
+        # adding the same dir again is a no-op
+        update_index(index, [batch_file])
+
+    assert len(index) == 4 and len(index.sources) == 2
+    clusters, metadata = index_clusters(index)
+    assert [m["jsonl_file"] for m in metadata] == ["dump_a_0.jsonl"] * 2 + ["dump_b_0.jsonl"] * 2
+    assert sorted(map(sorted, (c for c in clusters if len(c) > 1))) == [[0, 2]]
+
+    # a batch recomputed over a file list that overlaps indexed files only adds the new files
+    input_files = sorted((tmp_path / "dump_a").glob("*.jsonl")) + _write_dump(tmp_path / "dump_c", [["new doc"]])
+    batch_file = tmp_path / "signatures_batch_0000.pkl"
+    signature_batch(input_files, 0, seeds, 5, "one_perm", None, batch_file)
+    update_index(index, [batch_file])
+    assert len(index) == 5
+
+
+def test_signature_formats_are_not_mixed(tmp_path):
+    input_files = _write_dump(tmp_path / "dump", [["first document here", "second document here"]])
+    seeds = make_seeds(64, 0)
+    batches = {}
+    for name, mode, bits in [("k_perm", "k_perm", None), ("k_perm_16", "k_perm", 16), ("one_perm", "one_perm", None)]:
+        batches[name] = tmp_path / f"{name}.pkl"
+        signature_batch(input_files, 0, seeds, 5, mode, bits, batches[name])
+        assert read_batch_format(batches[name]) == signature_format(mode, 5, seeds, bits)
+    assert len({read_batch_format(path) for path in batches.values()}) == 3
+    assert signature_format("k_perm", 5, seeds, None) != signature_format("k_perm", 5, make_seeds(64, 1), None)
+
+    assert check_signature_format([batches["k_perm"]]) == signature_format("k_perm", 5, seeds, None)
+    with pytest.raises(ValueError, match="different formats"):
+        check_signature_format([batches["k_perm"], batches["one_perm"]])
+
+    # an index takes the format of its first batch and rejects others
+    index = LSHIndex(tmp_path / "index", num_bands=16, rows=4)
+    update_index(index, [batches["k_perm"]])
+    with pytest.raises(ValueError, match="signature format"):
+        update_index(index, [batches["one_perm"]])
+    assert len(index) == 2
+    index = LSHIndex(tmp_path / "index", signature_format=signature_format("k_perm", 5, seeds, None))
+    with pytest.raises(ValueError, match="signature_format"):
+        LSHIndex(tmp_path / "index", signature_format=signature_format("one_perm", 5, seeds, None))
+
+
+def test_changed_format_is_recomputed(tmp_path):
+    input_files = _write_dump(tmp_path / "dump", [["some document text"]])
+    sig_dir = tmp_path / "sigs"
+    sig_dir.mkdir()
+    get_signatures_parallel_incremental(input_files, 64, 5, sig_dir, mode="one_perm")
+    batch_file = sig_dir / "signatures_batch_0000.pkl"
+    assert read_batch_format(batch_file) == signature_format("one_perm", 5, make_seeds(64, 0), None)
+    # same input files, other bits: not skipped
+    get_signatures_parallel_incremental(input_files, 64, 5, sig_dir, mode="one_perm", bits=16)
+    assert read_batch_format(batch_file) == signature_format("one_perm", 5, make_seeds(64, 0), 16)
@@ -0,0 +1,37 @@
+import numpy as np
+
+from cs336_data.lsh_params import (
+    LSHParams, collision_probability, false_negative_mass, false_positive_mass, optimal_lsh_params
+)
+
+
+def test_collision_probability_s_curve():
+    s = np.linspace(0, 1, 101)
+    p = collision_probability(s, 20, 5)
+    assert p[0] == 0 and p[-1] == 1
+    assert np.all(np.diff(p) >= 0)
+    assert np.isclose(collision_probability(0.5, 20, 5), 1 - (1 - 0.5**5) ** 20)
+
+
+def test_optimal_lsh_params():
+    params = optimal_lsh_params(0.8, max_hashes=64)
+    assert params.num_hashes <= 64
+    error = (params.false_positive + params.false_negative) / 2
+    # the chosen setting beats a few hand-picked ones within the budget
+    for num_bands, rows in [(4, 16), (8, 8), (16, 4), (64, 1)]:
+        other = (false_positive_mass(0.8, num_bands, rows) + false_negative_mass(0.8, num_bands, rows)) / 2
+        assert error <= other + 1e-4
+    # the steep part of the S-curve sits near the threshold
+    assert abs((1 / params.num_bands) ** (1 / params.rows) - 0.8) < 0.1
+
+
+def test_fn_weight_lowers_false_negatives():
+    balanced = optimal_lsh_params(0.7, max_hashes=48)
+    recall = optimal_lsh_params(0.7, max_hashes=48, fp_weight=0.1, fn_weight=0.9)
+    assert recall.false_negative <= balanced.false_negative
+
+
+def test_save_load(tmp_path):
+    params = optimal_lsh_params(0.8, max_hashes=32)
+    params.save(tmp_path / "lsh_params.json")
+    assert LSHParams.load(tmp_path / "lsh_params.json") == params
@@ -0,0 +1,97 @@
+import json
+import random
+
+import numpy as np
+import pytest
+
+from cs336_data.leaderboard_create_signature import get_signatures_single_file
+from cs336_data.minhash_dedpulication import minhash_deduplication
+from cs336_data.minhash_signatures import (
+    SIGNATURE_MODES, document_signature, estimate_jaccard, k_perm_signature, one_permutation_signature,
+    signature_dtype, truncate_bits
+)
+from cs336_data.text_normalization import shingle_hashes
+
+from .common import FIXTURES_PATH
+
+
+def _shingles(n, offset=0):
+    return shingle_hashes([f"w{i}" for i in range(offset, offset + n)], 1)
+
+
+def test_one_permutation_signature_is_consistent():
+    shingles = _shingles(1000)
+    a = one_permutation_signature(shingles, 128, seed=7)
+    b = one_permutation_signature(shingles[::-1].copy(), 128, seed=7)
+    assert a.dtype == np.uint32
+    np.testing.assert_array_equal(a, b)
+    assert not np.array_equal(a, one_permutation_signature(shingles, 128, seed=8))
+
+
+def test_densification_fills_every_bin():
+    # 3 shingles, 256 bins: every bin is copied from one of the (at most) 3 filled ones
+    signature = one_permutation_signature(_shingles(3), 256, seed=1)
+    assert len(np.unique(signature)) <= 3
+    assert np.all(signature != np.uint32(0xFFFFFFFF))
+    assert np.all(one_permutation_signature(_shingles(0), 16, seed=1) == np.uint32(0xFFFFFFFF))
+
+
+def test_k_perm_signature():
+    seeds = list(range(1, 257))
+    a = k_perm_signature(_shingles(1000), seeds)
+    assert a.dtype == np.uint32 and len(a) == 256
+    np.testing.assert_array_equal(a, k_perm_signature(_shingles(1000)[::-1].copy(), seeds))
+    assert np.all(k_perm_signature(_shingles(0), seeds) == np.uint32(0xFFFFFFFF))
+    b = k_perm_signature(_shingles(1000, offset=500), seeds)
+    assert abs(estimate_jaccard(a, b) - 1 / 3) < 0.1
+
+
+@pytest.mark.parametrize("mode", SIGNATURE_MODES)
+@pytest.mark.parametrize("bits", [None, 16, 8])
+def test_short_document(tmp_path, mode, bits):
+    seeds = list(range(1, 65))
+    # fewer words than `ngrams`: one shingle in both modes
+    short = document_signature("Just three words.", seeds, ngrams=5, mode=mode, bits=bits)
+    assert short.dtype == signature_dtype(bits) and len(short) == 64
+    np.testing.assert_array_equal(short, document_signature("just THREE words", seeds, 5, mode, bits))
+    empty = document_signature("", seeds, ngrams=5, mode=mode, bits=bits)
+    assert np.all(empty == truncate_bits(np.full(64, 0xFFFFFFFF), bits))
+    assert not np.array_equal(short, empty)
+
+    shard = tmp_path / "docs.jsonl"
+    shard.write_text("\n".join(json.dumps({"text": text}) for text in ["", "short doc", "a b c d e f g"]) + "\n")
+    _, records = get_signatures_single_file(shard, 0, seeds, 5, mode, bits)
+    assert [record["line_id"] for record in records] == [0, 1, 2]
+    np.testing.assert_array_equal(records[1]["signatures"], document_signature("short doc", seeds, 5, mode, bits))
+
+
+def test_estimate_jaccard():
+    rng = random.Random(0)
+    for _ in range(5):
+        overlap = rng.randint(100, 900)
+        # sets {0..999} and {1000 - overlap .. 1999 - overlap}
+        a, b = _shingles(1000), _shingles(1000, offset=1000 - overlap)
+        truth = overlap / (2000 - overlap)
+        for bits in (None, 16, 8):
+            sig_a = truncate_bits(one_permutation_signature(a, 1024, seed=3), bits)
+            sig_b = truncate_bits(one_permutation_signature(b, 1024, seed=3), bits)
+            assert abs(estimate_jaccard(sig_a, sig_b, bits) - truth) < 0.07
+
+
+def test_truncate_bits():
+    assert signature_dtype(8) == np.uint8 and signature_dtype(16) == np.uint16 and signature_dtype(None) == np.uint32
+    # signed mmh3 minima of the k-permutation signatures
+    truncated = truncate_bits([-1, 0, 257, -2**31], 8)
+    assert truncated.dtype == np.uint8
+    assert truncated.tolist() == [255, 0, 1, 0]
+    # empty positions of older float k-permutation signatures
+    assert truncate_bits([float("inf"), -5.0], 16).tolist() == [0xFFFF, 0xFFFB]
+
+
+def test_minhash_deduplication_one_perm(tmp_path):
+    paths = sorted((FIXTURES_PATH / "documents_with_fuzzy_duplicates").glob("*.txt"))
+    minhash_deduplication(paths, tmp_path, num_hashes=500, ngrams=5, num_bands=50, jaccard_threshold=0.8,
+                          signature_mode="one_perm", signature_bits=8)
+    # rails_mit_license.txt and react_mit_license.txt are fuzzy duplicates, one of them is kept
+    kept = sorted(path.name for path in tmp_path.glob("*"))
+    assert len(kept) == 2 and "pytorch_license.txt" in kept
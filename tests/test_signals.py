@@ -0,0 +1,41 @@
+import numpy as np
+
+from cs336_data.document_shards import ShardWriter, iter_documents
+from cs336_data.leaderboard_signals import SIGNAL_DTYPE, materialize, select_mask, stage_counts
+
+
+def _signals():
+    # url_filtered, lang, lang_score, non_nsfw, non_toxic, n_words, mean_word_len, alpha_word_frac, valid_line_frac
+    return np.array([
+        (False, b"en", 0.95, 0.99, 0.99, 300, 4.5, 0.95, 1.0),  # kept
+        (True, b"en", 0.95, 0.99, 0.99, 300, 4.5, 0.95, 1.0),   # url
+        (False, b"de", 0.99, 0.99, 0.99, 300, 4.5, 0.95, 1.0),  # lang
+        (False, b"en", 0.85, 0.99, 0.99, 300, 4.5, 0.95, 1.0),  # lang score
+        (False, b"en", 0.95, 0.99, 0.99, 20, 4.5, 0.95, 1.0),   # quality: too short
+        (False, b"en", 0.95, 0.99, 0.99, 300, 4.5, 0.50, 1.0),  # quality: not enough alphabetic words
+        (False, b"en", 0.95, 0.40, 0.99, 300, 4.5, 0.95, 1.0),  # nsfw
+        (False, b"en", 0.95, 0.99, 0.80, 300, 4.5, 0.95, 1.0),  # toxic
+    ], dtype=SIGNAL_DTYPE)
+
+
+def test_select_mask_stage_counts():
+    signals = _signals()
+    assert stage_counts(select_mask(signals)) == {
+        "by_url": 1, "by_lang": 2, "by_quality": 2, "by_nsfw": 1, "by_toxic": 1, "kept": 1
+    }
+    relaxed = select_mask(signals, score_lang=0.8, score_toxic=0.5, min_word_cnt=10, url_filter=False)
+    assert np.flatnonzero(relaxed["kept"]).tolist() == [0, 1, 3, 4, 7]
+
+
+def test_materialize_kept_records(tmp_path):
+    signals = _signals()
+    np.save(tmp_path / "file.signals.npy", signals)
+    with ShardWriter(tmp_path / "file.jsonl.zst", block_records=3) as writer:
+        for i in range(len(signals)):
+            writer.write({"text": f"doc {i}", "url": f"https://example.com/{i}", "record_id": f"<urn:{i}>"})
+
+    n_kept = materialize(tmp_path / "file.signals.npy", tmp_path / "out.jsonl", {"score_lang": 0.8})
+    records = list(iter_documents(tmp_path / "out.jsonl"))
+    assert n_kept == 2
+    assert [r["text"] for r in records] == ["doc 0", "doc 3"]
+    assert abs(records[1]["lang_score"] - 0.85) < 1e-6
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from cs336_data.cpus import available_cpus
+from cs336_data.suffix_array_dedup import (
+    chunk_suffix_array, deduplicate_tokens, default_workers, open_tokens, worker_memory,
+)
+
+MIN_LENGTH = 8
+
+
+def _tokens():
+    rng = np.random.default_rng(0)
+    tokens = rng.integers(0, 20, size=3000).astype(np.uint16)
+    tokens[1000:1100] = tokens[100:200]
+    tokens[2500:2520] = tokens[100:120]
+    # one span repeated many times, so it spans several merge buckets
+    for i in range(40):
+        tokens[1500 + i * 10:1509 + i * 10] = tokens[300:309]
+    return tokens
+
+
+def _reference_mask(tokens):
+    seen, mask = set(), np.zeros(len(tokens), dtype=bool)
+    for i in range(len(tokens) - MIN_LENGTH + 1):
+        span = tuple(tokens[i:i + MIN_LENGTH])
+        if span in seen:
+            mask[i:i + MIN_LENGTH] = True
+        seen.add(span)
+    return mask
+
+
+def test_chunk_suffix_array(tmp_path):
+    tokens = _tokens()
+    tokens.tofile(tmp_path / "tokens.bin")
+    mmap = open_tokens(tmp_path / "tokens.bin")
+    for start, end in [(0, len(tokens)), (700, 1900), (2990, 3000)]:
+        expected = sorted(range(start, min(end, len(tokens) - MIN_LENGTH + 1)),
+                          key=lambda i: (tuple(tokens[i:i + MIN_LENGTH]), i))
+        assert chunk_suffix_array(mmap, start, end, MIN_LENGTH).tolist() == expected
+
+
+@pytest.mark.parametrize("chunk_tokens,bucket_suffixes", [(3000, 10**6), (500, 300), (257, 64)])
+def test_deduplicate_tokens(tmp_path, chunk_tokens, bucket_suffixes):
+    tokens = _tokens()
+    tokens.tofile(tmp_path / "tokens.bin")
+    stats = deduplicate_tokens(tmp_path / "tokens.bin", tmp_path / "dedup.bin", tmp_path / "work", MIN_LENGTH,
+                               chunk_tokens, bucket_suffixes, n_workers=2, keep_token=None, sample_stride=16)
+    mask = _reference_mask(tokens)
+    np.testing.assert_array_equal(np.fromfile(tmp_path / "dedup.bin", dtype=np.uint16), tokens[~mask])
+    assert stats["removed"] == mask.sum()
+    # the merged buckets form the suffix array of the whole stream
+    assert np.load(tmp_path / "work" / "suffix_array.npy").tolist() == chunk_suffix_array(
+        tokens, 0, len(tokens), MIN_LENGTH).tolist()
+
+
+def test_keep_token(tmp_path):
+    tokens = np.tile(np.arange(10, dtype=np.uint16), 5)  # 9 is the document separator
+    tokens.tofile(tmp_path / "tokens.bin")
+    deduplicate_tokens(tmp_path / "tokens.bin", tmp_path / "dedup.bin", tmp_path / "work", MIN_LENGTH,
+                       n_workers=1, keep_token=9)
+    output = np.fromfile(tmp_path / "dedup.bin", dtype=np.uint16)
+    assert output[:10].tolist() == list(range(10)) and output[10:].tolist() == [9] * 4
+
+
+def test_default_workers_fit_the_memory_budget():
+    n_cpus = available_cpus()
+    # the defaults: a 64M-token chunk is ~2 GB in pass 1, a 16M-suffix bucket of 50-token spans ~3.5 GB in pass 3
+    assert worker_memory(1 << 26, 1 << 24, 50) == (4 * 50 + 24) << 24
+    assert worker_memory(1 << 26, 1 << 10, 50) == 30 * ((1 << 26) + 50)
+    per_worker = worker_memory(1 << 20, 1 << 16, 50)
+    assert default_workers(1 << 20, 1 << 16, 50, memory_budget=3 * per_worker + 1) == min(3, n_cpus)
+    assert default_workers(1 << 20, 1 << 16, 50, memory_budget=per_worker // 2) == 1
+    assert default_workers(1 << 20, 1 << 16, 50, memory_budget=10**6 * per_worker) == n_cpus
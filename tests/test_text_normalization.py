@@ -0,0 +1,45 @@
+import numpy as np
+
+from cs336_data.minhash_dedpulication import normalize_text
+from cs336_data.text_normalization import normalize_words, shingle_hashes
+
+from .common import FIXTURES_PATH
+
+TRICKY = [
+    "",
+    "   ",
+    "Hello, World! It's a test-case... (really)",
+    "  leading and trailing whitespace\n\t",
+    "Café naïve résumé Ångström façade",
+    "ΟΔΟΣ ΟΣ'Α Σ.Σ",  # Greek final sigma depends on the neighbours of Σ
+    "İstanbul ǅ ß ﬁ Ⅻ",  # lowercasing that changes length
+    "é ạ̈ combining marks after base letters",
+    "non-breaking space, ideographic　space, line separator",
+    ";greek question mark; and varia `",
+    "中文字符 and emoji 🙂 and ＦＵＬＬＷＩＤＴＨ",
+    "lone surrogate \ud800 here",
+]
+
+
+def _reference(text):
+    return [word for word in normalize_text(text) if word]
+
+
+def test_normalize_words_parity():
+    for text in TRICKY:
+        assert normalize_words(text) == _reference(text), text
+    for path in sorted(FIXTURES_PATH.rglob("*.txt")):
+        text = path.read_text(errors="ignore")
+        assert normalize_words(text) == _reference(text), path
+
+
+def test_shingle_hashes():
+    words = "the quick brown fox jumps over the quick brown fox".split()
+    hashes = shingle_hashes(words, 3)
+    assert hashes.dtype == np.uint64
+    assert len(hashes) == len(words) - 3 + 1
+    # equal shingles hash equally, different ones don't
+    assert hashes[0] == hashes[6]
+    assert len(set(hashes.tolist())) == 6
+    assert len(shingle_hashes(words[:2], 3)) == 1
+    assert len(shingle_hashes([], 3)) == 0
@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+
+from cs336_data.text_windows import TextWindow, classifier_input, evaluate_windows
+
+
+def test_windows():
+    text = "".join(str(i % 10) for i in range(10000))
+    assert classifier_input("a\nb") == "a b"
+    assert TextWindow("head", 100)(text) == text[:100]
+    assert TextWindow("head_tail", 100)(text) == text[:50] + " " + text[-50:]
+    spans = TextWindow("spans", 100, n_spans=4)(text)
+    assert len(spans) == 100 + 3
+    assert spans == TextWindow("spans", 100, n_spans=4)(text)
+    # short texts are never cut
+    assert TextWindow("head_tail", 100)("short") == "short"
+    assert TextWindow.parse("spans:4:2000") == TextWindow("spans", 2000, n_spans=4)
+    assert str(TextWindow.parse("head_tail:500")) == "head_tail:500"
+    assert TextWindow.parse("spans") == TextWindow("spans")
+    for spec in ["middle:10", "spans:4", "spans:4:x", "head:10:20", "full:10", "head:"]:
+        with pytest.raises(ValueError):
+            TextWindow.parse(spec)
+    with pytest.raises(ValueError, match="spans:K:N"):
+        TextWindow.parse("spans:4")
+    with pytest.raises(ValueError):
+        TextWindow("spans", 3, n_spans=4)
+
+
+def test_spans_do_not_overlap():
+    window = TextWindow("spans", 400, n_spans=8)
+    for length in [401, 450, 1000, 10000]:
+        for offset in range(20):
+            # every character is unique, so each span's position can be found
+            text = "".join(chr(0x4e00 + offset + i) for i in range(length))
+            starts = [text.index(span) for span in window(text).split(" ")]
+            assert len(starts) == 8
+            assert all(b - a >= 50 for a, b in zip(starts, starts[1:]))
+            assert starts[-1] + 50 <= length
+    # the positions depend on the content, not only on the length
+    texts = ["".join(chr(0x4e00 + offset + i) for i in range(10000)) for offset in range(2)]
+    starts = [[text.index(span) for span in window(text).split(" ")] for text in texts]
+    assert starts[0] != starts[1]
+
+
+class LastCharModel:
+    """stand-in fastText model: `__label__en` iff the input ends with "e" """
+
+    def predict(self, texts):
+        labels = [["__label__en" if text.endswith("e") else "__label__fr"] for text in texts]
+        return labels, [np.array([0.99]) for _ in texts]
+
+
+def test_evaluate_windows():
+    texts = ["x" * 5000 + "e", "e" * 5000 + "x", "short e"]
+    results = evaluate_windows(texts, {"lang": LastCharModel()}, {"lang": 0.5},
+                               [TextWindow("head", 100), TextWindow("head_tail", 100)])
+    assert results[0]["window"] == "head:100"
+    # head cuts off the deciding last character of both long documents
+    assert results[0]["lang_label"] == pytest.approx(1 / 3)
+    assert results[1]["lang_label"] == 1.0
+    assert results[1]["lang_decision"] == 1.0
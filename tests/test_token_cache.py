@@ -0,0 +1,113 @@
+import resource
+
+import numpy as np
+
+from cs336_basics.data import ShardWriter, TokenDataset
+from cs336_data.token_cache import TokenCache, coalesce
+
+VOCAB_SIZE = 1000
+EOS = 999
+
+
+def _tokenize(text):
+    return [hash(word) % EOS for word in text.split()] + [EOS]
+
+
+def _assemble(cache, texts, path):
+    # what `leaderboard_tokenization.tokenize_cached` does: new documents are written as they are tokenized,
+    # cached ones copied in runs, and the cache is flushed once at the end
+    spans = cache.spans(texts)
+    n_runs, run = 0, []
+    with ShardWriter(path, VOCAB_SIZE, EOS) as writer:
+        for text, span in zip(texts, spans):
+            if span is not None:
+                run.append(span)
+                continue
+            n_runs += cache.copy(run, writer)
+            run = []
+            ids = _tokenize(text)
+            cache.add(text, ids)
+            writer.write(ids)
+        n_runs += cache.copy(run, writer)
+    cache.flush()
+    return spans.count(None), n_runs
+
+
+def test_coalesce():
+    spans = [("a", 0, 3), ("a", 3, 2), ("b", 5, 1), ("a", 5, 4), ("a", 10, 1)]
+    assert list(coalesce(spans)) == [("a", 0, 5), ("b", 5, 6), ("a", 5, 9), ("a", 10, 11)]
+    assert list(coalesce([])) == []
+
+
+def test_rerun_tokenizes_only_new_documents(tmp_path):
+    texts = [f"document {i} " + "word " * (i % 17) for i in range(500)]
+    cache = TokenCache(tmp_path / "cache", VOCAB_SIZE, EOS, namespace="test", shard_tokens=2000)
+
+    n_tokenized, _ = _assemble(cache, texts, tmp_path / "first.tok")
+    assert n_tokenized == 500
+    assert len(cache) == 500
+
+    # a rerun with a few documents dropped and a few new ones, and a duplicate
+    rerun = texts[:100] + [f"new {i}" for i in range(5)] + texts[150:] + texts[:1]
+    n_tokenized, n_runs = _assemble(cache, rerun, tmp_path / "second.tok")
+    assert n_tokenized == 5
+    assert n_runs < 20
+
+    expected = np.concatenate([_tokenize(text) for text in rerun])
+    np.testing.assert_array_equal(TokenDataset(tmp_path / "second.tok")[:], expected)
+    assert TokenDataset(tmp_path / "second.tok").eos_id == EOS
+
+    stats = cache.stats()
+    assert stats["entries"] == 505
+    assert stats["misses"] == 505
+    assert stats["hits"] == len(rerun) - 5
+    assert stats["hit_rate"] == (len(rerun) - 5) / (len(rerun) + 500)
+
+
+def test_counters_are_saved_on_close(tmp_path):
+    cache = TokenCache(tmp_path / "cache", VOCAB_SIZE, EOS, namespace="test")
+    cache.add("cached", [1, EOS])
+    cache.flush()
+    for _ in range(3):
+        cache.spans(["cached", "not cached"])
+    assert (cache.hits, cache.misses) == (3, 3)
+
+    other = TokenCache(tmp_path / "cache", VOCAB_SIZE, EOS, namespace="test")
+    assert (other.stats()["hits"], other.stats()["misses"]) == (0, 0)
+    cache.close()
+    assert (other.stats()["hits"], other.stats()["misses"]) == (3, 3)
+    other.spans(["cached"])
+    assert other.stats()["hits"] == 4
+
+
+def test_namespace_separates_tokenizers(tmp_path):
+    a = TokenCache(tmp_path / "cache", VOCAB_SIZE, EOS, namespace="a")
+    b = TokenCache(tmp_path / "cache", VOCAB_SIZE, EOS, namespace="b")
+    a.add("some text", [1, 2, EOS])
+    a.flush()
+    assert a.spans(["some text"])[0] is not None
+    assert b.spans(["some text"]) == [None]
+    np.testing.assert_array_equal(a.tokens(a.spans(["some text"])[0]), [1, 2, EOS])
+
+
+def test_copy_from_more_shards_than_descriptors(tmp_path):
+    texts = [f"document {i}" for i in range(1500)]
+    # one store shard per document
+    cache = TokenCache(tmp_path / "cache", VOCAB_SIZE, EOS, namespace="test", shard_tokens=1)
+    for text in texts:
+        cache.add(text, _tokenize(text))
+    cache.close()
+    assert len(list((tmp_path / "cache" / "shards").glob("*.tok"))) == 1500
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (min(1024, hard), hard))
+    try:
+        cache = TokenCache(tmp_path / "cache", VOCAB_SIZE, EOS, namespace="test")
+        with ShardWriter(tmp_path / "out.tok", VOCAB_SIZE, EOS) as writer:
+            assert cache.copy(cache.spans(texts), writer) == 1500
+        assert len(cache._shards) <= cache.max_open_shards
+        cache.close()
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    np.testing.assert_array_equal(TokenDataset(tmp_path / "out.tok")[:],
+                                  np.concatenate([_tokenize(text) for text in texts]))
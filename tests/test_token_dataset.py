@@ -0,0 +1,103 @@
+import numpy as np
+import pytest
+import torch
+
+from cs336_basics.data import (
+    SHARD_HEADER_SIZE, ShardHeader, ShardWriter, TokenDataset, get_batch, get_batch_at, read_shard_header,
+    write_shard
+)
+
+VOCAB_SIZE = 50257
+EOS = 50256
+
+
+def _write_shards(directory, lengths, seed=0):
+    rng = np.random.default_rng(seed)
+    directory.mkdir()
+    parts = [rng.integers(0, VOCAB_SIZE, size=n) for n in lengths]
+    for i, part in enumerate(parts):
+        write_shard(directory / f"part_{i:05d}.tok", part, VOCAB_SIZE, EOS)
+    return np.concatenate(parts)
+
+
+def test_header_round_trip(tmp_path):
+    header = write_shard(tmp_path / "a.tok", [1, 2, 3, EOS], VOCAB_SIZE, EOS)
+    assert header == ShardHeader(np.dtype("<u2"), VOCAB_SIZE, 4, EOS)
+    assert read_shard_header(tmp_path / "a.tok") == header
+    assert (tmp_path / "a.tok").stat().st_size == SHARD_HEADER_SIZE + 4 * 2
+
+    with ShardWriter(tmp_path / "b.tok", vocab_size=100) as writer:
+        writer.write([1, 2])
+        writer.write(np.array([3], dtype=np.int64))
+    assert read_shard_header(tmp_path / "b.tok") == ShardHeader(np.dtype("<u2"), 100, 3, None)
+    assert not (tmp_path / "b.tok.tmp").exists()
+
+    with pytest.raises(ValueError):
+        write_shard(tmp_path / "c.tok", [100], vocab_size=100)
+    assert not (tmp_path / "c.tok").exists() and not (tmp_path / "c.tok.tmp").exists()
+
+
+def test_large_vocab_is_uint32(tmp_path):
+    write_shard(tmp_path / "big.tok", [70000, 1, 99_999], vocab_size=100_000)
+    assert read_shard_header(tmp_path / "big.tok").dtype == np.dtype("<u4")
+    dataset = TokenDataset(tmp_path / "big.tok")
+    assert dataset.dtype == np.uint32 and dataset.vocab_size == 100_000
+    assert dataset[:].tolist() == [70000, 1, 99_999]
+
+
+def test_slices_across_shards(tmp_path):
+    expected = _write_shards(tmp_path / "shards", [100, 0, 7, 1000, 1])
+    dataset = TokenDataset(tmp_path / "shards")
+    assert len(dataset) == len(expected) == 1108
+    assert dataset.vocab_size == VOCAB_SIZE and dataset.eos_id == EOS
+    rng = np.random.default_rng(1)
+    for start in [0, 99, 100, 106, 107, 1106, *rng.integers(0, len(expected), size=200)]:
+        for length in (0, 1, 2, 8, 50, 1200):
+            np.testing.assert_array_equal(dataset[start:start + length], expected[start:start + length])
+    np.testing.assert_array_equal(dataset[::7], expected[::7])
+    np.testing.assert_array_equal(dataset[-20:], expected[-20:])
+
+
+def test_indexing(tmp_path):
+    expected = _write_shards(tmp_path / "shards", [3, 0, 4])
+    dataset = TokenDataset(tmp_path / "shards")
+    assert [dataset[i] for i in range(7)] == expected.tolist()
+    assert dataset[-1] == expected[-1] and dataset[-7] == expected[0]
+    assert dataset[np.int64(3)] == expected[3] and dataset[torch.tensor(4)] == expected[4]
+    for index in (7, -8, 100):
+        with pytest.raises(IndexError):
+            dataset[index]
+
+
+def test_legacy_bin(tmp_path):
+    tokens = np.arange(1000, dtype=np.uint16)
+    tokens.tofile(tmp_path / "train.bin")
+    dataset = TokenDataset(tmp_path / "train.bin")
+    assert len(dataset) == 1000 and dataset.vocab_size is None and dataset.eos_id is None
+    np.testing.assert_array_equal(dataset[10:20], tokens[10:20])
+
+
+def test_shards_must_agree_on_eos(tmp_path):
+    (tmp_path / "shards").mkdir()
+    write_shard(tmp_path / "shards" / "a.tok", [1], VOCAB_SIZE, EOS)
+    write_shard(tmp_path / "shards" / "b.tok", [1], VOCAB_SIZE, 0)
+    with pytest.raises(ValueError):
+        TokenDataset(tmp_path / "shards")
+    with pytest.raises(FileNotFoundError):
+        TokenDataset(tmp_path / "empty_dir_does_not_exist")
+
+
+def test_get_batch_on_dataset(tmp_path):
+    expected = _write_shards(tmp_path / "shards", [30, 0, 50, 20])
+    dataset = TokenDataset(tmp_path / "shards")
+    # windows starting in one shard and ending in the next
+    starts = torch.tensor([0, 25, 28, 75, 89])
+    x, y = get_batch_at(dataset, starts, context_length=10, device="cpu")
+    assert x.shape == y.shape == (5, 10) and x.dtype == torch.int64
+    for row, start in enumerate(starts.tolist()):
+        assert x[row].tolist() == expected[start:start + 10].tolist()
+        assert y[row].tolist() == expected[start + 1:start + 11].tolist()
+
+    x, y = get_batch(dataset, batch_size=8, context_length=16, device="cpu")
+    assert x.shape == (8, 16)
+    assert torch.equal(x[:, 1:], y[:, :-1])
@@ -0,0 +1,65 @@
+import numpy as np
+
+from cs336_data.url_filter import DomainBlocklist, UrlFilter, _legacy_should_filter_url
+
+URLS = [
+    "https://www.example.com/page?q=1",
+    "http://news.bbc.co.uk/article",
+    "https://www.pornhub.com/video",
+    "https://m.facebook.com/profile",
+    "https://example.de/seite",
+    "http://user:pw@Docs.Python.ORG:8080/3/",
+    "https://sub.domain.example.edu#anchor",
+    "not a url",
+    "",
+]
+
+
+def test_url_filter_matches_per_url_extraction():
+    url_filter = UrlFilter()
+    expected = [_legacy_should_filter_url(url, url_filter.extractor) for url in URLS]
+    assert [url_filter(url) for url in URLS] == expected
+    assert url_filter.filter_urls(URLS) == expected
+    # every decision after the first for a host comes from the cache
+    assert [url_filter(url) for url in URLS] == expected
+    assert url_filter.cache_info().hits > 0
+
+
+def test_domain_blocklist(tmp_path):
+    (tmp_path / "a").write_text("example.com\n# comment\nExample.com\n\n")
+    (tmp_path / "b").write_text("ads.tracker.net  # inline comment\n.example.com\n")
+    blocklist = DomainBlocklist.from_files([tmp_path / "a", tmp_path / "b"])
+    # sorted unique uint64 hashes, duplicates and case folded together
+    assert blocklist.hashes.dtype == np.uint64
+    assert len(blocklist) == 2
+    assert (blocklist.hashes[1:] > blocklist.hashes[:-1]).all()
+    assert "example.com" in blocklist and "ads.tracker.net" in blocklist
+    # membership is exact; parents are only walked by `blocks_host`
+    assert "www.example.com" not in blocklist
+    assert "tracker.net" not in blocklist
+    assert blocklist.blocks_host("www.example.com")
+    assert blocklist.blocks_host("x.ads.tracker.net")
+    assert not blocklist.blocks_host("tracker.net")
+    assert not blocklist.blocks_host("notexample.com")
+    assert "example.com" not in DomainBlocklist()
+
+    blocklist.save(tmp_path / "list.npy")
+    np.testing.assert_array_equal(DomainBlocklist.load(tmp_path / "list.npy").hashes, blocklist.hashes)
+
+
+def test_blocklist_blocks_subdomains(tmp_path):
+    blocklist_path = tmp_path / "domains"
+    blocklist_path.write_text("# UT1 style list\nbadsite.com\n.worse.org\n")
+    url_filter = UrlFilter.from_blocklist_files([blocklist_path])
+    assert url_filter("https://badsite.com/x")
+    assert url_filter("https://www.badsite.com/x")
+    assert url_filter("https://a.b.worse.org/")
+    assert not url_filter("https://goodsite.com/")
+    assert not url_filter("https://notbadsite.com/")
+
+    # a compiled list loads back to the same set
+    url_filter.blocklist.save(tmp_path / "domains.npy")
+    reloaded = UrlFilter.from_blocklist_files([tmp_path / "domains.npy"])
+    assert len(reloaded.blocklist) == 2
+    assert reloaded("https://www.badsite.com/x")
+    assert not reloaded("https://goodsite.com/")